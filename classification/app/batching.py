@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+from collections import Counter
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import TYPE_CHECKING, Any
+
+import structlog
+from fastapi import HTTPException
+from opentelemetry import trace
+
+from app.config import config
+from app.inference import InferenceExecutor, inference_executor
+from app.metrics import (
+    BATCH_SIZE_BUCKETS,
+    Histogram,
+    MetricFamily,
+    Sample,
+    register_collector,
+)
+from app.profiling import ProfileSummary, request_profiles
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Sequence
+
+logger = structlog.get_logger()
+
+
+@dataclass
+class BatchStats:
+    batches: int = 0
+    items: int = 0
+    size_histogram: Counter[int] = field(default_factory=Counter)
+    queue_wait_ms_total: float = 0.0
+    queue_wait_ms_max: float = 0.0
+
+
+@dataclass
+class _PendingItem[T, R]:
+    item: T
+    future: asyncio.Future[R]
+    enqueued_at: float = field(default_factory=perf_counter)
+    # Set when the caller is a profiled request, which then gets its batch's profile.
+    profiles: list[ProfileSummary] | None = None
+    batch_size: int = 0
+    queue_wait_ms: float = 0.0
+
+
+class MicroBatcher[T, R]:
+    """Groups concurrent single-item calls into batched forwards.
+
+    Callers `submit` one item and await its result. Consumers take the first queued
+    item, then keep collecting until `max_batch_size` items are gathered or
+    `max_wait_ms` has elapsed, run `batch_fn` once on the inference executor and fan
+    the results back out in order. While a batch is running, new requests pile up in
+    the queue, so batches grow with load without adding latency when idle.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        batch_fn: Callable[[list[T]], Sequence[R]],
+        *,
+        max_batch_size: int = config.BATCH_MAX_SIZE,
+        max_wait_ms: float = config.BATCH_MAX_WAIT_MS,
+        max_queue_size: int = config.INFERENCE_QUEUE_SIZE,
+        consumers: int = config.INFERENCE_CONCURRENCY,
+        executor: InferenceExecutor = inference_executor,
+    ) -> None:
+        self.name = name
+        self.stats = BatchStats()
+        self._batch_fn = batch_fn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._consumers = consumers
+        self._executor = executor
+        self._queue: asyncio.Queue[_PendingItem[T, R]] = asyncio.Queue(maxsize=max_queue_size)
+        self._tasks: list[asyncio.Task[None]] = []
+
+        _batchers.append(self)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, item: T) -> R:
+        self._ensure_started()
+
+        pending: _PendingItem[T, R] = _PendingItem(
+            item,
+            asyncio.get_running_loop().create_future(),
+            profiles=request_profiles.get(),
+        )
+        try:
+            self._queue.put_nowait(pending)
+        except asyncio.QueueFull as e:
+            logger.warning('Batch queue is full', batcher=self.name, depth=self.queue_depth)
+            raise HTTPException(status_code=503, detail='Inference queue is full') from e
+
+        result = await pending.future
+
+        span = trace.get_current_span()
+        span.set_attribute('batch.size', pending.batch_size)
+        span.set_attribute('batch.queue_wait_ms', pending.queue_wait_ms)
+        return result
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def _ensure_started(self) -> None:
+        # Consumers that died (e.g. on an unexpected error) are replaced as well.
+        self._tasks = [task for task in self._tasks if not task.done()]
+        if len(self._tasks) >= self._consumers:
+            return
+
+        # Consumers outlive the request that starts them, so they get a fresh context
+        # instead of inheriting (and parenting every batch span under) that request.
+        self._tasks += [
+            asyncio.create_task(
+                self._consume(),
+                name=f'{self.name}-batcher-{i}',
+                context=contextvars.Context(),
+            )
+            for i in range(len(self._tasks), self._consumers)
+        ]
+
+    async def _consume(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait
+
+            while len(batch) < self._max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except TimeoutError:
+                    break
+
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch: list[_PendingItem[T, R]]) -> None:
+        # Callers that went away (e.g. client disconnect) don't need a forward pass.
+        batch = [pending for pending in batch if not pending.future.done()]
+        if not batch:
+            return
+
+        dispatched_at = perf_counter()
+        for pending in batch:
+            pending.batch_size = len(batch)
+            pending.queue_wait_ms = (dispatched_at - pending.enqueued_at) * 1000
+        self._record(batch)
+
+        # Consumers run outside of any request, so a batch with a profiled request in it
+        # is marked here for the executor to profile it on its thread.
+        requested = [p.profiles for p in batch if p.profiles is not None]
+        summaries: list[ProfileSummary] = []
+        token = request_profiles.set(summaries if requested else None)
+
+        # Anything escaping here would kill the consumer and leave these futures, and
+        # every later submit, waiting forever.
+        try:
+            results = await self._executor.run(self._batch_fn, [p.item for p in batch])
+            # Checked up front, so a miscounted batch fails every caller instead of
+            # handing out results that may belong to someone else.
+            for pending, result in list(zip(batch, results, strict=True)):
+                if not pending.future.done():
+                    pending.future.set_result(result)
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+        finally:
+            request_profiles.reset(token)
+            for profiles in requested:
+                profiles.extend(summaries)
+
+    def _record(self, batch: list[_PendingItem[T, R]]) -> None:
+        waits = [pending.queue_wait_ms for pending in batch]
+
+        self.stats.batches += 1
+        self.stats.items += len(batch)
+        self.stats.size_histogram[len(batch)] += 1
+        self.stats.queue_wait_ms_total += sum(waits)
+        self.stats.queue_wait_ms_max = max(self.stats.queue_wait_ms_max, *waits)
+        batch_size_histogram.observe(len(batch), batcher=self.name)
+        for wait_ms in waits:
+            queue_wait_histogram.observe(wait_ms / 1000, batcher=self.name)
+
+        logger.debug(
+            'Dispatching batch',
+            batcher=self.name,
+            batch_size=len(batch),
+            queue_wait_ms=max(waits),
+            queue_depth=self.queue_depth,
+        )
+
+
+_batchers: list[MicroBatcher[Any, Any]] = []
+
+batch_size_histogram = Histogram(
+    'starlight_batch_size',
+    'Items per batched forward.',
+    ('batcher',),
+    BATCH_SIZE_BUCKETS,
+)
+queue_wait_histogram = Histogram(
+    'starlight_batch_queue_wait_seconds',
+    'Time items wait in a batch queue before their forward starts.',
+    ('batcher',),
+)
+
+
+def _queue_depths() -> list[MetricFamily]:
+    return [
+        MetricFamily(
+            'starlight_batch_queue_depth',
+            'gauge',
+            'Items waiting in a batch queue.',
+            [Sample({'batcher': batcher.name}, batcher.queue_depth) for batcher in _batchers],
+        ),
+    ]
+
+
+register_collector(_queue_depths)
+
+
+async def close_batchers() -> None:
+    await asyncio.gather(*(batcher.close() for batcher in _batchers))
@@ -0,0 +1,352 @@
+"""Benchmark the classification and embedding models on a synthetic image corpus.
+
+Runs every model over generated images at several resolutions and batch sizes, and
+prints throughput, latency percentiles and peak memory as JSON, so runs before and
+after a torch, transformers or dtype change can be diffed directly:
+
+    uv run python -m app.benchmark --output before.json
+
+With Camie selected, the report also has the share of tag decisions that the served
+tensor preprocessing changes relative to the PIL path the checkpoint was validated on.
+
+Models are loaded from the local Hugging Face cache with downloads disabled, and run on
+the CPU unless `--device` says otherwise. Nothing else leaves the machine.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Self
+
+import numpy as np
+import structlog
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator
+
+    from PIL.Image import Image as PILImage
+
+logger = structlog.get_logger()
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Resolution-independent text inputs, shaped like tag strings and search queries.
+_TEXTS = (
+    'hatsune miku, 1girl, solo, long hair, twintails, aqua hair, smile',
+    'landscape, mountains, sunrise, clouds, no humans, scenery',
+    'girl with an umbrella in the rain',
+    'cat sleeping on a windowsill',
+)
+
+MODELS = (
+    'nsfw',
+    'aesthetic',
+    'style',
+    'camie',
+    'camie-pil',
+    'classify',
+    'embedding-image',
+    'embedding-text',
+)
+_TEXT_MODELS = frozenset({'embedding-text'})
+
+
+@dataclass
+class BenchmarkResult:
+    model: str
+    resolution: int | None
+    batch_size: int
+    iterations: int
+    first_call_ms: float
+    throughput_per_second: float
+    latency_ms_p50: float
+    latency_ms_p99: float
+    latency_ms_mean: float
+    peak_rss_bytes: int
+    peak_device_memory_bytes: int | None
+
+
+def synthetic_images(resolution: int, count: int, seed: int = 0) -> list[PILImage]:
+    """Deterministic 4:3 images mixing noise, gradients and flat regions.
+
+    Noise defeats codec-like shortcuts and gradients exercise resizing, so the corpus
+    costs about as much to process as real photos of the same size.
+    """
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    width, height = resolution, resolution * 3 // 4
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    images: list[PILImage] = []
+    for _ in range(count):
+        noise = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        pixels = noise * 0.5 + gradient * 0.5
+        pixels[: height // 4] = rng.integers(0, 256, 3)
+        images.append(Image.fromarray(pixels.astype(np.uint8), 'RGB'))
+    return images
+
+
+class _PeakRss:
+    """Samples the resident set in the background to find the peak during a run."""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.peak = 0
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss())
+            self._stop.wait(self._interval)
+
+
+def _rss() -> int:
+    return int(Path('/proc/self/statm').read_bytes().split()[1]) * _PAGE_SIZE
+
+
+@contextmanager
+def _device_peak(device: str) -> Generator[dict[str, int | None]]:
+    import torch
+
+    peak: dict[str, int | None] = {'bytes': None}
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        yield peak
+    finally:
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            peak['bytes'] = torch.cuda.max_memory_allocated()
+
+
+def _runners(device: str) -> dict[str, Callable[[list[Any]], object]]:
+    from app.imgutils.camie import camie_inputs, get_camie_tags_batch, get_camie_tags_from_tensor
+    from app.models import EncodingMode
+    from app.preprocessing import DecodedBatch
+    from app.services import classification, embeddings
+
+    def classifier(model: Any) -> Callable[[list[PILImage]], object]:
+        # Preprocessing is shared between models in production, but counted per model
+        # here so each entry is a complete single-model call.
+        def run(images: list[PILImage]) -> object:
+            with model.use() as loaded:
+                return loaded(DecodedBatch.from_images(images, device))
+
+        return run
+
+    return {
+        'nsfw': classifier(classification.nsfw_model),
+        'aesthetic': classifier(classification.aesthetic_model),
+        'style': classifier(classification.style_model),
+        'camie': lambda images: get_camie_tags_from_tensor(
+            camie_inputs(DecodedBatch.from_images(images, device).pixels),
+        ),
+        'camie-pil': get_camie_tags_batch,
+        'classify': classification.classify_batch,
+        'embedding-image': lambda images: embeddings.encode(images, EncodingMode.DOCUMENT),
+        'embedding-text': lambda texts: embeddings.encode(texts, EncodingMode.QUERY),
+    }
+
+
+def run_benchmark(
+    name: str,
+    run: Callable[[list[Any]], object],
+    inputs: list[Any],
+    *,
+    resolution: int | None,
+    iterations: int,
+    warmup: int,
+    device: str,
+) -> BenchmarkResult:
+    # The first call also loads the model, so it's reported apart from the timed runs.
+    start = perf_counter()
+    run(inputs)
+    first_call_ms = (perf_counter() - start) * 1000
+    for _ in range(warmup):
+        run(inputs)
+
+    latencies: list[float] = []
+    with _PeakRss() as rss, _device_peak(device) as device_peak:
+        for _ in range(iterations):
+            start = perf_counter()
+            run(inputs)
+            latencies.append(perf_counter() - start)
+
+    latencies_ms = np.array(latencies) * 1000
+    return BenchmarkResult(
+        model=name,
+        resolution=resolution,
+        batch_size=len(inputs),
+        iterations=iterations,
+        first_call_ms=first_call_ms,
+        throughput_per_second=len(inputs) * iterations / sum(latencies),
+        latency_ms_p50=float(np.percentile(latencies_ms, 50)),
+        latency_ms_p99=float(np.percentile(latencies_ms, 99)),
+        latency_ms_mean=float(latencies_ms.mean()),
+        peak_rss_bytes=rss.peak,
+        peak_device_memory_bytes=device_peak['bytes'],
+    )
+
+
+def _camie_parity(resolutions: list[int]) -> dict[str, float]:
+    """`preprocessing_flip_rate` per resolution, keyed by resolution for JSON."""
+    from app.imgutils.camie import preprocessing_flip_rate
+
+    parity: dict[str, float] = {}
+    for resolution in resolutions:
+        parity[str(resolution)] = preprocessing_flip_rate(synthetic_images(resolution, 4, seed=1))
+        logger.info(
+            'Camie preprocessing parity',
+            resolution=resolution,
+            flip_rate=parity[str(resolution)],
+        )
+    return parity
+
+
+def _environment(device: str) -> dict[str, Any]:
+    import torch
+    import transformers
+
+    from app.config import config
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'torch': torch.__version__,
+        'torch_hip': torch.version.hip,
+        'transformers': transformers.__version__,
+        'device': device,
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'cpu_quantization': config.CPU_QUANTIZATION,
+        'camie_compile': config.CAMIE_COMPILE,
+    }
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(part) for part in value.split(',') if part]
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m app.benchmark',
+        description=__doc__.split('\n')[0],
+    )
+    parser.add_argument(
+        '--models',
+        type=lambda v: v.split(','),
+        default=list(MODELS),
+        help=f'Comma-separated subset of: {", ".join(MODELS)}',
+    )
+    parser.add_argument(
+        '--resolutions',
+        type=_int_list,
+        default=[256, 512, 1024, 2048],
+        help='Longer image side, comma-separated',
+    )
+    parser.add_argument('--batch-sizes', type=_int_list, default=[1, 4, 8], help='Comma-separated')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed runs after the first call')
+    parser.add_argument('--device', choices=['cpu', 'cuda', 'auto'], default='cpu')
+    parser.add_argument(
+        '--online',
+        action='store_true',
+        help='Allow downloading models that are not cached yet',
+    )
+    parser.add_argument('--output', type=Path, help='Write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    if unknown := set(args.models) - set(MODELS):
+        parser.error(f'Unknown models: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+
+    # Both are read once at import time by app.config and huggingface_hub.
+    os.environ['MODEL_DEVICE'] = args.device
+    if not args.online:
+        os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ.setdefault('API_TOKEN', 'benchmark')
+
+    from app.device import resolve_model_device
+    from app.logger import configure_logger
+
+    configure_logger()
+    device = resolve_model_device()
+    runners = _runners(device)
+
+    results: list[BenchmarkResult] = []
+    for name in args.models:
+        for batch_size in args.batch_sizes:
+            if name in _TEXT_MODELS:
+                texts = [_TEXTS[i % len(_TEXTS)] for i in range(batch_size)]
+                cases: list[tuple[int | None, list[Any]]] = [(None, texts)]
+            else:
+                cases = [(res, synthetic_images(res, batch_size)) for res in args.resolutions]
+
+            for resolution, inputs in cases:
+                result = run_benchmark(
+                    name,
+                    runners[name],
+                    inputs,
+                    resolution=resolution,
+                    iterations=args.iterations,
+                    warmup=args.warmup,
+                    device=device,
+                )
+                results.append(result)
+                # Logs go to stderr, leaving stdout to the report.
+                logger.info(
+                    'Benchmark finished',
+                    model=name,
+                    resolution=resolution,
+                    batch_size=batch_size,
+                    throughput_per_second=result.throughput_per_second,
+                    latency_ms_p50=result.latency_ms_p50,
+                    latency_ms_p99=result.latency_ms_p99,
+                )
+
+    report = {
+        'environment': _environment(device),
+        'parameters': {
+            'models': args.models,
+            'resolutions': args.resolutions,
+            'batch_sizes': args.batch_sizes,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+        },
+        'results': [asdict(result) for result in results],
+    }
+    if {'camie', 'camie-pil'} & set(args.models):
+        report['camie_preprocessing_flip_rate'] = _camie_parity(args.resolutions)
+    output = json.dumps(report, indent=2) + '\n'
+    if args.output:
+        args.output.write_text(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
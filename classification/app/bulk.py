@@ -0,0 +1,389 @@
+"""Classify an image library offline, with the same models as `/v1/classify`.
+
+Images come from a directory (walked recursively) or a manifest with one path per line,
+relative to the manifest. A thread pool reads and decodes images ahead of the model, so
+the next batch is ready by the time the current forward finishes:
+
+    uv run python -m app.bulk /mnt/images --output results.jsonl
+    uv run python -m app.bulk manifest.txt --format parquet --output results/
+
+Results are written as they are produced, and the output doubles as the checkpoint:
+rerunning the same command skips every image already in it. Images that fail are
+recorded with an error like the batch API's and not retried on resume. JSONL is appended to and
+flushed per batch. Parquet is written as a directory of part files, each renamed into
+place once complete, and needs the `parquet` dependency group; a part is written every
+`--rows-per-part` rows or `--part-seconds` seconds, whichever comes first, so at most
+that much work is redone after a crash.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Protocol
+
+import structlog
+from fastapi import HTTPException
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+    from concurrent.futures import Future
+
+    from PIL.Image import Image as PILImage
+
+    from app.models import ClassificationResult
+
+logger = structlog.get_logger()
+
+IMAGE_SUFFIXES = frozenset(
+    {'.avif', '.bmp', '.gif', '.heic', '.heif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'},
+)
+
+
+def iter_sources(source: Path) -> Iterator[tuple[str, Path]]:
+    """Yield `(key, path)` pairs in a stable order; the key identifies an image in results."""
+    if source.is_dir():
+        # Walked lazily and sorted per directory, so millions of files are neither
+        # listed up front nor visited in a different order on resume.
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                path = Path(root) / name
+                if path.suffix.lower() in IMAGE_SUFFIXES:
+                    yield path.relative_to(source).as_posix(), path
+        return
+
+    with source.open(encoding='utf-8') as manifest:
+        for line in manifest:
+            key = line.strip()
+            if key and not key.startswith('#'):
+                yield key, source.parent / key
+
+
+def read_image(path: Path) -> PILImage:
+    """Decode a local image with the same checks and reduced decode as the API."""
+    try:
+        return _decode_file(path)
+    except HTTPException:
+        raise
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f'Image not found: {path}') from e
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image data: {e}') from e
+
+
+def _decode_file(path: Path) -> PILImage:
+    from app.config import config
+    from app.utils import SIGNATURE_SIZE, check_image_signature, decode_image
+
+    with path.open('rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            raise HTTPException(status_code=400, detail='Invalid image data: empty file')
+        if size > config.IMAGE_MAX_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f'Image is too large: more than {config.IMAGE_MAX_BYTES} bytes',
+            )
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            check_image_signature(mapped[:SIGNATURE_SIZE])
+            return decode_image(mapped)
+
+
+def _result_row(key: str, result: ClassificationResult) -> dict[str, Any]:
+    return {'path': key, **result.model_dump(mode='json')}
+
+
+def _error_row(key: str, error: HTTPException) -> dict[str, Any]:
+    return {'path': key, 'error': {'status_code': error.status_code, 'detail': str(error.detail)}}
+
+
+class ResultWriter(Protocol):
+    def completed(self) -> set[str]: ...
+
+    def write(self, rows: list[dict[str, Any]]) -> None: ...
+
+    def close(self) -> None: ...
+
+
+class JsonlWriter:
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._file = None
+
+    def completed(self) -> set[str]:
+        if not self._path.exists():
+            return set()
+
+        keys: set[str] = set()
+        with self._path.open('rb+') as file:
+            end = 0
+            for line in file:
+                # A line without a newline was cut off by the interruption; it's
+                # truncated below and its image classified again.
+                if not line.endswith(b'\n'):
+                    break
+                keys.add(json.loads(line)['path'])
+                end += len(line)
+            file.truncate(end)
+        return keys
+
+    def write(self, rows: list[dict[str, Any]]) -> None:
+        if self._file is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self._path.open('a', encoding='utf-8')
+        self._file.writelines(json.dumps(row, ensure_ascii=False) + '\n' for row in rows)
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class ParquetWriter:
+    def __init__(self, directory: Path, rows_per_part: int, part_seconds: float) -> None:
+        try:
+            import pyarrow as pa
+        except ImportError as e:
+            raise SystemExit(
+                'Parquet output needs pyarrow: uv sync --group parquet',
+            ) from e
+
+        from app.models import NSFWScores, StyleScore
+
+        self._directory = directory
+        self._rows_per_part = rows_per_part
+        self._part_seconds = part_seconds
+        self._pending: list[dict[str, Any]] = []
+        self._last_flush = perf_counter()
+        self._schema = pa.schema(
+            [
+                ('path', pa.string()),
+                ('aesthetic', pa.float32()),
+                ('style', pa.struct([(name, pa.float32()) for name in StyleScore.model_fields])),
+                (
+                    'nsfw',
+                    pa.struct(
+                        [
+                            (
+                                'scores',
+                                pa.struct(
+                                    [(name, pa.float32()) for name in NSFWScores.model_fields],
+                                ),
+                            ),
+                            ('is_nsfw', pa.bool_()),
+                        ],
+                    ),
+                ),
+                ('characters', pa.list_(pa.string())),
+                ('tags', pa.list_(pa.string())),
+                ('error', pa.struct([('status_code', pa.int32()), ('detail', pa.string())])),
+            ],
+        )
+
+    def _parts(self) -> list[Path]:
+        return sorted(self._directory.glob('part-*.parquet'))
+
+    def completed(self) -> set[str]:
+        import pyarrow.parquet as pq
+
+        # Scratch files of a part that was being written when the run stopped.
+        for scratch in self._directory.glob('.part-*.parquet.tmp'):
+            scratch.unlink()
+
+        return {
+            key
+            for part in self._parts()
+            for key in pq.read_table(part, columns=['path']).column('path').to_pylist()
+        }
+
+    def write(self, rows: list[dict[str, Any]]) -> None:
+        self._pending.extend(rows)
+        while len(self._pending) >= self._rows_per_part:
+            self._flush(self._pending[: self._rows_per_part])
+            del self._pending[: self._rows_per_part]
+        # Slow runs still checkpoint regularly, at the cost of smaller parts.
+        if self._pending and perf_counter() - self._last_flush >= self._part_seconds:
+            self._flush(self._pending)
+            self._pending = []
+
+    def _flush(self, rows: list[dict[str, Any]]) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._directory.mkdir(parents=True, exist_ok=True)
+        parts = self._parts()
+        index = int(parts[-1].stem.removeprefix('part-')) + 1 if parts else 0
+        target = self._directory / f'part-{index:05}.parquet'
+        scratch = self._directory / f'.{target.name}.tmp'
+        pq.write_table(pa.Table.from_pylist(rows, schema=self._schema), scratch)
+        scratch.replace(target)
+        self._last_flush = perf_counter()
+
+    def close(self) -> None:
+        if self._pending:
+            self._flush(self._pending)
+            self._pending = []
+
+
+def _classify(keys: list[str], images: list[PILImage]) -> list[dict[str, Any]]:
+    from app.services.classification import classify_batch
+
+    try:
+        results = classify_batch(images)
+    except Exception as e:
+        if len(images) > 1:
+            # Retry one by one, so a single bad image doesn't fail its whole batch.
+            logger.exception('Batch classification failed, retrying images separately')
+            return [
+                row
+                for key, image in zip(keys, images, strict=True)
+                for row in _classify([key], [image])
+            ]
+        logger.exception('Model inference failed', path=keys[0], error=e)
+        return [_error_row(keys[0], HTTPException(500, f'Model inference failed: {e}'))]
+    return list(map(_result_row, keys, results, strict=True))
+
+
+def _prefetch(
+    pool: ThreadPoolExecutor,
+    sources: Iterable[tuple[str, Path]],
+    window: int,
+) -> Iterator[tuple[str, Future[PILImage]]]:
+    # At most `window` images are read or held decoded at once, in source order.
+    pending: deque[tuple[str, Future[PILImage]]] = deque()
+    for key, path in sources:
+        pending.append((key, pool.submit(read_image, path)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    yield from pending
+
+
+def run(
+    sources: Iterable[tuple[str, Path]],
+    writer: ResultWriter,
+    *,
+    batch_size: int,
+    decode_workers: int,
+    prefetch: int,
+) -> None:
+    done = writer.completed()
+    if done:
+        logger.info('Resuming from checkpoint', completed=len(done))
+
+    processed = failed = 0
+    start = perf_counter()
+    keys: list[str] = []
+    images: list[PILImage] = []
+    rows: list[dict[str, Any]] = []
+
+    def flush() -> None:
+        nonlocal processed, failed
+        if images:
+            rows.extend(_classify(keys, images))
+        writer.write(rows)
+        processed += len(rows)
+        failed += sum('error' in row for row in rows)
+        keys.clear()
+        images.clear()
+        rows.clear()
+
+    with ThreadPoolExecutor(decode_workers, thread_name_prefix='bulk-decode') as pool:
+        todo = ((key, path) for key, path in sources if key not in done)
+        for key, future in _prefetch(pool, todo, prefetch):
+            try:
+                image = future.result()
+            except HTTPException as e:
+                rows.append(_error_row(key, e))
+            else:
+                keys.append(key)
+                images.append(image)
+
+            if len(images) >= batch_size:
+                flush()
+                elapsed = perf_counter() - start
+                logger.info(
+                    'Bulk classification progress',
+                    processed=processed,
+                    failed=failed,
+                    images_per_second=processed / elapsed,
+                )
+        flush()
+
+    logger.info(
+        'Bulk classification finished',
+        processed=processed,
+        failed=failed,
+        skipped=len(done),
+        duration_s=perf_counter() - start,
+    )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m app.bulk',
+        description=__doc__.split('\n')[0],
+    )
+    parser.add_argument('source', type=Path, help='Image directory or manifest file')
+    parser.add_argument('--output', type=Path, required=True)
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--decode-workers', type=int, default=min(8, os.cpu_count() or 1))
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        help='Images decoded ahead of the model (default: 4 batches)',
+    )
+    parser.add_argument(
+        '--rows-per-part',
+        type=int,
+        default=10_000,
+        help='Parquet only: most rows in one part file',
+    )
+    parser.add_argument(
+        '--part-seconds',
+        type=float,
+        default=60.0,
+        help='Parquet only: write a part at least this often, however few rows it has',
+    )
+    args = parser.parse_args(argv)
+
+    if not args.source.exists():
+        parser.error(f'Source not found: {args.source}')
+    return args
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    # Required by app.config, but nothing here serves or checks API requests.
+    os.environ.setdefault('API_TOKEN', 'bulk')
+
+    from app.logger import configure_logger
+
+    configure_logger()
+    writer: ResultWriter = (
+        ParquetWriter(args.output, args.rows_per_part, args.part_seconds)
+        if args.format == 'parquet'
+        else JsonlWriter(args.output)
+    )
+    try:
+        run(
+            iter_sources(args.source),
+            writer,
+            batch_size=args.batch_size,
+            decode_workers=args.decode_workers,
+            prefetch=args.prefetch or args.batch_size * 4,
+        )
+    finally:
+        # Also on Ctrl-C, so every classified image is in the checkpoint.
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+"""Content-addressed cache for model outputs.
+
+Results are keyed by a digest of their input (decoded pixels or text) together with a
+fingerprint of everything else that affects the output: model IDs, thresholds and
+encoding options. Changing any of those yields new keys, so stale entries simply age
+out instead of needing invalidation.
+
+Two tiers are used: an in-process LRU bounded by total value size, and an optional
+SQLite file that survives restarts and is shared by every worker on the host.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from time import monotonic, time
+from typing import TYPE_CHECKING, Any, Final, Self
+
+import structlog
+
+from app.config import config
+from app.metrics import MetricFamily, Sample, register_collector
+
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
+
+logger = structlog.get_logger()
+
+# Evict down to this fraction of the budget so eviction doesn't run on every insert.
+_EVICTION_TARGET = 0.9
+_EVICTION_CHUNK = 256
+# Eviction only needs a rough recency order, so hits refresh `accessed_at` at most this
+# often; every refresh is a write that waits on the file lock shared by all workers.
+_ACCESS_REFRESH_SECONDS = 300
+# Pixels are hashed in strips of about this size, rather than copied out all at once.
+_DIGEST_STRIP_BYTES = 1024 * 1024
+
+
+def digest(*parts: str | bytes) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        hasher.update(part.encode() if isinstance(part, str) else part)
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+def image_digest(img: PILImage) -> str:
+    # Hash decoded pixels rather than the encoded file, so the same picture re-served
+    # with different metadata or from another URL still hits the cache.
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in (img.mode, f'{img.width}x{img.height}'):
+        hasher.update(part.encode())
+        hasher.update(b'\0')
+
+    # Pillow keeps no contiguous pixel buffer to hash in place, and `tobytes` would
+    # copy the whole image. Strips give the same digest with a bounded copy.
+    rows = max(1, _DIGEST_STRIP_BYTES // max(1, img.width * len(img.getbands())))
+    for top in range(0, img.height, rows):
+        hasher.update(img.crop((0, top, img.width, min(top + rows, img.height))).tobytes())
+    hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+@dataclass(frozen=True)
+class CacheNamespace:
+    name: str
+    fingerprint: str
+
+    @classmethod
+    def create(cls, name: str, *parts: str) -> Self:
+        return cls(name=name, fingerprint=digest(*parts)[:16])
+
+    def key(self, input_digest: str) -> str:
+        return f'{self.name}:{self.fingerprint}:{input_digest}'
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+
+class ObjectCache[K, V]:
+    """Bounded LRU of live Python objects with an optional time-to-live.
+
+    Unlike `ResultCache`, values are kept as-is rather than serialized, so a hit costs a
+    dict lookup. Only used from the event loop thread, hence no locking.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float | None = None) -> None:
+        self.name = name
+        self.stats = CacheStats()
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+        _object_caches.append(self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+
+        stored_at, value = entry
+        if self._ttl is not None and monotonic() - stored_at > self._ttl:
+            del self._entries[key]
+            self.stats.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        if self._max_entries <= 0:
+            return
+
+        self._entries[key] = (monotonic(), value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+class _MemoryTier:
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self._max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+
+            self._entries[key] = value
+            self._size += len(value)
+
+            while self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class _DiskTier:
+    def __init__(self, path: Path, max_bytes: int) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path,
+            timeout=5,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+            'size INTEGER NOT NULL, accessed_at REAL NOT NULL)',
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS results_accessed_at_idx ON results (accessed_at)',
+        )
+        self._size = self._total_size()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, accessed_at FROM results WHERE key = ?',
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, accessed_at = row
+            if (now := time()) - accessed_at > _ACCESS_REFRESH_SECONDS:
+                self._conn.execute(
+                    'UPDATE results SET accessed_at = ? WHERE key = ?',
+                    (now, key),
+                )
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            previous = self._conn.execute(
+                'SELECT size FROM results WHERE key = ?',
+                (key,),
+            ).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, size, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, value, len(value), time()),
+            )
+            self._size += len(value) - (previous[0] if previous else 0)
+
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _total_size(self) -> int:
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def _evict(self) -> None:
+        # Other workers write to the same file, so resync the real total first.
+        self._size = self._total_size()
+
+        target = self._max_bytes * _EVICTION_TARGET
+        while self._size > target:
+            rows = self._conn.execute(
+                'SELECT key, size FROM results ORDER BY accessed_at LIMIT ?',
+                (_EVICTION_CHUNK,),
+            ).fetchall()
+            if not rows:
+                break
+
+            # Rows are read in chunks but only deleted until the target is reached.
+            evicted: list[tuple[str]] = []
+            for key, size in rows:
+                if self._size <= target:
+                    break
+                evicted.append((key,))
+                self._size -= size
+            self._conn.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+
+class ResultCache:
+    def __init__(
+        self,
+        memory_max_bytes: int,
+        disk_path: Path | None = None,
+        disk_max_bytes: int = 0,
+    ) -> None:
+        self.stats: defaultdict[str, CacheStats] = defaultdict(CacheStats)
+        self._memory = _MemoryTier(memory_max_bytes) if memory_max_bytes > 0 else None
+        self._disk = _DiskTier(disk_path, disk_max_bytes) if disk_path else None
+
+    @property
+    def enabled(self) -> bool:
+        return self._memory is not None or self._disk is not None
+
+    @property
+    def memory_size(self) -> int:
+        return self._memory.size if self._memory else 0
+
+    async def get(self, namespace: CacheNamespace, input_digest: str) -> bytes | None:
+        key = namespace.key(input_digest)
+        stats = self.stats[namespace.name]
+
+        if self._memory and (value := self._memory.get(key)) is not None:
+            stats.hits += 1
+            return value
+
+        if self._disk and (value := await self._disk_get(key)) is not None:
+            stats.hits += 1
+            stats.disk_hits += 1
+            if self._memory:
+                self._memory.set(key, value)
+            return value
+
+        stats.misses += 1
+        return None
+
+    async def set(self, namespace: CacheNamespace, input_digest: str, value: bytes) -> None:
+        key = namespace.key(input_digest)
+
+        if self._memory:
+            self._memory.set(key, value)
+
+        if self._disk:
+            try:
+                await asyncio.to_thread(self._disk.set, key, value)
+            except sqlite3.Error:
+                # The disk tier is best effort; a locked or full file must not fail requests
+                logger.exception('Failed to write result cache entry')
+
+    def close(self) -> None:
+        if self._disk:
+            self._disk.close()
+
+    async def _disk_get(self, key: str) -> bytes | None:
+        assert self._disk is not None
+        try:
+            return await asyncio.to_thread(self._disk.get, key)
+        except sqlite3.Error:
+            logger.exception('Failed to read result cache entry')
+            return None
+
+
+result_cache: Final[ResultCache] = ResultCache(
+    memory_max_bytes=config.CACHE_MEMORY_MAX_MB * 1024 * 1024,
+    disk_path=Path(config.CACHE_DISK_PATH) if config.CACHE_DISK_PATH else None,
+    disk_max_bytes=config.CACHE_DISK_MAX_MB * 1024 * 1024,
+)
+
+
+_object_caches: list[ObjectCache[Any, Any]] = []
+
+
+def cache_stats() -> dict[str, dict[str, int]]:
+    stats = {name: asdict(counters) for name, counters in result_cache.stats.items()}
+    for cache in _object_caches:
+        stats[cache.name] = {**asdict(cache.stats), 'entries': len(cache)}
+    return stats
+
+
+_CACHE_COUNTERS = {
+    'hits': 'Cache lookups answered from the cache.',
+    'disk_hits': 'Cache hits served from the SQLite tier.',
+    'misses': 'Cache lookups that missed.',
+}
+
+
+def _cache_families() -> list[MetricFamily]:
+    stats = cache_stats()
+    families = [
+        MetricFamily(
+            f'starlight_cache_{counter}_total',
+            'counter',
+            help_text,
+            [Sample({'cache': name}, counters[counter]) for name, counters in stats.items()],
+        )
+        for counter, help_text in _CACHE_COUNTERS.items()
+    ]
+    families.append(
+        MetricFamily(
+            'starlight_cache_entries',
+            'gauge',
+            'Entries held by an in-memory object cache.',
+            [
+                Sample({'cache': name}, counters['entries'])
+                for name, counters in stats.items()
+                if 'entries' in counters
+            ],
+        ),
+    )
+    return families
+
+
+register_collector(_cache_families)
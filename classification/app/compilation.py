@@ -0,0 +1,167 @@
+"""Opt-in `torch.compile` execution for batch models.
+
+Each batch is padded up to a fixed bucket size, so the compiled module only ever sees
+a handful of static shapes and never recompiles at request time. Every bucket is
+compiled at load time, and the resulting kernels are saved as a portable cache
+artifact that later processes load before compiling, turning restarts into cache hits.
+Compiled outputs are checked against eager ones before the compiled module is used.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+import structlog
+import torch
+
+from app.config import config
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from torch import Tensor, nn
+
+logger = structlog.get_logger()
+
+
+def batch_buckets(max_batch_size: int) -> list[int]:
+    """Powers of two below `max_batch_size`, plus `max_batch_size` itself."""
+    buckets = [1]
+    while buckets[-1] * 2 < max_batch_size:
+        buckets.append(buckets[-1] * 2)
+    if max_batch_size > 1:
+        buckets.append(max_batch_size)
+    return buckets
+
+
+class CompiledBatchModel:
+    """Runs a compiled module on batches padded to the nearest bucket size.
+
+    Batches larger than the biggest bucket are split into bucket-sized chunks.
+    """
+
+    def __init__(self, compiled: Callable[[Tensor], Tensor], buckets: list[int]) -> None:
+        self._compiled = compiled
+        self._buckets = buckets
+
+    def __call__(self, inputs: Tensor) -> Tensor:
+        largest = self._buckets[-1]
+        if inputs.shape[0] > largest:
+            return torch.cat([self(chunk) for chunk in inputs.split(largest)])
+
+        batch_size = inputs.shape[0]
+        bucket = next(size for size in self._buckets if size >= batch_size)
+        if bucket > batch_size:
+            padding = inputs[-1:].expand(bucket - batch_size, *inputs.shape[1:])
+            inputs = torch.cat((inputs, padding))
+
+        return self._compiled(inputs)[:batch_size]
+
+
+def _cache_artifact_path(name: str, device: str, dtype: torch.dtype) -> Path | None:
+    if not config.COMPILE_CACHE_DIR:
+        return None
+
+    dtype_name = str(dtype).removeprefix('torch.')
+    torch_version = torch.__version__.replace('+', '-')
+    return Path(config.COMPILE_CACHE_DIR) / f'{name}-{device}-{dtype_name}-{torch_version}.bin'
+
+
+def _load_cache_artifacts(path: Path | None) -> None:
+    if path is None or not path.is_file():
+        return
+
+    try:
+        torch.compiler.load_cache_artifacts(path.read_bytes())
+    except Exception:
+        # A stale or corrupt artifact only costs a recompile.
+        logger.exception('Failed to load compile cache artifacts', path=str(path))
+    else:
+        logger.info('Loaded compile cache artifacts', path=str(path))
+
+
+def _save_cache_artifacts(path: Path | None) -> None:
+    if path is None or (artifacts := torch.compiler.save_cache_artifacts()) is None:
+        return
+
+    serialized, _ = artifacts
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename, so concurrent workers never read a partial artifact.
+    tmp_path = path.with_suffix(f'.{id(serialized)}.tmp')
+    tmp_path.write_bytes(serialized)
+    tmp_path.replace(path)
+    logger.info('Saved compile cache artifacts', path=str(path), size=len(serialized))
+
+
+def compile_batch_model(
+    model: nn.Module,
+    *,
+    name: str,
+    example_input: Tensor,
+    max_batch_size: int,
+    atol: float,
+    output_fn: Callable[[Tensor], Tensor] = torch.sigmoid,
+) -> Callable[[Tensor], Tensor]:
+    """Compile `model` for every bucket up to `max_batch_size`, or return it unchanged.
+
+    `example_input` is a single-item batch used to compile each bucket and to compare
+    `output_fn` of compiled and eager outputs. If compiling fails or any difference
+    exceeds `atol`, the eager model is returned and the failure is logged.
+    """
+    path = _cache_artifact_path(name, str(example_input.device), example_input.dtype)
+    _load_cache_artifacts(path)
+
+    buckets = batch_buckets(max_batch_size)
+    compiled = CompiledBatchModel(torch.compile(model, dynamic=False), buckets)
+
+    start = perf_counter()
+    try:
+        divergence = _first_divergence(model, compiled, buckets, example_input, output_fn, atol)
+    except Exception:
+        logger.exception('Failed to compile model, using eager', model=name)
+        return model
+
+    if divergence is not None:
+        bucket, max_diff = divergence
+        logger.error(
+            'Compiled model diverges from eager, using eager',
+            model=name,
+            batch_size=bucket,
+            max_diff=max_diff,
+            atol=atol,
+        )
+        return model
+
+    logger.info(
+        'Compiled model',
+        model=name,
+        buckets=buckets,
+        duration_ms=(perf_counter() - start) * 1000,
+    )
+    _save_cache_artifacts(path)
+    return compiled
+
+
+def _first_divergence(
+    model: nn.Module,
+    compiled: CompiledBatchModel,
+    buckets: list[int],
+    example_input: Tensor,
+    output_fn: Callable[[Tensor], Tensor],
+    atol: float,
+) -> tuple[int, float] | None:
+    """Compile each bucket by running it, and return the first one off by more than `atol`.
+
+    Returns the bucket's batch size and its largest difference from eager.
+    """
+    with torch.inference_mode():
+        expected = output_fn(model(example_input)).float()
+        for bucket in buckets:
+            inputs = example_input.expand(bucket, *example_input.shape[1:]).contiguous()
+            actual = output_fn(compiled(inputs)).float()
+            max_diff = (actual - expected).abs().max().item()
+            if max_diff > atol:
+                return bucket, max_diff
+    return None
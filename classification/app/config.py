@@ -11,6 +11,104 @@ class Config(BaseSettings):
     ENABLE_EMBEDDINGS: bool = False
     ENABLE_CLASSIFICATION: bool = False
     MODEL_DEVICE: Literal['auto', 'cpu', 'cuda'] = 'auto'
+    # Unix socket of a model host (`python -m app.model_host`). When set, HTTP workers
+    # load no models and forward every inference call to the host instead.
+    MODEL_HOST_SOCKET: str | None = None
+    # Calls to the model host fail with 504 after this long. It covers queueing and,
+    # for the first call, loading the model.
+    MODEL_HOST_TIMEOUT_SECONDS: float = 120.0
+
+    # Torch threads per worker process. Cores are shared equally between CPU_WORKERS
+    # processes (GRANIAN_WORKERS by default) unless CPU_THREADS is set. CPU_AFFINITY pins
+    # each worker to its own share of cores ('cores') or to a NUMA node ('numa').
+    CPU_WORKERS: int | None = None
+    CPU_THREADS: int | None = None
+    CPU_INTEROP_THREADS: int = 1
+    CPU_AFFINITY: Literal['none', 'cores', 'numa'] = 'none'
+
+    # Number of threads running model forwards in parallel per worker process.
+    INFERENCE_CONCURRENCY: int = 1
+    # Max inference calls queued or running per worker before returning 503.
+    INFERENCE_QUEUE_SIZE: int = 64
+    # Concurrent requests are grouped into one forward of up to BATCH_MAX_SIZE images,
+    # waiting at most BATCH_MAX_WAIT_MS for the batch to fill up.
+    BATCH_MAX_SIZE: int = 8
+    BATCH_MAX_WAIT_MS: float = 5.0
+    # Max images accepted by a single /v1/classify/batch request.
+    CLASSIFY_BATCH_MAX_IMAGES: int = 32
+
+    # Images are decoded at reduced resolution as long as their shorter side stays at
+    # least IMAGE_DECODE_MIN_SIZE (the largest model input), and rejected with 413 when
+    # the decoded image would still exceed IMAGE_MAX_PIXELS.
+    IMAGE_DECODE_MIN_SIZE: int = 512
+    IMAGE_MAX_PIXELS: int = 40_000_000
+    # Image downloads are streamed and aborted past IMAGE_MAX_BYTES or once they take
+    # longer than IMAGE_DOWNLOAD_TIMEOUT_SECONDS in total.
+    IMAGE_MAX_BYTES: int = 32 * 1024 * 1024
+    IMAGE_DOWNLOAD_TIMEOUT_SECONDS: float = 25.0
+    # Directory shared with co-located producers. When set, `file://<path>` images under
+    # it are memory-mapped instead of downloaded.
+    IMAGE_SHARED_VOLUME: str | None = None
+    # Keep-alive connection pool for image downloads. HTTP_POOL_CONNECTIONS is the
+    # number of hosts with pooled connections, HTTP_POOL_MAXSIZE the connections kept
+    # per host. Past HTTP_MAX_CONNECTIONS_PER_HOST concurrent downloads from one host,
+    # further downloads wait for a free connection instead of opening new ones.
+    HTTP_POOL_CONNECTIONS: int = 10
+    HTTP_POOL_MAXSIZE: int = 32
+    HTTP_MAX_CONNECTIONS_PER_HOST: int = 32
+    HTTP_KEEPALIVE_SECONDS: float = 600.0
+    HTTP_KEEPALIVE_IDLE_SECONDS: float = 60.0
+
+    # Content-addressed cache of classification results and embeddings. The memory tier
+    # is per worker; the optional SQLite file is shared by all workers on the host.
+    CACHE_MEMORY_MAX_MB: int = 256
+    CACHE_DISK_PATH: str | None = None
+    CACHE_DISK_MAX_MB: int = 2048
+    # In-process cache of text embeddings (tag strings and search queries). Entries
+    # never expire unless TEXT_CACHE_TTL_SECONDS is set.
+    TEXT_CACHE_MAX_ENTRIES: int = 10_000
+    TEXT_CACHE_TTL_SECONDS: float | None = None
+
+    # /v1/embeddings/query runs on its own thread pool. With 'cpu', a separate CPU copy
+    # of jina-clip-v2 serves queries so they don't share the accelerator with images.
+    QUERY_EMBEDDING_DEVICE: Literal['shared', 'cpu'] = 'shared'
+    QUERY_CONCURRENCY: int = 1
+    QUERY_BATCH_MAX_SIZE: int = 32
+    QUERY_BATCH_MAX_WAIT_MS: float = 2.0
+
+    # Run Camie through torch.compile, with one static graph per padded batch size and
+    # a parity check against eager at load time. Compiled kernels are saved under
+    # COMPILE_CACHE_DIR so restarts load them instead of recompiling.
+    CAMIE_COMPILE: bool = False
+    COMPILE_CACHE_DIR: str | None = None
+
+    # With 'int8', models running on the CPU get dynamically quantized linear layers. Each
+    # model is compared with FP32 on a reference set at load time and kept in FP32 if
+    # scores differ by more than QUANTIZATION_MAX_DRIFT, or if more than
+    # QUANTIZATION_MAX_FLIP_RATE of threshold decisions (is_nsfw, Camie tags) flip.
+    # QUANTIZATION_REFERENCE_DIR holds the reference images; without it, a small
+    # synthetic set is used.
+    CPU_QUANTIZATION: Literal['none', 'int8'] = 'none'
+    QUANTIZATION_MAX_DRIFT: float = 0.05
+    QUANTIZATION_MAX_FLIP_RATE: float = 0.02
+    QUANTIZATION_REFERENCE_DIR: str | None = None
+
+    # Run every enabled model at startup before /ready reports ok.
+    WARMUP: bool = True
+    # Models load on first use (or at warmup) and are released again after
+    # MODEL_IDLE_UNLOAD_SECONDS without requests, freeing their memory for other
+    # services. Unset keeps them loaded for the life of the process.
+    MODEL_IDLE_UNLOAD_SECONDS: float | None = None
+
+    # Inference requests to /v1 are profiled with torch.profiler when they send
+    # X-Profile-Token set to ADMIN_API_TOKEN, or at random with probability
+    # PROFILE_SAMPLE_RATE. Traces are saved under PROFILE_TRACE_DIR (a temporary directory
+    # by default), which keeps the newest PROFILE_MAX_TRACES, and their top operators
+    # are logged. One model call is profiled at a time.
+    ADMIN_API_TOKEN: str | None = None
+    PROFILE_SAMPLE_RATE: float = 0.0
+    PROFILE_TRACE_DIR: str | None = None
+    PROFILE_MAX_TRACES: int = 100
 
     LOG_LEVEL: str = 'DEBUG'
     DISABLE_OPENAPI: bool = False
@@ -1,5 +1,10 @@
+import fcntl
+import os
+import tempfile
+from dataclasses import dataclass, field
 from functools import cache
-from typing import Literal
+from pathlib import Path
+from typing import IO, Literal
 
 import structlog
 import torch
@@ -8,6 +13,142 @@ from app.config import config
 
 logger = structlog.get_logger()
 
+_NUMA_NODES_PATH = Path('/sys/devices/system/node')
+
+
+@dataclass(frozen=True)
+class CpuLayout:
+    worker: int
+    workers: int
+    cpus: list[int]
+    numa_node: int | None
+    intra_op_threads: int
+    inter_op_threads: int
+    # Marks the worker slot as taken. The layout is cached, so it stays open for the
+    # life of the process.
+    slot_lock: IO[bytes] | None = field(default=None, repr=False, compare=False)
+
+
+def _parse_cpulist(cpulist: str) -> list[int]:
+    cpus: list[int] = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _numa_nodes(available: list[int]) -> dict[int, list[int]]:
+    nodes: dict[int, list[int]] = {}
+    for node_dir in sorted(_NUMA_NODES_PATH.glob('node[0-9]*')):
+        cpus = _parse_cpulist((node_dir / 'cpulist').read_text())
+        if usable := [cpu for cpu in cpus if cpu in available]:
+            nodes[int(node_dir.name.removeprefix('node'))] = usable
+    return nodes or {0: available}
+
+
+def _claim_worker_slot(workers: int) -> tuple[int, IO[bytes] | None]:
+    """Claim the lowest free worker index on this host, with the lock that holds it.
+
+    Granian doesn't tell workers their index, so workers take turns locking slot
+    files instead. Locks are released when a process exits, so restarted workers
+    reclaim the slot of the one they replace.
+    """
+    slot_dir = Path(tempfile.gettempdir()) / 'classification-workers'
+    slot_dir.mkdir(exist_ok=True)
+    for slot in range(workers):
+        lock = (slot_dir / f'{slot}.lock').open('wb')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        return slot, lock
+
+    # More processes than configured workers; share slots rather than fail.
+    return os.getpid() % workers, None
+
+
+def _split(cpus: list[int], parts: int, index: int) -> list[int]:
+    size, extra = divmod(len(cpus), parts)
+    start = index * size + min(index, extra)
+    return cpus[start : start + size + (index < extra)] or cpus
+
+
+@cache
+def configure_cpu_execution() -> CpuLayout:
+    """Size torch's thread pools for this worker and optionally pin it to its cores.
+
+    Without a policy, every worker starts one intra-op thread per core and N workers
+    oversubscribe the host N times over. Each worker gets an equal share of the
+    available cores instead; with `CPU_AFFINITY`, that share is a fixed core set or
+    NUMA node, so caches stay warm and workers never migrate onto each other.
+    """
+    available = sorted(os.sched_getaffinity(0))
+    workers = max(1, config.CPU_WORKERS or int(os.environ.get('GRANIAN_WORKERS', '1')))
+    worker, slot_lock = _claim_worker_slot(workers) if workers > 1 else (0, None)
+
+    numa_node: int | None = None
+    match config.CPU_AFFINITY:
+        case 'cores':
+            cpus = _split(available, workers, worker)
+        case 'numa':
+            nodes = _numa_nodes(available)
+            numa_node = list(nodes)[worker % len(nodes)]
+            # Workers sharing a node split its cores between them.
+            node_workers = len(range(worker % len(nodes), workers, len(nodes)))
+            cpus = _split(nodes[numa_node], node_workers, worker // len(nodes))
+        case _:
+            cpus = available
+
+    if cpus != available:
+        # Threads inherit the mask, so pin before torch starts its thread pools.
+        os.sched_setaffinity(0, cpus)
+
+    share = len(cpus) if config.CPU_AFFINITY != 'none' else len(available) // workers
+    intra_op_threads = config.CPU_THREADS or max(1, share)
+    torch.set_num_threads(intra_op_threads)
+    # Only settable before any inter-op work has run.
+    try:
+        torch.set_interop_threads(config.CPU_INTEROP_THREADS)
+    except RuntimeError:
+        logger.warning('Inter-op threads were already initialized')
+
+    layout = CpuLayout(
+        worker=worker,
+        workers=workers,
+        cpus=cpus,
+        numa_node=numa_node,
+        intra_op_threads=torch.get_num_threads(),
+        inter_op_threads=torch.get_num_interop_threads(),
+        slot_lock=slot_lock,
+    )
+    logger.info(
+        'CPU execution layout',
+        worker=layout.worker,
+        workers=layout.workers,
+        affinity=config.CPU_AFFINITY,
+        cpus=_format_cpulist(layout.cpus),
+        numa_node=layout.numa_node,
+        intra_op_threads=layout.intra_op_threads,
+        inter_op_threads=layout.inter_op_threads,
+    )
+    return layout
+
+
+def _format_cpulist(cpus: list[int]) -> str:
+    ranges: list[str] = []
+    start = prev = cpus[0]
+    for cpu in [*cpus[1:], None]:
+        if cpu is not None and cpu == prev + 1:
+            prev = cpu
+            continue
+        ranges.append(str(start) if start == prev else f'{start}-{prev}')
+        if cpu is not None:
+            start = prev = cpu
+    return ','.join(ranges)
+
 
 @cache
 def resolve_model_device() -> Literal['cpu', 'cuda']:
@@ -27,4 +168,6 @@ def resolve_model_device() -> Literal['cpu', 'cuda']:
         torch.__version__,
         torch.version.hip,
     )
+    # Preprocessing and CPU query copies use torch threads on every device.
+    configure_cpu_execution()
     return device
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Final
+from urllib.parse import urlsplit
+
+from niquests import AsyncSession
+
+from app.config import config
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator
+
+
+def create_http_session() -> AsyncSession:
+    # Pools are kept per host; with keep-alive, a burst of downloads from the same
+    # bucket reuses warm TLS connections instead of handshaking per image.
+    return AsyncSession(
+        disable_http3=True,
+        pool_connections=config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=config.HTTP_POOL_MAXSIZE,
+        keepalive_delay=config.HTTP_KEEPALIVE_SECONDS,
+        keepalive_idle_window=config.HTTP_KEEPALIVE_IDLE_SECONDS,
+    )
+
+
+@dataclass
+class _HostSlots:
+    semaphore: asyncio.Semaphore
+    active: int = 0
+    waiting: int = 0
+
+
+@dataclass
+class DownloadStats:
+    downloads: int = 0
+    waited: int = 0
+    wait_ms_total: float = 0.0
+    wait_ms_max: float = 0.0
+
+
+class HostLimiter:
+    """Caps concurrent downloads per host.
+
+    Downloads beyond the limit wait for a slot instead of opening connections the
+    pool can't keep, so bursts are served by the same warm connections. Hosts are
+    forgotten once they have no active or waiting downloads, so arbitrary URLs can't
+    grow the table.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.stats = DownloadStats()
+        self._limit = limit
+        self._hosts: dict[str, _HostSlots] = {}
+
+    @asynccontextmanager
+    async def slot(self, url: str) -> AsyncGenerator[None]:
+        host = urlsplit(url).netloc
+        slots = self._hosts.get(host)
+        if slots is None:
+            slots = self._hosts[host] = _HostSlots(asyncio.Semaphore(self._limit))
+
+        start = perf_counter()
+        contended = slots.semaphore.locked()
+        slots.waiting += 1
+        try:
+            await slots.semaphore.acquire()
+        except BaseException:
+            slots.waiting -= 1
+            self._forget_if_unused(host, slots)
+            raise
+        slots.waiting -= 1
+        slots.active += 1
+        self._record(perf_counter() - start, contended=contended)
+
+        try:
+            yield
+        finally:
+            slots.active -= 1
+            slots.semaphore.release()
+            self._forget_if_unused(host, slots)
+
+    def pool_stats(self) -> dict[str, Any]:
+        return {
+            **asdict(self.stats),
+            'hosts': {
+                host: {
+                    'active': slots.active,
+                    'waiting': slots.waiting,
+                    'idle': self._limit - slots.active,
+                }
+                for host, slots in self._hosts.items()
+            },
+        }
+
+    def _record(self, wait: float, *, contended: bool) -> None:
+        wait_ms = wait * 1000
+        self.stats.downloads += 1
+        if contended:
+            self.stats.waited += 1
+        self.stats.wait_ms_total += wait_ms
+        self.stats.wait_ms_max = max(self.stats.wait_ms_max, wait_ms)
+
+    def _forget_if_unused(self, host: str, slots: _HostSlots) -> None:
+        if slots.active == 0 and slots.waiting == 0 and self._hosts.get(host) is slots:
+            del self._hosts[host]
+
+
+host_limiter: Final[HostLimiter] = HostLimiter(config.HTTP_MAX_CONNECTIONS_PER_HOST)
@@ -11,30 +11,51 @@ Notes:
 
 from __future__ import annotations
 
-import copy
 import json
 import os
 import pathlib
 from collections import defaultdict
-from operator import itemgetter
-from typing import TYPE_CHECKING, Any, BinaryIO
+from collections.abc import Callable, Mapping
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, BinaryIO
 
+import numpy as np
 import torch
 from huggingface_hub import hf_hub_download
 from PIL import Image
 from safetensors.torch import load_file
 
+from app.compilation import compile_batch_model
+from app.config import config
 from app.device import resolve_model_device
 from app.imgutils.camie_model import ImageTagger
+from app.imgutils.camie_tags import TagTable, load_tag_table
 from app.imgutils.utils import ts_lru_cache
+from app.preprocessing import DecodedBatch, device_stage, letterbox, record_device_stages
+from app.quantization import (
+    accept_quantized,
+    flip_rate,
+    quantization_enabled,
+    quantize_linear_layers,
+    reference_images,
+)
+from app.registry import ManagedModel
 
 if TYPE_CHECKING:
-    from collections.abc import Mapping
+    from collections.abc import Sequence
 
 ImageTyping = str | os.PathLike[str] | bytes | bytearray | BinaryIO | Image.Image
 
 _REPO_ID = 'Camais03/camie-tagger-v2'
 
+DEFAULT_GENERAL_THRESHOLD = 0.5
+DEFAULT_CHARACTER_THRESHOLD = 0.8
+DEFAULT_TOP_K = 50
+
+_MEAN = (0.485, 0.456, 0.406)
+_STD = (0.229, 0.224, 0.225)
+_PAD_COLOR = (124, 116, 104)
+
 
 @ts_lru_cache()
 def _get_overlap_tags() -> Mapping[str, list[str]]:
@@ -48,41 +69,44 @@ def _get_overlap_tags() -> Mapping[str, list[str]]:
 
 
 @ts_lru_cache()
-def _get_metadata_file() -> Mapping[str, Any]:
+def _get_metadata() -> TagTable:
     json_file = hf_hub_download(_REPO_ID, 'camie-tagger-v2-metadata.json', repo_type='model')
-    with pathlib.Path(json_file).open('rb') as f:
-        return json.load(f)
+    return load_tag_table(json_file)
 
 
 def drop_overlap_tags(
     tags: list[str] | Mapping[str, float],
 ) -> list[str] | Mapping[str, float]:
+    """Drop tags implied by a more specific tag in the same list.
+
+    Works on arbitrary tag strings. Camie output goes through the precompiled
+    `_drop_overlap_tag_ids` instead, which avoids the per-call string scans.
+    """
     overlap_tags_dict = _get_overlap_tags()
     result_tags: list[str] = []
-    origin_tags = copy.deepcopy(tags)
-    if isinstance(tags, dict):
-        tags = list(tags.keys())
-    tags_underscore = [tag.replace(' ', '_') for tag in tags]
+    tag_names = list(tags.keys()) if isinstance(tags, Mapping) else tags
+    tags_underscore = [tag.replace(' ', '_') for tag in tag_names]
+    tags_underscore_set = set(tags_underscore)
 
-    for tag, tag_ in zip(tags, tags_underscore, strict=False):
+    for tag, tag_ in zip(tag_names, tags_underscore, strict=True):
         to_remove = False
-        if tag_ in overlap_tags_dict:
-            overlap_values = set(overlap_tags_dict[tag_])
-            if overlap_values.intersection(set(tags_underscore)):
-                to_remove = True
-        for tag_another in tags:
+        if tag_ in overlap_tags_dict and not tags_underscore_set.isdisjoint(
+            overlap_tags_dict[tag_],
+        ):
+            to_remove = True
+        for tag_another in tag_names:
             if tag in tag_another and tag != tag_another:
                 to_remove = True
                 break
         if not to_remove:
             result_tags.append(tag)
 
-    if isinstance(origin_tags, list):
+    if isinstance(tags, list):
         return result_tags
-    if isinstance(origin_tags, dict):
+    if isinstance(tags, Mapping):
         result_tags_set = set(result_tags)
-        return {key: value for key, value in origin_tags.items() if key in result_tags_set}
-    raise TypeError(f'Unknown tags type - {origin_tags!r}.')  # pragma: no cover
+        return {key: value for key, value in tags.items() if key in result_tags_set}
+    raise TypeError(f'Unknown tags type - {tags!r}.')  # pragma: no cover
 
 
 _KAOMOJIS = [
@@ -118,12 +142,11 @@ def underline(tag: str) -> str:
     return tag.replace(' ', '_') if tag not in _KAOMOJIS else tag
 
 
-@ts_lru_cache()
-def _get_camie_model() -> ImageTagger:
-    metadata = _get_metadata_file()
-    model_info = metadata['model_info']
+def _load_camie_model() -> ImageTagger:
+    metadata = _get_metadata()
+    model_info = metadata.model_info
     model = ImageTagger(
-        total_tags=metadata['dataset_info']['total_tags'],
+        total_tags=len(metadata),
         model_name=model_info['backbone'],
         num_heads=model_info['num_attention_heads'],
         tag_context_size=model_info['tag_context_size'],
@@ -139,15 +162,31 @@ def _get_camie_model() -> ImageTagger:
         ),
         strict=True,
     )
-    device = resolve_model_device()
     # Camie uses FP16 rather than BF16 because its top-k candidate selection and
     # thresholded tag scores benefit from FP16's additional mantissa precision
-    # (10 fraction bits versus BF16's 7). The checkpoint was verified against the
-    # previous ONNX output without threshold disagreements, and its activation range
-    # is safe in FP16, so BF16's wider exponent range provides no practical benefit.
+    # (10 fraction bits versus BF16's 7). On `preprocess_image` inputs the checkpoint
+    # was verified against the previous ONNX output without threshold disagreements,
+    # and its activation range is safe in FP16, so BF16's wider exponent range provides
+    # no practical benefit. Serving preprocesses with `camie_inputs` instead, whose
+    # effect on tag decisions `preprocessing_flip_rate` measures.
     # FP16 still halves model memory and runs through native ROCm kernels on the GPU.
-    dtype = torch.float16 if device == 'cuda' else torch.float32
-    return model.to(device=device, dtype=dtype).eval()
+    model = model.to(device=resolve_model_device(), dtype=_model_dtype()).eval()
+    return _quantize(model) if quantization_enabled(resolve_model_device()) else model
+
+
+def _quantize(model: ImageTagger) -> ImageTagger:
+    inputs = camie_inputs(DecodedBatch.from_images(reference_images(), 'cpu').pixels)
+    quantized = quantize_linear_layers(model)
+    with torch.inference_mode():
+        expected = torch.sigmoid(model(inputs)).float()
+        actual = torch.sigmoid(quantized(inputs)).float()
+
+    # Int8 error can also reorder the top-k candidates that get cross-attention, so
+    # check the tag decisions themselves, not just the scores.
+    thresholds = _get_threshold_vector(DEFAULT_GENERAL_THRESHOLD, DEFAULT_CHARACTER_THRESHOLD)
+    flips = flip_rate(expected >= thresholds, actual >= thresholds)
+    max_diff = (actual - expected).abs().max().item()
+    return quantized if accept_quantized(_REPO_ID, max_diff=max_diff, flips=flips) else model
 
 
 def _load_image(img: ImageTyping) -> Image.Image:
@@ -165,15 +204,18 @@ def _load_image(img: ImageTyping) -> Image.Image:
 
 
 def preprocess_image(pil_img: Image.Image, image_size: int = 512) -> torch.Tensor:
+    """Letterbox one image on the CPU with PIL's Lanczos resize.
+
+    The preprocessing the checkpoint was validated with. Requests go through
+    `camie_inputs`; this path remains as the reference for `preprocessing_flip_rate`
+    and the `camie-pil` benchmark.
+    """
     from torchvision import transforms
 
     transform = transforms.Compose(
         [
             transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.485, 0.456, 0.406],
-                std=[0.229, 0.224, 0.225],
-            ),
+            transforms.Normalize(mean=_MEAN, std=_STD),
         ],
     )
 
@@ -190,8 +232,7 @@ def preprocess_image(pil_img: Image.Image, image_size: int = 512) -> torch.Tenso
         new_width = int(new_height * aspect_ratio)
 
     pil_img = pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    pad_color = (124, 116, 104)
-    new_image = Image.new('RGB', (image_size, image_size), pad_color)
+    new_image = Image.new('RGB', (image_size, image_size), _PAD_COLOR)
     paste_x = (image_size - new_width) // 2
     paste_y = (image_size - new_height) // 2
     new_image.paste(pil_img, (paste_x, paste_y))
@@ -202,9 +243,9 @@ def preprocess_image(pil_img: Image.Image, image_size: int = 512) -> torch.Tenso
 def get_camie_tags(
     img: ImageTyping,
     *,
-    general_threshold: float = 0.5,
-    character_threshold: float = 0.8,
-    top_k: int = 50,
+    general_threshold: float = DEFAULT_GENERAL_THRESHOLD,
+    character_threshold: float = DEFAULT_CHARACTER_THRESHOLD,
+    top_k: int = DEFAULT_TOP_K,
     apply_drop_overlap: bool = True,
     use_underline: bool = False,
 ) -> dict[str, list[tuple[str, float]]]:
@@ -222,59 +263,331 @@ def get_camie_tags(
     Returns:
         Dictionary mapping category -> list of (tag, probability) pairs.
     """
-    metadata = _get_metadata_file()
-    dataset_info = metadata['dataset_info']
-    tag_mapping = dataset_info['tag_mapping']
-    idx_to_tag: dict[str, str] = tag_mapping['idx_to_tag']
-    tag_to_category: dict[str, str] = tag_mapping['tag_to_category']
+    return get_camie_tags_batch(
+        [img],
+        general_threshold=general_threshold,
+        character_threshold=character_threshold,
+        top_k=top_k,
+        apply_drop_overlap=apply_drop_overlap,
+        use_underline=use_underline,
+    )[0]
+
+
+def get_camie_tags_batch(
+    imgs: Sequence[ImageTyping],
+    *,
+    general_threshold: float = DEFAULT_GENERAL_THRESHOLD,
+    character_threshold: float = DEFAULT_CHARACTER_THRESHOLD,
+    top_k: int = DEFAULT_TOP_K,
+    apply_drop_overlap: bool = True,
+    use_underline: bool = False,
+) -> list[dict[str, list[tuple[str, float]]]]:
+    """Generate tags for several images with a single batched forward pass.
+
+    Accepts the same options as `get_camie_tags` and returns one mapping per input
+    image, in input order. Images are preprocessed with `preprocess_image`, not the
+    `camie_inputs` path requests use; kept for the `camie-pil` benchmark.
+    """
+    image_size = _get_metadata().model_info['img_size']
+    img_tensor = torch.stack(
+        [preprocess_image(_load_image(img), image_size=image_size) for img in imgs],
+    )
+    return get_camie_tags_from_tensor(
+        img_tensor.to(device=resolve_model_device(), dtype=_model_dtype()),
+        general_threshold=general_threshold,
+        character_threshold=character_threshold,
+        top_k=top_k,
+        apply_drop_overlap=apply_drop_overlap,
+        use_underline=use_underline,
+    )
+
 
-    model = _get_camie_model()
+def camie_inputs(pixels: list[torch.Tensor]) -> torch.Tensor:
+    """Build model inputs from uint8 CHW tensors already on the model device.
 
-    pil_img = _load_image(img)
-    img_tensor = preprocess_image(pil_img, image_size=metadata['model_info']['img_size'])
+    Tensor counterpart of `preprocess_image`, letterboxing the whole batch on the
+    device. Resizing is bicubic since tensors have no Lanczos kernel.
+    """
+    with device_stage(_REPO_ID, 'preprocess', resolve_model_device()):
+        return letterbox(
+            pixels,
+            size=_get_metadata().model_info['img_size'],
+            pad_color=_PAD_COLOR,
+            mean=_MEAN,
+            std=_STD,
+            dtype=_model_dtype(),
+        )
+
+
+def preprocessing_flip_rate(images: Sequence[Image.Image]) -> float:
+    """Share of tag decisions that `camie_inputs` changes relative to `preprocess_image`.
+
+    The tensor path resizes bicubic with antialiasing, since tensors have no Lanczos
+    kernel, so the model sees slightly different pixels than it was validated on.
+    Decisions are taken at the default thresholds, counted as in the int8 check.
+    """
     device = resolve_model_device()
+    image_size = _get_metadata().model_info['img_size']
+    reference = torch.stack(
+        [preprocess_image(img.convert('RGB'), image_size=image_size) for img in images],
+    ).to(device=device, dtype=_model_dtype())
+    served = camie_inputs(DecodedBatch.from_images(list(images), device).pixels)
+    thresholds = _get_threshold_vector(DEFAULT_GENERAL_THRESHOLD, DEFAULT_CHARACTER_THRESHOLD)
+
+    with camie_model.use() as camie, torch.inference_mode():
+        expected = torch.sigmoid(camie.run(reference)).float() >= thresholds
+        actual = torch.sigmoid(camie.run(served)).float() >= thresholds
+    record_device_stages()
+    return flip_rate(expected, actual)
+
+
+def get_camie_tags_from_tensor(
+    inputs: torch.Tensor,
+    *,
+    general_threshold: float = DEFAULT_GENERAL_THRESHOLD,
+    character_threshold: float = DEFAULT_CHARACTER_THRESHOLD,
+    top_k: int = DEFAULT_TOP_K,
+    apply_drop_overlap: bool = True,
+    use_underline: bool = False,
+) -> list[dict[str, list[tuple[str, float]]]]:
+    """Generate tags for a preprocessed batch on the model device, e.g. from `camie_inputs`."""
+    with (
+        camie_model.use() as camie,
+        torch.inference_mode(),
+        device_stage(_REPO_ID, 'forward', inputs.device),
+    ):
+        probs = torch.sigmoid(camie.run(inputs)).float()
+
+    with device_stage(_REPO_ID, 'postprocess', inputs.device):
+        with torch.inference_mode():
+            candidates = _select_candidates(
+                probs,
+                general_threshold=general_threshold,
+                character_threshold=character_threshold,
+                top_k=top_k,
+            )
+
+        tags = [
+            _postprocess_tags(
+                image_candidates,
+                apply_drop_overlap=apply_drop_overlap,
+                use_underline=use_underline,
+            )
+            for image_candidates in candidates
+        ]
+    # Candidates were copied to the host, so the preprocess and forward events of
+    # this batch have completed as well.
+    record_device_stages()
+    return tags
+
+
+@dataclass(frozen=True)
+class _CamieModel:
+    module: ImageTagger
+    # The module itself, or its compiled form with `CAMIE_COMPILE`.
+    run: Callable[[torch.Tensor], torch.Tensor]
+
+
+def _load_camie() -> _CamieModel:
+    model = _load_camie_model()
+    if not config.CAMIE_COMPILE:
+        return _CamieModel(model, model)
+
+    image_size = _get_metadata().model_info['img_size']
+    # Fixed noise keeps the parity check reproducible across restarts.
+    generator = torch.Generator().manual_seed(0)
+    example_input = torch.randn(1, 3, image_size, image_size, generator=generator)
+    dtype = _model_dtype()
+    runner = compile_batch_model(
+        model,
+        name='camie',
+        example_input=example_input.to(device=resolve_model_device(), dtype=dtype),
+        max_batch_size=config.BATCH_MAX_SIZE,
+        # Kernel fusion reorders FP16 reductions, so allow for its rounding error.
+        atol=1e-2 if dtype == torch.float16 else 1e-4,
+    )
+    return _CamieModel(model, runner)
+
+
+camie_model = ManagedModel(_REPO_ID, _load_camie, lambda camie: [camie.module])
+
+
+def _model_dtype() -> torch.dtype:
     # Inputs must match the cached model dtype; probabilities are converted back to
-    # FP32 below before CPU-side sorting, thresholding, and serialization.
-    dtype = torch.float16 if device == 'cuda' else torch.float32
-    inputs = img_tensor.unsqueeze(0).to(device=device, dtype=dtype)
-    with torch.inference_mode():
-        probs = torch.sigmoid(model(inputs))[0].float().cpu().tolist()
+    # FP32 before thresholding, ranking, and serialization.
+    return torch.float16 if resolve_model_device() == 'cuda' else torch.float32
 
-    wanted_categories = {'general', 'character'}
-    thresholds = {
-        'general': general_threshold,
-        'character': character_threshold,
-    }
 
-    tags_by_category: dict[str, list[tuple[str, float]]] = defaultdict(list)
+# Only these categories are returned; codes index `_CATEGORIES`, -1 marks the rest.
+_CATEGORIES = ('general', 'character')
+_SKIPPED_CATEGORY = -1
 
-    for idx, prob in enumerate(probs):
-        idx_str = str(idx)
-        tag_name = idx_to_tag.get(idx_str)
-        if not tag_name:
-            continue
-        category = tag_to_category.get(tag_name, 'general')
-        if category not in wanted_categories:
-            continue
-        threshold = thresholds[category]
-        if prob < threshold:
-            continue
-        tags_by_category[category].append((tag_name, prob))
 
-    for category in list(tags_by_category.keys()):
-        tags_by_category[category].sort(key=itemgetter(1), reverse=True)
-        if top_k > 0:
-            tags_by_category[category] = tags_by_category[category][:top_k]
+@ts_lru_cache()
+def _get_tag_table() -> tuple[TagTable, torch.Tensor]:
+    """Tag names and their `_CATEGORIES` codes, index-aligned with the model output.
 
-    if apply_drop_overlap:
-        for category, pairs in list(tags_by_category.items()):
-            mapping = dict(pairs)
-            filtered_mapping = drop_overlap_tags(mapping)  # type: ignore[arg-type]
-            filtered_pairs = sorted(filtered_mapping.items(), key=itemgetter(1), reverse=True)
-            tags_by_category[category] = filtered_pairs
+    Indices without a tag name or outside the wanted categories get
+    `_SKIPPED_CATEGORY`, so they can never pass thresholding.
+    """
+    table = _get_metadata()
+    # The trailing entry is what NO_CATEGORY (-1) indexes.
+    remap = np.array(
+        [
+            *(
+                _CATEGORIES.index(c) if c in _CATEGORIES else _SKIPPED_CATEGORY
+                for c in table.categories
+            ),
+            _SKIPPED_CATEGORY,
+        ],
+        dtype=np.int8,
+    )
+    category_codes = torch.from_numpy(remap[table.category_codes])
+    return table, category_codes.to(device=resolve_model_device())
 
+
+@ts_lru_cache()
+def _get_threshold_vector(general_threshold: float, character_threshold: float) -> torch.Tensor:
+    _, category_codes = _get_tag_table()
+    # Skipped indices get an unreachable threshold instead of a separate mask.
+    category_thresholds = torch.tensor(
+        [general_threshold, character_threshold, float('inf')],
+        dtype=torch.float32,
+        device=category_codes.device,
+    )
+    return category_thresholds[category_codes.long()]
+
+
+def _select_candidates(
+    probs: torch.Tensor,
+    *,
+    general_threshold: float,
+    character_threshold: float,
+    top_k: int,
+) -> list[dict[str, list[tuple[int, float]]]]:
+    """Threshold and rank every image's probabilities on the model device.
+
+    Only the surviving (at most `top_k` per category) indices are copied back to the
+    host and turned into Python objects.
+    """
+    _, category_codes = _get_tag_table()
+    passed = probs >= _get_threshold_vector(general_threshold, character_threshold)
+
+    candidates: list[dict[str, list[tuple[int, float]]]] = [{} for _ in range(probs.shape[0])]
+    for code, category in enumerate(_CATEGORIES):
+        mask = passed & (category_codes == code)
+        k = top_k if top_k > 0 else int(mask.sum(dim=1).max())
+        k = min(k, probs.shape[1])
+        if k == 0:
+            continue
+
+        # Probabilities are in [0, 1], so -1 sorts every rejected index last.
+        scores, indices = probs.masked_fill(~mask, -1).topk(k, dim=1, sorted=True)
+        for image_candidates, image_scores, image_indices in zip(
+            candidates,
+            scores.cpu().tolist(),
+            indices.cpu().tolist(),
+            strict=True,
+        ):
+            pairs = [
+                (idx, score)
+                for score, idx in zip(image_scores, image_indices, strict=True)
+                if score >= 0
+            ]
+            if pairs:
+                image_candidates[category] = pairs
+
+    return candidates
+
+
+def _postprocess_tags(
+    candidates: dict[str, list[tuple[int, float]]],
+    *,
+    apply_drop_overlap: bool,
+    use_underline: bool,
+) -> dict[str, list[tuple[str, float]]]:
+    names, _ = _get_tag_table()
     formatter = underline if use_underline else remove_underline
-    for category, pairs in list(tags_by_category.items()):
-        tags_by_category[category] = [(formatter(name), score) for name, score in pairs]
 
-    return dict(tags_by_category)
+    tags_by_category: dict[str, list[tuple[str, float]]] = {}
+    for category, pairs in candidates.items():
+        kept = _drop_overlap_tag_ids([idx for idx, _ in pairs]) if apply_drop_overlap else None
+        tags_by_category[category] = [
+            (formatter(names[idx]), score) for idx, score in pairs if kept is None or idx in kept
+        ]
+
+    return tags_by_category
+
+
+# Substring candidates are found through the n-grams two tags share.
+_NGRAM = 3
+
+
+@ts_lru_cache()
+def _get_overlap_index() -> tuple[np.ndarray, np.ndarray]:
+    """For every tag ID, the IDs whose presence makes that tag redundant.
+
+    Compiles both rules of `drop_overlap_tags` over the Camie vocabulary once: the
+    `overlap_tags_simplified.json` relation, and "is a substring of another tag". Only
+    tags that can be returned (general and character) are indexed, since overlap
+    removal never sees anything else. The result is in CSR form: the IDs dominating
+    `idx` are `indices[indptr[idx]:indptr[idx + 1]]`.
+    """
+    names, category_codes = _get_tag_table()
+    returned_ids = [
+        idx for idx, code in enumerate(category_codes.tolist()) if code != _SKIPPED_CATEGORY
+    ]
+    tag_names = {idx: names[idx] for idx in returned_ids}
+    underscore_to_id = {name.replace(' ', '_'): idx for idx, name in tag_names.items()}
+
+    dominated_by: dict[int, set[int]] = {}
+
+    overlap_tags = _get_overlap_tags()
+    for idx, name in tag_names.items():
+        overlaps = overlap_tags.get(name.replace(' ', '_'), ())
+        overlap_ids = {underscore_to_id[tag] for tag in overlaps if tag in underscore_to_id}
+        if overlap_ids:
+            dominated_by.setdefault(idx, set()).update(overlap_ids)
+
+    # A tag is a substring of another only if the other has each of its n-grams, so the
+    # posting list of its rarest n-gram holds every candidate, checked directly. That is
+    # one list entry per distinct n-gram of a tag, rather than a string per suffix.
+    postings: defaultdict[str, list[int]] = defaultdict(list)
+    for idx, name in tag_names.items():
+        for gram in _ngrams(name):
+            postings[gram].append(idx)
+
+    for idx, name in tag_names.items():
+        grams = _ngrams(name)
+        # Tags shorter than an n-gram are few, and compared against everything.
+        candidates = min((postings[gram] for gram in grams), key=len) if grams else tag_names
+        containing = {
+            other for other in candidates if name in tag_names[other] and name != tag_names[other]
+        }
+        if containing:
+            dominated_by.setdefault(idx, set()).update(containing)
+
+    indptr = np.zeros(len(names) + 1, dtype=np.int32)
+    for idx, dominating in dominated_by.items():
+        indptr[idx + 1] = len(dominating)
+    np.cumsum(indptr, out=indptr)
+    indices = np.fromiter(
+        (other for idx in sorted(dominated_by) for other in sorted(dominated_by[idx])),
+        dtype=np.int32,
+        count=int(indptr[-1]),
+    )
+    return indptr, indices
+
+
+def _ngrams(name: str) -> set[str]:
+    return {name[start : start + _NGRAM] for start in range(len(name) - _NGRAM + 1)}
+
+
+def _drop_overlap_tag_ids(tag_ids: list[int]) -> set[int]:
+    indptr, indices = _get_overlap_index()
+    present = set(tag_ids)
+    return {
+        idx
+        for idx in tag_ids
+        if present.isdisjoint(indices[indptr[idx] : indptr[idx + 1]].tolist())
+    }
@@ -0,0 +1,128 @@
+"""
+Overview:
+    Compact, memory-mapped form of the Camie tagger metadata.
+
+Notes:
+    - The metadata JSON maps ~70k tag indices to names and categories through
+      string-keyed dicts. Parsing it takes seconds and the resulting objects cost every
+      worker tens of MB.
+    - It is converted once into flat arrays stored next to the downloaded file: a UTF-8
+      blob of tag names with their offsets, and an int8 category code per tag.
+    - Workers memory-map the arrays, so they share the same pages through the OS page
+      cache, and looking up a tag is array indexing.
+"""
+
+from __future__ import annotations
+
+import json
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import structlog
+
+logger = structlog.get_logger()
+
+# Bump when the layout changes, so existing conversions are rebuilt rather than misread.
+_FORMAT_VERSION = 1
+
+# Category code of indices without a tag name.
+NO_CATEGORY = -1
+
+_ARRAYS = ('category_codes', 'names_blob', 'names_offsets')
+
+
+@dataclass(frozen=True)
+class TagTable:
+    model_info: dict[str, Any]
+    categories: tuple[str, ...]
+    # One code per tag index, indexing `categories`, or NO_CATEGORY.
+    category_codes: np.ndarray
+    names_blob: np.ndarray
+    names_offsets: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.category_codes)
+
+    def __getitem__(self, idx: int) -> str:
+        start, end = self.names_offsets[idx], self.names_offsets[idx + 1]
+        return self.names_blob[start:end].tobytes().decode()
+
+
+def load_tag_table(metadata_file: str | Path) -> TagTable:
+    """Open the converted form of `metadata_file`, converting it on first use."""
+    # Resolving the hub snapshot symlink keys the conversion on the file's content.
+    source = Path(metadata_file).resolve()
+    target = source.with_name(f'{source.name}.tags-v{_FORMAT_VERSION}')
+    if not (target / 'info.json').exists():
+        arrays, info = _convert(source)
+        try:
+            _save(target, arrays, info)
+        except OSError as e:
+            # A read-only model cache still works, just without the shared pages.
+            logger.warning('Could not store converted Camie metadata', path=str(target), error=e)
+            return _table(info, arrays)
+
+    info = json.loads((target / 'info.json').read_text())
+    arrays = {name: np.load(target / f'{name}.npy', mmap_mode='r') for name in _ARRAYS}
+    return _table(info, arrays)
+
+
+def _convert(source: Path) -> tuple[dict[str, np.ndarray], dict[str, Any]]:
+    with source.open('rb') as f:
+        metadata = json.load(f)
+
+    dataset_info = metadata['dataset_info']
+    tag_mapping = dataset_info['tag_mapping']
+    idx_to_tag: dict[str, str] = tag_mapping['idx_to_tag']
+    tag_to_category: dict[str, str] = tag_mapping['tag_to_category']
+    # Tags missing from `tag_to_category` count as general.
+    categories = sorted({*tag_to_category.values(), 'general'})
+
+    total_tags = dataset_info['total_tags']
+    category_codes = np.full(total_tags, NO_CATEGORY, dtype=np.int8)
+    names_offsets = np.zeros(total_tags + 1, dtype=np.uint32)
+    encoded: list[bytes] = []
+    for idx in range(total_tags):
+        tag_name = idx_to_tag.get(str(idx), '')
+        if tag_name:
+            category_codes[idx] = categories.index(tag_to_category.get(tag_name, 'general'))
+        encoded.append(tag_name.encode())
+        names_offsets[idx + 1] = names_offsets[idx] + len(encoded[-1])
+
+    arrays = {
+        'category_codes': category_codes,
+        'names_blob': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        'names_offsets': names_offsets,
+    }
+    return arrays, {'model_info': metadata['model_info'], 'categories': categories}
+
+
+def _save(target: Path, arrays: dict[str, np.ndarray], info: dict[str, Any]) -> None:
+    # Write into a scratch directory and rename it into place, so concurrently starting
+    # workers never map a half-written array.
+    scratch = Path(tempfile.mkdtemp(dir=target.parent, prefix=f'.{target.name}-'))
+    try:
+        for name, array in arrays.items():
+            np.save(scratch / f'{name}.npy', array)
+        (scratch / 'info.json').write_text(json.dumps(info))
+        scratch.rename(target)
+    except OSError:
+        # Another worker got there first; its copy is identical.
+        if not (target / 'info.json').exists():
+            raise
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _table(info: dict[str, Any], arrays: dict[str, np.ndarray]) -> TagTable:
+    return TagTable(
+        model_info=info['model_info'],
+        categories=tuple(info['categories']),
+        category_codes=arrays['category_codes'],
+        names_blob=arrays['names_blob'],
+        names_offsets=arrays['names_offsets'],
+    )
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Final
+
+import structlog
+from fastapi import HTTPException
+
+from app.config import config
+from app.metrics import MetricFamily, Sample, register_collector
+from app.profiling import run_profiled
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+logger = structlog.get_logger()
+
+
+class InferenceExecutor:
+    """Runs blocking model calls on dedicated threads so the event loop keeps serving.
+
+    Torch releases the GIL inside its kernels, so image downloads, request parsing and
+    health checks keep running while a forward pass is in flight. At most `max_pending`
+    calls may be queued or running at once; beyond that, callers fail fast with 503
+    instead of piling up behind slow inference.
+    """
+
+    def __init__(self, concurrency: int, max_pending: int) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='inference')
+        self._max_pending = max_pending
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def run[**P, R](self, func: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+        # Only touched from the event loop thread, so a plain counter is enough.
+        if self._pending >= self._max_pending:
+            logger.warning('Inference queue is full', pending=self._pending)
+            raise HTTPException(status_code=503, detail='Inference queue is full')
+
+        self._pending += 1
+        try:
+            # Executor threads don't inherit context variables; copying them keeps
+            # OTEL spans, structlog context and profiling attached to the calling request.
+            call = functools.partial(
+                contextvars.copy_context().run,
+                run_profiled,
+                func,
+                *args,
+                **kwargs,
+            )
+            return await asyncio.get_running_loop().run_in_executor(self._pool, call)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+inference_executor: Final[InferenceExecutor] = InferenceExecutor(
+    concurrency=config.INFERENCE_CONCURRENCY,
+    max_pending=config.INFERENCE_QUEUE_SIZE,
+)
+
+# Search queries get their own threads so they never wait behind image backlogs.
+query_executor: Final[InferenceExecutor] = InferenceExecutor(
+    concurrency=config.QUERY_CONCURRENCY,
+    max_pending=config.INFERENCE_QUEUE_SIZE,
+)
+
+
+def _pending_calls() -> list[MetricFamily]:
+    return [
+        MetricFamily(
+            'starlight_inference_pending',
+            'gauge',
+            'Inference calls queued or running on an executor.',
+            [
+                Sample({'executor': 'inference'}, inference_executor.pending),
+                Sample({'executor': 'query'}, query_executor.pending),
+            ],
+        ),
+    ]
+
+
+register_collector(_pending_calls)
@@ -0,0 +1,45 @@
+"""Framing for the Unix socket between HTTP workers and the model host.
+
+Every message is a fixed 8-byte prefix with the sizes of a JSON header and a binary
+payload, followed by both. Headers carry the request id, operation and small
+arguments; payloads carry raw pixels or float32 vectors, so neither side ever
+base64-encodes or re-decodes an image.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import struct
+from typing import TYPE_CHECKING, Any
+
+from PIL import Image
+
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
+
+_PREFIX = struct.Struct('!II')
+
+# Raised by `read_frame` and writes once the other side has gone away.
+DISCONNECTED = (asyncio.IncompleteReadError, ConnectionError)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[dict[str, Any], bytes]:
+    header_size, payload_size = _PREFIX.unpack(await reader.readexactly(_PREFIX.size))
+    header = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b''
+    return header, payload
+
+
+def write_frame(writer: asyncio.StreamWriter, header: dict[str, Any], payload: bytes = b'') -> None:
+    encoded = json.dumps(header).encode()
+    writer.writelines([_PREFIX.pack(len(encoded), len(payload)), encoded, payload])
+
+
+def image_to_payload(img: PILImage) -> tuple[dict[str, Any], bytes]:
+    # Decoded pixels, since the worker already paid for the download and decode.
+    return {'mode': img.mode, 'width': img.width, 'height': img.height}, img.tobytes()
+
+
+def image_from_payload(meta: dict[str, Any], payload: bytes) -> PILImage:
+    return Image.frombytes(meta['mode'], (meta['width'], meta['height']), payload)
@@ -1,36 +1,90 @@
 from __future__ import annotations
 
+import asyncio
 from contextlib import asynccontextmanager
+from dataclasses import asdict
 from time import perf_counter
 from typing import TYPE_CHECKING, Any
 from uuid import uuid4
 
 import structlog
 from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request
-from niquests import AsyncSession
+from fastapi.responses import PlainTextResponse
 from opentelemetry import baggage, trace
 from opentelemetry.context import attach, detach
 
+from app.batching import close_batchers
+from app.cache import cache_stats, result_cache
 from app.config import config
+from app.http_client import create_http_session, host_limiter
+from app.inference import inference_executor, query_executor
 from app.logger import configure_logger
+from app.metrics import CONTENT_TYPE, collect, render, with_labels
+from app.model_client import (
+    host_cache_stats,
+    host_metrics,
+    host_model_stats,
+    model_host,
+    wait_until_ready,
+)
 from app.otel import setup_otel
+from app.profiling import PROFILE_HEADER, profile_request, profile_requested, record_profiles
 
 if TYPE_CHECKING:
-    from collections.abc import AsyncIterator, Callable, Coroutine
+    from collections.abc import AsyncGenerator, Callable, Coroutine
 
     from starlette.responses import Response
 
+# Thin workers in front of a model host never load models, nor torch.
+if not config.MODEL_HOST_SOCKET:
+    from app.registry import model_stats, run_idle_unloader
+
 configure_logger()
 
 
+async def warm_up(application: FastAPI) -> None:
+    start = perf_counter()
+    try:
+        if config.MODEL_HOST_SOCKET:
+            # Models live in the model host; ready once the host has warmed them up.
+            await wait_until_ready()
+        for warmup in warmups:
+            await inference_executor.run(warmup)
+    except Exception:
+        # Stay unready: routing traffic to a replica whose models fail to run won't help.
+        logger.exception('Model warmup failed')
+        return
+
+    application.state.ready = True
+    logger.info('Models warmed up', duration_ms=(perf_counter() - start) * 1000)
+
+
 @asynccontextmanager
-async def lifespan(application: FastAPI) -> AsyncIterator[None]:
-    application.state.http_session = AsyncSession(disable_http3=True)
+async def lifespan(application: FastAPI) -> AsyncGenerator[None]:
+    application.state.http_session = create_http_session()
+    application.state.ready = not config.WARMUP
+
+    # Warm up in the background so /health answers while models load; /ready flips
+    # once every enabled model has run a forward at each configured batch size.
+    warmup_task = asyncio.create_task(warm_up(application)) if config.WARMUP else None
+    unloader_task = (
+        asyncio.create_task(run_idle_unloader()) if not config.MODEL_HOST_SOCKET else None
+    )
 
     try:
         yield
     finally:
+        if warmup_task:
+            warmup_task.cancel()
+        if unloader_task:
+            unloader_task.cancel()
         await application.state.http_session.close()
+        if config.MODEL_HOST_SOCKET:
+            await model_host.close()
+        await close_batchers()
+        inference_executor.shutdown()
+        query_executor.shutdown()
+        result_cache.close()
 
 
 app = FastAPI(
@@ -64,7 +118,17 @@ async def log_request_duration(
 
     start = perf_counter()
     try:
-        response = await call_next(request)
+        # Only inference routes, all POSTs under /v1, run models worth profiling.
+        if (
+            request.method == 'POST'
+            and request.url.path.startswith('/v1/')
+            and profile_requested(request.headers.get(PROFILE_HEADER))
+        ):
+            with profile_request() as profiles:
+                response = await call_next(request)
+            record_profiles(span, profiles, request_id=request_id)
+        else:
+            response = await call_next(request)
     finally:
         detach(token)
 
@@ -103,14 +167,71 @@ def health() -> dict[str, str]:
     return {'status': 'ok'}
 
 
+@app.get('/ready')
+def ready(request: Request) -> dict[str, str]:
+    if not request.app.state.ready:
+        raise HTTPException(status_code=503, detail='Models are warming up')
+
+    return {'status': 'ready'}
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    families = await asyncio.to_thread(collect)
+    if config.MODEL_HOST_SOCKET:
+        # Inference runs in the host, so its stage timings, queues and memory are
+        # served alongside this worker's download and decode metrics.
+        families = [
+            *with_labels(families, process='worker'),
+            *with_labels(await host_metrics(), process='host'),
+        ]
+    return PlainTextResponse(render(families), media_type=CONTENT_TYPE)
+
+
+@protected_router.get('/cache/stats')
+async def get_cache_stats() -> dict[str, dict[str, int]]:
+    if config.MODEL_HOST_SOCKET:
+        return await host_cache_stats()
+    return cache_stats()
+
+
+@protected_router.get('/models/stats')
+async def get_model_stats() -> dict[str, dict[str, Any]]:
+    if config.MODEL_HOST_SOCKET:
+        return await host_model_stats()
+    # Walks every loaded model's state_dict, so keep it off the event loop.
+    stats = await asyncio.to_thread(model_stats)
+    return {name: asdict(model) for name, model in stats.items()}
+
+
+@protected_router.get('/http/stats')
+def get_http_stats() -> dict[str, Any]:
+    return host_limiter.pool_stats()
+
+
+warmups: list[Callable[[], None]] = []
+
 if config.ENABLE_CLASSIFICATION:
     from app.routes.classification import router as classification_router
 
     protected_router.include_router(classification_router)
+    if not config.MODEL_HOST_SOCKET:
+        from app.services.classification import warmup as warmup_classification
+
+        warmups.append(warmup_classification)
 
 if config.ENABLE_EMBEDDINGS:
     from app.routes.embeddings import router as embeddings_router
 
     protected_router.include_router(embeddings_router)
+    if not config.MODEL_HOST_SOCKET:
+        from app.services.embeddings import warmup as warmup_embeddings
+
+        warmups.append(warmup_embeddings)
+
+if config.ENABLE_CLASSIFICATION and config.ENABLE_EMBEDDINGS:
+    from app.routes.analysis import router as analysis_router
+
+    protected_router.include_router(analysis_router)
 
 app.include_router(protected_router)
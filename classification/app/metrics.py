@@ -0,0 +1,206 @@
+"""Prometheus metrics in the text exposition format.
+
+Histograms live in-process behind a lock each, so recording on a hot path costs a
+bucket lookup. Values that are already tracked elsewhere (batch queues, cache
+counters, model memory) are read at scrape time by collectors instead of mirrored.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Literal
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator, Iterable
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 1ms to 30s covers everything from a cached decode to a cold download.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+@dataclass
+class Sample:
+    labels: dict[str, str]
+    value: float
+    # `_bucket`, `_sum` and `_count` for histograms.
+    suffix: str = ''
+
+
+@dataclass
+class MetricFamily:
+    name: str
+    type: Literal['counter', 'gauge', 'histogram']
+    help: str
+    samples: list[Sample] = field(default_factory=list)
+
+
+type Collector = Callable[[], Iterable[MetricFamily]]
+
+_collectors: list[Collector] = []
+
+
+def register_collector(collector: Collector) -> None:
+    _collectors.append(collector)
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = SECONDS_BUCKETS,
+    ) -> None:
+        self._family = MetricFamily(name, 'histogram', help_text)
+        self._labelnames = labelnames
+        self._buckets = buckets
+        # Per label set: a count per bucket plus one for +Inf, and the sum.
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        register_collector(self._collect)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self._labelnames)
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self._buckets) + 1))
+            counts[index] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Generator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _collect(self) -> list[MetricFamily]:
+        with self._lock:
+            snapshot = [
+                (key, list(counts), self._sums[key]) for key, counts in self._counts.items()
+            ]
+
+        samples: list[Sample] = []
+        for key, counts, total in snapshot:
+            labels = dict(zip(self._labelnames, key, strict=True))
+            cumulative = 0
+            for bound, count in zip([*self._buckets, float('inf')], counts, strict=True):
+                cumulative += count
+                samples.append(
+                    Sample({**labels, 'le': _format_value(bound)}, cumulative, '_bucket'),
+                )
+            samples.extend((Sample(labels, total, '_sum'), Sample(labels, cumulative, '_count')))
+        return [MetricFamily(self._family.name, 'histogram', self._family.help, samples)]
+
+
+@contextmanager
+def time_stage(
+    model_id: str,
+    stage: Literal['preprocess', 'forward', 'postprocess'],
+) -> Generator[None]:
+    """Time one stage of a model call into `model_stage_seconds`, failed or not."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        model_stage_seconds.observe(perf_counter() - start, model=model_id, stage=stage)
+
+
+def collect() -> list[MetricFamily]:
+    return [family for collector in _collectors for family in collector()]
+
+
+def with_labels(families: Iterable[MetricFamily], **labels: str) -> list[MetricFamily]:
+    return [
+        MetricFamily(
+            family.name,
+            family.type,
+            family.help,
+            [Sample({**labels, **s.labels}, s.value, s.suffix) for s in family.samples],
+        )
+        for family in families
+    ]
+
+
+def render(families: Iterable[MetricFamily]) -> str:
+    # Families with the same name (e.g. from a worker and the model host) are merged,
+    # since HELP and TYPE may only appear once per metric.
+    merged: dict[str, MetricFamily] = {}
+    for family in families:
+        if family.name in merged:
+            merged[family.name].samples.extend(family.samples)
+        else:
+            merged[family.name] = MetricFamily(
+                family.name,
+                family.type,
+                family.help,
+                list(family.samples),
+            )
+
+    lines: list[str] = []
+    for family in merged.values():
+        lines.extend((f'# HELP {family.name} {family.help}', f'# TYPE {family.name} {family.type}'))
+        for sample in family.samples:
+            labels = ','.join(f'{name}="{_escape(value)}"' for name, value in sample.labels.items())
+            name = (
+                f'{family.name}{sample.suffix}{{{labels}}}'
+                if labels
+                else f'{family.name}{sample.suffix}'
+            )
+            lines.append(f'{name} {_format_value(sample.value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _process_families() -> list[MetricFamily]:
+    # statm reports pages; the second field is the resident set.
+    resident_pages = int(Path('/proc/self/statm').read_bytes().split()[1])
+    return [
+        MetricFamily(
+            'process_resident_memory_bytes',
+            'gauge',
+            'Resident memory size in bytes.',
+            [Sample({}, resident_pages * os.sysconf('SC_PAGE_SIZE'))],
+        ),
+    ]
+
+
+register_collector(_process_families)
+
+image_download_seconds = Histogram(
+    'starlight_image_download_seconds',
+    'Time to download an image URL, including failed downloads.',
+)
+image_decode_seconds = Histogram(
+    'starlight_image_decode_seconds',
+    'Time to decode image bytes into pixels.',
+)
+pipeline_seconds = Histogram(
+    'starlight_pipeline_seconds',
+    'Time spent in each pipeline_span operation.',
+    ('operation', 'model'),
+)
+model_stage_seconds = Histogram(
+    'starlight_model_stage_seconds',
+    'Time per model in input preprocessing, the forward pass and output postprocessing.',
+    ('model', 'stage'),
+)
@@ -0,0 +1,202 @@
+"""Model calls forwarded to the model host over its Unix socket.
+
+Used instead of `app.services` when `MODEL_HOST_SOCKET` is set. The functions mirror
+the local service signatures, so routes don't care where the models run.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Final
+
+import numpy as np
+import structlog
+from fastapi import HTTPException
+
+from app.config import config
+from app.ipc import DISCONNECTED, image_to_payload, read_frame, write_frame
+from app.metrics import MetricFamily, Sample
+from app.models import ClassificationResult
+from app.profiling import ProfileSummary, request_profiles
+
+if TYPE_CHECKING:
+    from numpy import ndarray
+    from PIL.Image import Image as PILImage
+
+    from app.models import EncodingMode
+
+logger = structlog.get_logger()
+
+
+@dataclass
+class _Connection:
+    writer: asyncio.StreamWriter
+    # Calls awaiting a response on this connection, by request id.
+    pending: dict[int, asyncio.Future[tuple[dict[str, Any], bytes]]] = field(
+        default_factory=dict,
+    )
+    reader_task: asyncio.Task[None] | None = None
+
+
+class ModelHostClient:
+    """One multiplexed connection per worker; responses are matched by request id.
+
+    Connects lazily and reconnects on the next call after the host goes away, failing
+    calls in flight on the lost connection with 503 in the meantime. Calls the host
+    doesn't answer within `MODEL_HOST_TIMEOUT_SECONDS` fail with 504.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._ids = itertools.count()
+        self._connection: _Connection | None = None
+        self._connect_lock = asyncio.Lock()
+
+    async def call(
+        self,
+        op: str,
+        args: dict[str, Any] | None = None,
+        payload: bytes = b'',
+    ) -> tuple[dict[str, Any], bytes]:
+        connection = await self._connect()
+        request_id = next(self._ids)
+        request: dict[str, Any] = {'id': request_id, 'op': op, 'args': args or {}}
+        # Calls of a profiled request are profiled where the models run.
+        if (profiles := request_profiles.get()) is not None:
+            request['profile'] = True
+        future = asyncio.get_running_loop().create_future()
+        connection.pending[request_id] = future
+        try:
+            write_frame(connection.writer, request, payload)
+            await connection.writer.drain()
+            async with asyncio.timeout(config.MODEL_HOST_TIMEOUT_SECONDS):
+                header, body = await future
+        except TimeoutError as e:
+            logger.warning('Model host call timed out', op=op, path=self._path)
+            raise HTTPException(status_code=504, detail='Model host timed out') from e
+        except ConnectionError as e:
+            raise HTTPException(status_code=503, detail='Model host unavailable') from e
+        finally:
+            connection.pending.pop(request_id, None)
+
+        if profiles is not None:
+            profiles.extend(ProfileSummary(**profile) for profile in header.get('profiles', []))
+        if header['status_code'] != 200:
+            raise HTTPException(status_code=header['status_code'], detail=header.get('detail'))
+        return header, body
+
+    async def close(self) -> None:
+        if connection := self._connection:
+            if connection.reader_task:
+                connection.reader_task.cancel()
+            connection.writer.close()
+
+    async def _connect(self) -> _Connection:
+        async with self._connect_lock:
+            if self._connection is None or self._connection.writer.is_closing():
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self._path)
+                except OSError as e:
+                    raise HTTPException(status_code=503, detail='Model host unavailable') from e
+                connection = _Connection(writer)
+                connection.reader_task = asyncio.create_task(
+                    self._read_responses(connection, reader),
+                )
+                self._connection = connection
+            return self._connection
+
+    async def _read_responses(self, connection: _Connection, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                header, body = await read_frame(reader)
+                future = connection.pending.get(header['id'])
+                if future and not future.done():
+                    future.set_result((header, body))
+        except DISCONNECTED:
+            logger.warning('Lost connection to model host', path=self._path)
+        finally:
+            # Only this connection is torn down; a newer one may already be serving.
+            connection.writer.close()
+            if self._connection is connection:
+                self._connection = None
+            for future in connection.pending.values():
+                if not future.done():
+                    future.set_exception(
+                        HTTPException(status_code=503, detail='Model host connection lost'),
+                    )
+
+
+model_host: Final[ModelHostClient] = ModelHostClient(config.MODEL_HOST_SOCKET or '')
+
+
+async def wait_until_ready(poll_interval: float = 1.0) -> None:
+    while True:
+        try:
+            header, _ = await model_host.call('ready')
+            if header['result']:
+                return
+        except HTTPException:
+            pass
+        await asyncio.sleep(poll_interval)
+
+
+async def host_cache_stats() -> dict[str, dict[str, int]]:
+    header, _ = await model_host.call('cache_stats')
+    return header['result']
+
+
+async def host_model_stats() -> dict[str, dict[str, Any]]:
+    header, _ = await model_host.call('model_stats')
+    return header['result']
+
+
+async def host_metrics() -> list[MetricFamily]:
+    header, _ = await model_host.call('metrics')
+    return [
+        MetricFamily(
+            family['name'],
+            family['type'],
+            family['help'],
+            [Sample(**sample) for sample in family['samples']],
+        )
+        for family in header['result']
+    ]
+
+
+async def classify_image(img: PILImage, pixels_digest: str | None = None) -> ClassificationResult:
+    meta, pixels = image_to_payload(img)
+    _, body = await model_host.call(
+        'classify',
+        {'image': meta, 'pixels_digest': pixels_digest},
+        pixels,
+    )
+    return ClassificationResult.model_validate_json(body)
+
+
+async def encode_image(
+    img: PILImage,
+    encoding_mode: EncodingMode,
+    pixels_digest: str | None = None,
+) -> ndarray:
+    meta, pixels = image_to_payload(img)
+    _, body = await model_host.call(
+        'encode_image',
+        {'image': meta, 'encoding_mode': encoding_mode.value, 'pixels_digest': pixels_digest},
+        pixels,
+    )
+    return np.frombuffer(body, dtype=np.float32)
+
+
+async def encode_text(text: str, encoding_mode: EncodingMode) -> ndarray:
+    _, body = await model_host.call(
+        'encode_text',
+        {'text': text, 'encoding_mode': encoding_mode.value},
+    )
+    return np.frombuffer(body, dtype=np.float32)
+
+
+async def encode_query(query: str) -> ndarray:
+    _, body = await model_host.call('encode_query', {'query': query})
+    return np.frombuffer(body, dtype=np.float32)
@@ -0,0 +1,207 @@
+"""Model host: one process that owns every model and serves all HTTP workers.
+
+Run it next to granian with `python -m app.model_host` and start the workers with the
+same `MODEL_HOST_SOCKET`. Workers then skip loading models and forward each call over
+the socket. Weights are held once per host instead of once per worker, and the
+micro-batchers group requests from all workers into the same forwards.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import nullcontext
+from dataclasses import asdict
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+import structlog
+from fastapi import HTTPException
+
+from app.batching import close_batchers
+from app.cache import cache_stats, result_cache
+from app.config import config
+from app.inference import inference_executor, query_executor
+from app.ipc import DISCONNECTED, image_from_payload, read_frame, write_frame
+from app.logger import configure_logger
+from app.metrics import collect
+from app.models import EncodingMode
+from app.profiling import profile_request
+from app.registry import model_stats, run_idle_unloader
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from numpy import ndarray
+
+type Operation = Callable[[dict[str, Any], bytes], Awaitable[tuple[Any, bytes]]]
+
+logger = structlog.get_logger()
+
+
+def _vector(vector: ndarray) -> tuple[None, bytes]:
+    return None, vector.astype(np.float32).tobytes()
+
+
+class ModelHost:
+    def __init__(self) -> None:
+        self.ready = False
+        self.warmups: list[Callable[[], None]] = []
+        self.operations: dict[str, Operation] = {
+            'ready': self._ready,
+            'cache_stats': self._cache_stats,
+            'model_stats': self._model_stats,
+            'metrics': self._metrics,
+        }
+
+        # Same services a worker would import; models load on first use or at warmup.
+        if config.ENABLE_CLASSIFICATION:
+            from app.services import classification
+
+            async def classify(args: dict[str, Any], payload: bytes) -> tuple[None, bytes]:
+                img = image_from_payload(args['image'], payload)
+                result = await classification.classify_image(img, args['pixels_digest'])
+                return None, result.model_dump_json().encode()
+
+            self.operations['classify'] = classify
+            self.warmups.append(classification.warmup)
+
+        if config.ENABLE_EMBEDDINGS:
+            from app.services import embeddings
+
+            async def encode_image(args: dict[str, Any], payload: bytes) -> tuple[None, bytes]:
+                img = image_from_payload(args['image'], payload)
+                mode = EncodingMode(args['encoding_mode'])
+                return _vector(await embeddings.encode_image(img, mode, args['pixels_digest']))
+
+            async def encode_text(args: dict[str, Any], _: bytes) -> tuple[None, bytes]:
+                mode = EncodingMode(args['encoding_mode'])
+                return _vector(await embeddings.encode_text(args['text'], mode))
+
+            async def encode_query(args: dict[str, Any], _: bytes) -> tuple[None, bytes]:
+                return _vector(await embeddings.encode_query(args['query']))
+
+            self.operations |= {
+                'encode_image': encode_image,
+                'encode_text': encode_text,
+                'encode_query': encode_query,
+            }
+            self.warmups.append(embeddings.warmup)
+
+    async def warm_up(self) -> None:
+        start = perf_counter()
+        try:
+            for warmup in self.warmups:
+                await inference_executor.run(warmup)
+        except Exception:
+            logger.exception('Model warmup failed')
+            return
+
+        self.ready = True
+        logger.info('Models warmed up', duration_ms=(perf_counter() - start) * 1000)
+
+    async def handle_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        # Requests on one connection run concurrently so they can share batches.
+        tasks: set[asyncio.Task[None]] = set()
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                task = asyncio.create_task(self._dispatch(header, payload, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except DISCONNECTED:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _dispatch(
+        self,
+        header: dict[str, Any],
+        payload: bytes,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        response: dict[str, Any] = {'id': header['id'], 'status_code': 200}
+        body = b''
+        # Workers ask for a profile on every call of a profiled request; the model calls
+        # it makes are then profiled on the executor threads that run them.
+        profiler = profile_request() if header.get('profile') else nullcontext([])
+        with profiler as profiles:
+            try:
+                operation = self.operations.get(header['op'])
+                if operation is None:
+                    raise HTTPException(
+                        status_code=404,
+                        detail=f'Unknown operation: {header["op"]}',
+                    )
+                response['result'], body = await operation(header['args'], payload)
+            except HTTPException as e:
+                response |= {'status_code': e.status_code, 'detail': str(e.detail)}
+            except Exception as e:
+                logger.exception('Model host operation failed', op=header['op'])
+                response |= {'status_code': 500, 'detail': f'Model inference failed: {e}'}
+
+        if profiles:
+            response['profiles'] = [asdict(profile) for profile in profiles]
+
+        if writer.is_closing():
+            return
+        write_frame(writer, response, body)
+        await writer.drain()
+
+    async def _ready(self, *_: Any) -> tuple[bool, bytes]:
+        return self.ready, b''
+
+    async def _cache_stats(self, *_: Any) -> tuple[dict[str, dict[str, int]], bytes]:
+        return cache_stats(), b''
+
+    async def _metrics(self, *_: Any) -> tuple[list[dict[str, Any]], bytes]:
+        # Model memory collectors walk every state_dict, so keep them off the loop.
+        families = await asyncio.to_thread(collect)
+        return [asdict(family) for family in families], b''
+
+    async def _model_stats(self, *_: Any) -> tuple[dict[str, dict[str, Any]], bytes]:
+        stats = await asyncio.to_thread(model_stats)
+        return {name: asdict(model) for name, model in stats.items()}, b''
+
+
+async def serve(path: Path) -> None:
+    host = ModelHost()
+    server = await asyncio.start_unix_server(host.handle_connection, path=path)
+    logger.info('Model host listening', path=str(path))
+
+    warmup_task = asyncio.create_task(host.warm_up()) if config.WARMUP else None
+    unloader_task = asyncio.create_task(run_idle_unloader())
+    host.ready = not config.WARMUP
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if warmup_task:
+            warmup_task.cancel()
+        unloader_task.cancel()
+        await close_batchers()
+        inference_executor.shutdown()
+        query_executor.shutdown()
+        result_cache.close()
+
+
+def main() -> None:
+    if not config.MODEL_HOST_SOCKET:
+        raise RuntimeError('MODEL_HOST_SOCKET must be set to run the model host')
+
+    configure_logger()
+    path = Path(config.MODEL_HOST_SOCKET)
+    # A socket left behind by a previous host would make the bind fail.
+    path.unlink(missing_ok=True)
+    asyncio.run(serve(path))
+
+
+if __name__ == '__main__':
+    main()
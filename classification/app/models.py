@@ -19,6 +19,13 @@ class ImageRequest(BaseModel):
     image: str
 
 
+class BatchImageRequest(BaseModel):
+    images: list[str] = Field(min_length=1)
+
+
+# `high + medium` at or above this marks an image as NSFW.
+NSFW_THRESHOLD = 0.5
+
 # NSFW scores -> {"normal": <score>, "nsfw": <score>}
 
 
@@ -39,7 +46,7 @@ class NSFWResult(ResponseModel):
 
     @property
     def is_nsfw(self) -> bool:
-        return self.scores.high + self.scores.medium >= 0.5
+        return self.scores.high + self.scores.medium >= NSFW_THRESHOLD
 
     @override
     @classmethod
@@ -181,6 +188,16 @@ class ClassificationResult(ResponseModel):
         )
 
 
+class ClassificationError(BaseModel):
+    status_code: int
+    detail: str
+
+
+class BatchClassificationResponse(BaseModel):
+    # Same order as the request; failed images carry an error instead of a result.
+    results: list[ClassificationResult | ClassificationError]
+
+
 class EncodingMode(StrEnum):
     DOCUMENT = 'document'
     QUERY = 'retrieval.query'
@@ -204,3 +221,16 @@ class EmbeddingPayload(BaseModel):
 class EmbeddingResponse(BaseModel):
     image: list[float] | None = None
     text: list[float]
+
+
+class QueryEmbeddingPayload(BaseModel):
+    query: str
+
+
+class TextEmbeddingResponse(BaseModel):
+    text: list[float]
+
+
+class AnalysisResponse(BaseModel):
+    classification: ClassificationResult
+    embeddings: EmbeddingResponse
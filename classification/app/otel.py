@@ -10,6 +10,7 @@ from opentelemetry.instrumentation.transformers import TransformersInstrumentor
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 from opentelemetry.sdk.trace import TracerProvider
 
+from app.metrics import pipeline_seconds
 from app.models import EncodingMode
 
 resource = Resource(
@@ -37,7 +38,10 @@ def pipeline_span(
     encoding_mode: EncodingMode | None = None,
 ) -> Generator[None]:
     tracer = trace.get_tracer('starlight.pipeline')
-    with tracer.start_as_current_span(operation_name) as span:
+    with (
+        tracer.start_as_current_span(operation_name) as span,
+        pipeline_seconds.time(operation=operation_name, model=model_id or ''),
+    ):
         if model_id:
             span.set_attribute('model.id', model_id)
 
@@ -0,0 +1,355 @@
+"""Shared tensor preprocessing for the classification models.
+
+Every image is converted to a uint8 tensor and copied to the model device once. Each
+model's input is then derived from that copy with batched tensor ops (resize, crop,
+letterbox, normalize), instead of every pipeline running its own PIL resize and
+normalization of the same image on CPU.
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import TYPE_CHECKING, Any, Literal, Self
+
+import numpy as np
+import structlog
+import torch
+from PIL.Image import Image as PILImage
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms.v2 import functional as tvf
+
+from app.metrics import model_stage_seconds, time_stage
+from app.quantization import (
+    accept_quantized,
+    flip_rate,
+    quantize_linear_layers,
+    record_quantization,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator, Sequence
+
+    from torch import nn
+    from transformers import PreTrainedModel
+    from transformers.pipelines import ImageClassificationPipeline
+
+logger = structlog.get_logger()
+
+# Part of result cache fingerprints; bump whenever a change here alters model inputs.
+PREPROCESSING_VERSION = '1'
+
+# PIL resample codes, as stored in HF image processor configs. Tensor resizing only
+# has nearest, bilinear and bicubic kernels; Lanczos maps to bicubic, the closest.
+_PIL_INTERPOLATION = {
+    0: InterpolationMode.NEAREST,
+    1: InterpolationMode.BICUBIC,
+    2: InterpolationMode.BILINEAR,
+    3: InterpolationMode.BICUBIC,
+    4: InterpolationMode.BILINEAR,
+    5: InterpolationMode.BILINEAR,
+}
+_TIMM_INTERPOLATION = {
+    'nearest': InterpolationMode.NEAREST,
+    'bilinear': InterpolationMode.BILINEAR,
+    'bicubic': InterpolationMode.BICUBIC,
+}
+_TIMM_DEFAULT_CROP_PCT = 0.875
+
+
+@dataclass(frozen=True)
+class DecodedBatch:
+    """Images of one batch, both as PIL images and as uint8 CHW tensors on the device."""
+
+    images: list[PILImage]
+    pixels: list[torch.Tensor]
+
+    @classmethod
+    def from_images(cls, images: list[PILImage], device: str) -> Self:
+        # uint8 is a quarter of the float32 size, so the host-to-device copy stays cheap.
+        pixels = [
+            torch.from_numpy(np.asarray(img.convert('RGB'))).permute(2, 0, 1).to(device)
+            for img in images
+        ]
+        return cls(images=images, pixels=pixels)
+
+
+def _resize(pixels: torch.Tensor, size: int | list[int], mode: InterpolationMode) -> torch.Tensor:
+    # Antialiased resizing of float input matches PIL; rounding and clamping mirror the
+    # uint8 image PIL would have produced before normalization.
+    resized = tvf.resize(pixels.float(), size, interpolation=mode, antialias=True)
+    return resized.clamp_(0, 255).round_()
+
+
+def _normalize(
+    batch: torch.Tensor,
+    *,
+    rescale: float,
+    mean: Sequence[float],
+    std: Sequence[float],
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    mean_t = torch.tensor(mean, device=batch.device).view(1, -1, 1, 1)
+    std_t = torch.tensor(std, device=batch.device).view(1, -1, 1, 1)
+    return ((batch * rescale - mean_t) / std_t).to(dtype)
+
+
+@dataclass(frozen=True)
+class InputSpec:
+    """Resize, crop and normalization parameters of one image classification model.
+
+    `resize_to` is either an exact `[height, width]` or a shortest edge length that keeps
+    the aspect ratio; the result is then center-cropped to `crop` when set.
+    """
+
+    resize_to: int | list[int]
+    crop: list[int] | None
+    interpolation: InterpolationMode
+    rescale: float
+    mean: tuple[float, ...]
+    std: tuple[float, ...]
+
+    @classmethod
+    def from_image_processor(cls, processor: Any) -> Self | None:
+        """Read the spec from a HF image processor, or None if it isn't supported."""
+        if (data_config := getattr(processor, 'data_config', None)) is not None:
+            return cls._from_timm_data_config(data_config)
+
+        size = processor.size if getattr(processor, 'do_resize', False) else None
+        if not size or hasattr(processor, 'crop_pct'):
+            return None
+
+        if 'height' in size and 'width' in size:
+            resize_to: int | list[int] = [size['height'], size['width']]
+        elif 'shortest_edge' in size and len(size) == 1:
+            resize_to = size['shortest_edge']
+        else:
+            return None
+
+        crop = None
+        if getattr(processor, 'do_center_crop', False):
+            crop = [processor.crop_size['height'], processor.crop_size['width']]
+
+        do_normalize = getattr(processor, 'do_normalize', False)
+        return cls(
+            resize_to=resize_to,
+            crop=crop,
+            interpolation=_PIL_INTERPOLATION.get(
+                int(processor.resample),
+                InterpolationMode.BICUBIC,
+            ),
+            rescale=processor.rescale_factor if getattr(processor, 'do_rescale', False) else 1.0,
+            mean=tuple(processor.image_mean) if do_normalize else (0.0, 0.0, 0.0),
+            std=tuple(processor.image_std) if do_normalize else (1.0, 1.0, 1.0),
+        )
+
+    @classmethod
+    def _from_timm_data_config(cls, data_config: dict[str, Any]) -> Self | None:
+        # Mirrors timm's eval transform: scale by 1 / crop_pct, then center crop.
+        crop_mode = data_config.get('crop_mode', 'center')
+        if crop_mode not in {'center', 'squash'}:
+            return None
+
+        _, height, width = data_config['input_size']
+        crop_pct = data_config.get('crop_pct') or _TIMM_DEFAULT_CROP_PCT
+        scaled = [math.floor(height / crop_pct), math.floor(width / crop_pct)]
+
+        return cls(
+            resize_to=scaled[0] if crop_mode == 'center' and height == width else scaled,
+            crop=[height, width],
+            interpolation=_TIMM_INTERPOLATION.get(
+                data_config.get('interpolation', 'bicubic'),
+                InterpolationMode.BICUBIC,
+            ),
+            rescale=1 / 255,
+            mean=tuple(data_config['mean']),
+            std=tuple(data_config['std']),
+        )
+
+    def build(self, pixels: list[torch.Tensor], dtype: torch.dtype) -> torch.Tensor:
+        resized = [_resize(image, self.resize_to, self.interpolation) for image in pixels]
+        if self.crop is not None:
+            resized = [tvf.center_crop(image, self.crop) for image in resized]
+
+        return _normalize(
+            torch.stack(resized),
+            rescale=self.rescale,
+            mean=self.mean,
+            std=self.std,
+            dtype=dtype,
+        )
+
+
+def letterbox(
+    pixels: list[torch.Tensor],
+    *,
+    size: int,
+    pad_color: tuple[int, int, int],
+    mean: Sequence[float],
+    std: Sequence[float],
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Fit each image into a `size` square, keeping its aspect ratio, and pad the rest."""
+    batch = torch.tensor(pad_color, dtype=torch.float32, device=pixels[0].device)
+    batch = batch.view(1, 3, 1, 1).repeat(len(pixels), 1, size, size)
+
+    for i, image in enumerate(pixels):
+        height, width = image.shape[-2:]
+        aspect_ratio = width / height
+        if aspect_ratio > 1:
+            new_width, new_height = size, int(size / aspect_ratio)
+        else:
+            new_width, new_height = int(size * aspect_ratio), size
+
+        top = (size - new_height) // 2
+        left = (size - new_width) // 2
+        batch[i, :, top : top + new_height, left : left + new_width] = _resize(
+            image,
+            [new_height, new_width],
+            InterpolationMode.BICUBIC,
+        )
+
+    return _normalize(batch, rescale=1 / 255, mean=mean, std=std, dtype=dtype)
+
+
+type Stage = Literal['preprocess', 'forward', 'postprocess']
+
+
+class _PendingStages(threading.local):
+    def __init__(self) -> None:
+        self.events: list[tuple[str, Stage, torch.cuda.Event, torch.cuda.Event]] = []
+
+
+_pending_stages = _PendingStages()
+
+
+@contextmanager
+def device_stage(model_id: str, stage: Stage, device: torch.device | str) -> Generator[None]:
+    """Time a stage of device work into `model_stage_seconds` without waiting for it.
+
+    GPU kernels are still running when the Python call returns, so a pair of CUDA events
+    is recorded on the current stream instead and read by `record_device_stages`, after
+    the call has copied its results to the host. Stages on the CPU are timed directly.
+    """
+    if torch.device(device).type != 'cuda':
+        with time_stage(model_id, stage):
+            yield
+        return
+
+    start = torch.cuda.Event(enable_timing=True)
+    end = torch.cuda.Event(enable_timing=True)
+    start.record()
+    try:
+        yield
+    finally:
+        end.record()
+        _pending_stages.events.append((model_id, stage, start, end))
+
+
+def record_device_stages() -> None:
+    """Observe the stages `device_stage` timed on this thread so far."""
+    for model_id, stage, start, end in _pending_stages.events:
+        # Already complete after the results were copied to the host; waiting only
+        # covers the final, empty stretch of the last stage.
+        end.synchronize()
+        model_stage_seconds.observe(start.elapsed_time(end) / 1000, model=model_id, stage=stage)
+    _pending_stages.events.clear()
+
+
+class TensorImageClassifier:
+    """Runs an image classification pipeline's model directly on device tensors.
+
+    Inputs are built with the pipeline's own processor parameters and fed straight to
+    the model, and outputs use the pipeline's `[{'label', 'score'}, ...]` format. When
+    the processor can't be expressed as an `InputSpec`, the pipeline is used as is.
+    """
+
+    def __init__(self, pipe: ImageClassificationPipeline) -> None:
+        self._pipe = pipe
+        self._model = pipe.model
+        self._spec = InputSpec.from_image_processor(pipe.image_processor)
+        if self._spec is None:
+            logger.warning(
+                'Image processor is not supported for tensor preprocessing, using the pipeline',
+                model=self._model.name_or_path,
+                processor=type(pipe.image_processor).__name__,
+            )
+
+        model_config = self._model.config
+        self._labels: dict[int, str] = model_config.id2label
+        # Same activation the pipeline picks by default.
+        self._sigmoid = (
+            model_config.problem_type == 'multi_label_classification'
+            or model_config.num_labels == 1
+        )
+
+    @property
+    def label_ids(self) -> dict[str, int]:
+        return {label: idx for idx, label in self._labels.items()}
+
+    @property
+    def modules(self) -> list[nn.Module]:
+        return [self._model]
+
+    def __call__(self, batch: DecodedBatch) -> list[list[dict[str, str | float]]]:
+        name = self._model.name_or_path
+        if self._spec is None:
+            with time_stage(name, 'forward'):
+                return self._pipe(batch.images, batch_size=len(batch.images))  # type: ignore[return-value]
+
+        device = self._model.device
+        with device_stage(name, 'preprocess', device):
+            pixel_values = self._spec.build(batch.pixels, dtype=self._model.dtype)
+        with device_stage(name, 'forward', device):
+            scores = self._forward(self._model, pixel_values)
+        with device_stage(name, 'postprocess', device):
+            outputs = [
+                sorted(
+                    ({'label': self._labels[idx], 'score': score} for idx, score in enumerate(row)),
+                    key=itemgetter('score'),
+                    reverse=True,
+                )
+                for row in scores.cpu().tolist()
+            ]
+        record_device_stages()
+        return outputs
+
+    def quantize(
+        self,
+        reference: DecodedBatch,
+        decide: Callable[[torch.Tensor], torch.Tensor] | None = None,
+    ) -> None:
+        """Switch to int8 linear layers if scores on `reference` stay close to FP32.
+
+        `decide` maps scores to the boolean decisions made from them downstream, whose
+        flips are checked as well.
+        """
+        name = self._model.name_or_path
+        if self._spec is None:
+            logger.warning('Quantization needs tensor preprocessing, keeping FP32', model=name)
+            record_quantization(name, 'none')
+            return
+
+        quantized = quantize_linear_layers(self._model)
+        expected = self._scores(self._model, reference)
+        actual = self._scores(quantized, reference)
+
+        flips = flip_rate(decide(expected), decide(actual)) if decide else 0.0
+        max_diff = (actual - expected).abs().max().item()
+        if accept_quantized(name, max_diff=max_diff, flips=flips):
+            # The pipeline holds the model too; swap it there as well so the FP32
+            # weights can be freed.
+            self._model = self._pipe.model = quantized
+
+    def _scores(self, model: PreTrainedModel, batch: DecodedBatch) -> torch.Tensor:
+        assert self._spec is not None
+        return self._forward(model, self._spec.build(batch.pixels, dtype=model.dtype))
+
+    def _forward(self, model: PreTrainedModel, pixel_values: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            logits = model(pixel_values=pixel_values).logits.float()
+
+        return logits.sigmoid() if self._sigmoid else logits.softmax(dim=-1)
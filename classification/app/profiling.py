@@ -0,0 +1,209 @@
+"""Per-request torch.profiler traces.
+
+An inference request is profiled when it sends `X-Profile-Token` matching
+`ADMIN_API_TOKEN`, or at random at `PROFILE_SAMPLE_RATE`. Each profile is saved as a
+Chrome trace (open it in Perfetto or chrome://tracing) under `PROFILE_TRACE_DIR`, where
+only the newest `PROFILE_MAX_TRACES` are kept. Trace paths are added to the request span,
+and the most expensive operators are logged once the trace is saved.
+
+The profiler records the thread it runs on, so every model call of a profiled request is
+profiled on the executor thread that runs it, from start to end; a batched call also
+covers the other requests in its batch. Saving and summarizing the trace happen on a
+background thread afterwards, so results aren't held back by them. Only one call is
+profiled at a time, until its trace is saved, and calls made meanwhile go unprofiled.
+With a model host, workers load no torch: the host profiles the calls instead and
+returns their trace paths with the responses. Results served from the cache involve no
+model work to profile.
+"""
+
+from __future__ import annotations
+
+import random
+import secrets
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+from uuid import uuid4
+
+import structlog
+
+from app.config import config
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator
+
+    from opentelemetry.trace import Span
+    from torch.profiler import profile
+
+PROFILE_HEADER = 'X-Profile-Token'
+TOP_OPERATORS = 15
+
+logger = structlog.get_logger()
+
+# Held from the start of a profile until its trace is saved, so at most one profiler's
+# events are in memory.
+_lock = threading.Lock()
+_exporter = ThreadPoolExecutor(1, thread_name_prefix='profile-export')
+
+
+@dataclass
+class ProfileSummary:
+    # Saved in the background; the file may not exist yet when the request completes.
+    trace_path: str
+
+
+# Summaries of the model calls made by a profiled request; unset outside of one.
+request_profiles: ContextVar[list[ProfileSummary] | None] = ContextVar(
+    'request_profiles',
+    default=None,
+)
+
+
+def profile_requested(token: str | None) -> bool:
+    if token and config.ADMIN_API_TOKEN:
+        return secrets.compare_digest(token, config.ADMIN_API_TOKEN)
+    return random.random() < config.PROFILE_SAMPLE_RATE
+
+
+def _start() -> profile:
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    # Python stacks attribute operators to the model code (e.g. ImageTagger.forward)
+    # that launched them; shapes tell resizes and batch sizes apart.
+    profiler = profile(activities=activities, record_shapes=True, with_stack=True)
+    profiler.start()
+    return profiler
+
+
+def _finish(profiler: profile) -> ProfileSummary:
+    profiler.stop()
+
+    directory = Path(config.PROFILE_TRACE_DIR or Path(tempfile.gettempdir()) / 'profiles')
+    # Request ids come from clients, so they're kept out of file names.
+    path = directory / f'profile-{datetime.now(UTC):%Y%m%dT%H%M%S.%f}-{uuid4().hex[:8]}.json'
+    # Exporting the trace and aggregating its events can take longer than the call that
+    # was profiled, so neither runs on the executor thread.
+    _exporter.submit(_save, profiler, path)
+    return ProfileSummary(trace_path=str(path))
+
+
+def _save(profiler: profile, path: Path) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.export_chrome_trace(str(path))
+        prune_traces(path.parent, config.PROFILE_MAX_TRACES)
+        logger.info('Profile saved', trace_path=str(path), top_operators=_top_operators(profiler))
+    except Exception:
+        logger.exception('Failed to save profile', trace_path=str(path))
+    finally:
+        _lock.release()
+
+
+def _top_operators(profiler: profile) -> list[str]:
+    """`<operator> self=<ms> total=<ms> calls=<n>` of the costliest operators, in order."""
+    import torch
+
+    # Accelerator kernels run asynchronously, so their time is what matters on a GPU.
+    device = torch.cuda.is_available()
+    self_time = 'self_device_time_total' if device else 'self_cpu_time_total'
+    total_time = 'device_time_total' if device else 'cpu_time_total'
+    events = sorted(
+        profiler.key_averages(),
+        key=lambda event: getattr(event, self_time),
+        reverse=True,
+    )
+    return [
+        f'{event.key} self={getattr(event, self_time) / 1000:.2f}ms '
+        f'total={getattr(event, total_time) / 1000:.2f}ms calls={event.count}'
+        for event in events[:TOP_OPERATORS]
+    ]
+
+
+def prune_traces(directory: Path, keep: int) -> None:
+    """Delete all but the newest `keep` traces in `directory`."""
+    # Names start with a UTC timestamp, so they sort oldest first.
+    traces = sorted(directory.glob('profile-*.json'))
+    for trace_path in traces[: max(0, len(traces) - keep)]:
+        # Workers sharing the directory prune it concurrently.
+        trace_path.unlink(missing_ok=True)
+
+
+@contextmanager
+def torch_profile() -> Generator[list[ProfileSummary]]:
+    """Profile the current thread until exit; the yielded list then holds the summary.
+
+    It stays empty if another profile was still running or being saved.
+    """
+    summaries: list[ProfileSummary] = []
+    if not _lock.acquire(blocking=False):
+        logger.debug('Profile skipped, another one is in progress')
+        yield summaries
+        return
+
+    # A failing profiler is logged rather than failing the call it was meant to trace.
+    try:
+        profiler = _start()
+    except Exception:
+        logger.exception('Failed to start profiler')
+        _lock.release()
+        yield summaries
+        return
+
+    try:
+        yield summaries
+    finally:
+        try:
+            summaries.append(_finish(profiler))
+        except Exception:
+            # Released by `_save` otherwise.
+            logger.exception('Failed to save profile')
+            _lock.release()
+
+
+def run_profiled[**P, R](func: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    """Call `func`, profiling it if it runs on behalf of a profiled request.
+
+    Must run on the thread that does the model work, started and stopped there.
+    """
+    profiles = request_profiles.get()
+    if profiles is None:
+        return func(*args, **kwargs)
+
+    summaries: list[ProfileSummary] = []
+    try:
+        with torch_profile() as summaries:
+            return func(*args, **kwargs)
+    finally:
+        # The list is shared with the request through the copied context.
+        profiles.extend(summaries)
+
+
+@contextmanager
+def profile_request() -> Generator[list[ProfileSummary]]:
+    """Profile the model calls of the current request; the yielded list holds summaries."""
+    summaries: list[ProfileSummary] = []
+    token = request_profiles.set(summaries)
+    try:
+        yield summaries
+    finally:
+        request_profiles.reset(token)
+
+
+def record_profiles(span: Span, summaries: list[ProfileSummary], **log_fields: Any) -> None:
+    if not summaries:
+        return
+
+    trace_paths = [summary.trace_path for summary in summaries]
+    span.set_attribute('profile.trace_paths', trace_paths)
+    # Top operators follow in a 'Profile saved' entry per trace path.
+    logger.info('Request profiled', trace_paths=trace_paths, **log_fields)
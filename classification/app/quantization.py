@@ -0,0 +1,114 @@
+"""Int8 dynamic quantization for CPU inference.
+
+Linear layer weights are stored as int8 and activations are quantized on the fly,
+which cuts their memory by 4x and runs them through int8 GEMM kernels. Before a
+quantized model replaces its FP32 original, both run on a fixed reference set. The
+swap happens only if outputs stay close, and if threshold decisions (is_nsfw, Camie
+tags) rarely flip.
+"""
+
+from __future__ import annotations
+
+import copy
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import structlog
+import torch
+from PIL import Image
+from torch import nn
+
+from app.config import config
+from app.utils import decode_image, warmup_image
+
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
+    from torch import Tensor
+
+logger = structlog.get_logger()
+
+# Tag strings and search queries shaped like real traffic for the text tower check.
+REFERENCE_TEXTS = (
+    'hatsune miku, 1girl, solo, long hair, twintails, aqua hair, smile',
+    'landscape, mountains, sunrise, clouds, no humans, scenery',
+    'girl with an umbrella in the rain',
+    'cat sleeping on a windowsill',
+    'メイド服の女の子',
+)
+
+_SYNTHETIC_REFERENCE_SIZE = 512
+
+
+def quantization_enabled(device: str) -> bool:
+    return config.CPU_QUANTIZATION == 'int8' and device == 'cpu'
+
+
+def applied_quantization(name: str, device: str) -> str | None:
+    """The mode model `name` on `device` runs with, or None before its first load.
+
+    An int8 model that drifts too far keeps FP32, so this can differ from
+    `CPU_QUANTIZATION`. The decision outlives an idle unload, since reloading repeats
+    the same comparison on the same reference set.
+    """
+    if not quantization_enabled(device):
+        return 'none'
+    return _applied_modes.get(name)
+
+
+def record_quantization(name: str, mode: str) -> None:
+    _applied_modes[name] = mode
+
+
+_applied_modes: dict[str, str] = {}
+
+
+def quantize_linear_layers[M: nn.Module](module: M) -> M:
+    """Copy of `module` with every `nn.Linear` replaced by a dynamic int8 one."""
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(module),
+        {nn.Linear},
+        dtype=torch.qint8,
+    )
+
+
+def reference_images() -> list[PILImage]:
+    """Images from `QUANTIZATION_REFERENCE_DIR`, or a small synthetic set without it."""
+    if config.QUANTIZATION_REFERENCE_DIR:
+        paths = sorted(p for p in Path(config.QUANTIZATION_REFERENCE_DIR).iterdir() if p.is_file())
+        return [decode_image(path.read_bytes()) for path in paths]
+
+    # Noise and gradients at least cover the full input range of every model.
+    generator = torch.Generator().manual_seed(0)
+    size = _SYNTHETIC_REFERENCE_SIZE
+    noise = torch.randint(0, 256, (size, size, 3), dtype=torch.uint8, generator=generator)
+    gradient = torch.linspace(0, 255, size).to(torch.uint8).expand(size, size)
+    return [
+        warmup_image(),
+        Image.fromarray(noise.numpy()),
+        Image.merge('RGB', [Image.fromarray(gradient.numpy())] * 3),
+        Image.fromarray(gradient.T.contiguous().numpy()).convert('RGB'),
+    ]
+
+
+def flip_rate(expected: Tensor, actual: Tensor) -> float:
+    """Share of positive decisions (in either output) that differ between the two."""
+    flipped = (expected != actual).sum().item()
+    positive = (expected | actual).sum().item()
+    return flipped / positive if positive else 0.0
+
+
+def accept_quantized(name: str, *, max_diff: float, flips: float = 0.0) -> bool:
+    acceptable = (
+        max_diff <= config.QUANTIZATION_MAX_DRIFT and flips <= config.QUANTIZATION_MAX_FLIP_RATE
+    )
+    record_quantization(name, config.CPU_QUANTIZATION if acceptable else 'none')
+    log = logger.info if acceptable else logger.error
+    log(
+        'Using int8 model' if acceptable else 'Int8 model drifts from FP32, keeping FP32',
+        model=name,
+        max_diff=max_diff,
+        flip_rate=flips,
+        max_drift=config.QUANTIZATION_MAX_DRIFT,
+        max_flip_rate=config.QUANTIZATION_MAX_FLIP_RATE,
+    )
+    return acceptable
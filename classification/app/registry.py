@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import asyncio
+import gc
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING, Any
+
+import structlog
+import torch
+
+from app.config import config
+from app.metrics import MetricFamily, Sample, register_collector
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator, Iterable
+
+    from torch import nn
+
+logger = structlog.get_logger()
+
+
+@dataclass
+class ModelStats:
+    loaded: bool
+    loads: int
+    in_use: int
+    idle_seconds: float | None
+    devices: list[str]
+    memory_bytes: int
+
+
+class ManagedModel[M]:
+    """A model loaded on first use and released again after sitting idle.
+
+    Callers hold the model through `use()` for the duration of a forward, so it's never
+    unloaded from under a running batch. `modules` lists the torch modules of a loaded
+    model for memory reporting.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        load: Callable[[], M],
+        modules: Callable[[M], Iterable[nn.Module]],
+    ) -> None:
+        self.name = name
+        self._load = load
+        self._modules = modules
+        self._model: M | None = None
+        # `_lock` guards the fields below and is only held briefly; `_load_lock`
+        # serializes loads, which can take minutes, so stats and the idle unloader
+        # never wait on one.
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._in_use = 0
+        self._loads = 0
+        self._last_used = monotonic()
+
+        _models.append(self)
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @contextmanager
+    def use(self) -> Generator[M]:
+        if (model := self._acquire()) is None:
+            with self._load_lock:
+                # Another caller may have loaded it while this one waited.
+                if (model := self._acquire()) is None:
+                    model = self._load_and_acquire()
+
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                self._last_used = monotonic()
+
+    def _acquire(self) -> M | None:
+        with self._lock:
+            if self._model is not None:
+                self._in_use += 1
+            return self._model
+
+    def _load_and_acquire(self) -> M:
+        start = perf_counter()
+        model = self._load()
+        with self._lock:
+            # Published already in use, so the idle unloader can't drop it first.
+            self._model = model
+            self._loads += 1
+            self._in_use += 1
+        logger.info('Model loaded', model=self.name, duration_ms=(perf_counter() - start) * 1000)
+        return model
+
+    def unload_if_idle(self, idle_seconds: float) -> bool:
+        with self._lock:
+            if self._model is None or self._in_use:
+                return False
+            if monotonic() - self._last_used < idle_seconds:
+                return False
+            self._model = None
+        return True
+
+    def stats(self) -> ModelStats:
+        with self._lock:
+            model, in_use, loads = self._model, self._in_use, self._loads
+            idle_seconds = None if in_use else monotonic() - self._last_used
+
+        tensors = _tensors(self._modules(model)) if model is not None else []
+        return ModelStats(
+            loaded=model is not None,
+            loads=loads,
+            in_use=in_use,
+            idle_seconds=idle_seconds,
+            devices=sorted({str(tensor.device) for tensor in tensors}),
+            memory_bytes=sum(tensor.numel() * tensor.element_size() for tensor in tensors),
+        )
+
+
+def _tensors(modules: Iterable[nn.Module]) -> list[torch.Tensor]:
+    # state_dict rather than parameters(), so int8 packed weights are counted too.
+    # Tensors shared between modules (a pipeline and its quantized copy's untouched
+    # layers) are counted once.
+    seen: set[tuple[str, int]] = set()
+    tensors: list[torch.Tensor] = []
+    pending: list[Any] = [value for module in modules for value in module.state_dict().values()]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (tuple, list)):
+            pending.extend(value)
+        elif isinstance(value, torch.Tensor):
+            key = (str(value.device), value.data_ptr())
+            if key not in seen:
+                seen.add(key)
+                tensors.append(value)
+    return tensors
+
+
+_models: list[ManagedModel[Any]] = []
+
+
+def model_stats() -> dict[str, ModelStats]:
+    return {model.name: model.stats() for model in _models}
+
+
+def unload_idle_models(idle_seconds: float) -> list[str]:
+    unloaded = [model.name for model in _models if model.unload_if_idle(idle_seconds)]
+    if unloaded:
+        # Drop the last references now rather than whenever the next GC cycle runs, and
+        # hand the freed blocks back to the driver so other services can use them.
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info('Unloaded idle models', models=unloaded, idle_seconds=idle_seconds)
+    return unloaded
+
+
+async def run_idle_unloader() -> None:
+    """Periodically unload models unused for `MODEL_IDLE_UNLOAD_SECONDS`."""
+    idle_seconds = config.MODEL_IDLE_UNLOAD_SECONDS
+    if idle_seconds is None:
+        return
+
+    interval = min(max(idle_seconds / 4, 1.0), 60.0)
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(unload_idle_models, idle_seconds)
+
+
+def _memory_families() -> list[MetricFamily]:
+    stats = model_stats()
+    families = [
+        MetricFamily(
+            'starlight_model_loaded',
+            'gauge',
+            'Whether a model is currently loaded.',
+            [Sample({'model': name}, float(model.loaded)) for name, model in stats.items()],
+        ),
+        MetricFamily(
+            'starlight_model_memory_bytes',
+            'gauge',
+            "Bytes held by a loaded model's weights and buffers.",
+            [Sample({'model': name}, model.memory_bytes) for name, model in stats.items()],
+        ),
+    ]
+    if torch.cuda.is_available():
+        readers = (
+            ('allocated', torch.cuda.memory_allocated),
+            ('reserved', torch.cuda.memory_reserved),
+        )
+        samples = [
+            Sample({'device': f'cuda:{index}', 'kind': kind}, read(index))
+            for index in range(torch.cuda.device_count())
+            for kind, read in readers
+        ]
+        families.append(
+            MetricFamily(
+                'starlight_device_memory_bytes',
+                'gauge',
+                'Accelerator memory allocated by tensors and reserved by the caching allocator.',
+                samples,
+            ),
+        )
+    return families
+
+
+register_collector(_memory_families)
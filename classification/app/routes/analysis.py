@@ -0,0 +1,86 @@
+import asyncio
+from typing import TYPE_CHECKING, Annotated
+
+import structlog
+from fastapi import APIRouter, Body, HTTPException, Request
+
+from app.cache import image_digest, result_cache
+from app.models import (
+    AnalysisResponse,
+    EmbeddingPayload,
+    EmbeddingResponse,
+    EncodingMode,
+    ImageRequest,
+)
+from app.routes.classification import classify_image
+from app.routes.embeddings import encode_image, encode_text
+from app.utils import UPLOAD_OPENAPI_EXTRA, preprocess_image, preprocess_upload
+
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
+
+logger = structlog.get_logger()
+
+router = APIRouter()
+
+
+async def analyze_image(img: PILImage) -> AnalysisResponse:
+    # Hash the pixels once for both result cache lookups.
+    pixels_digest = await asyncio.to_thread(image_digest, img) if result_cache.enabled else None
+
+    classification, image_embedding = await asyncio.gather(
+        classify_image(img, pixels_digest),
+        encode_image(img, EncodingMode.DOCUMENT, pixels_digest),
+    )
+
+    # Same tag text the embeddings worker builds: characters first, then tags.
+    payload = EmbeddingPayload(tags=[*classification.characters, *classification.tags])
+    text_embedding = await encode_text(payload.text, payload.encoding_mode)
+
+    return AnalysisResponse(
+        classification=classification,
+        embeddings=EmbeddingResponse(
+            image=image_embedding.tolist(),
+            text=text_embedding.tolist(),
+        ),
+    )
+
+
+@router.post('/analyze')
+async def analyze(
+    request: Request,
+    image: Annotated[
+        ImageRequest,
+        Body(
+            description='Classify an image and embed it with its tags in one call. Provide JSON {"image": "<base64, URL or file:// path>"}',
+            examples=[
+                {'image': 'https://example.com/image.png'},
+            ],
+        ),
+    ],
+) -> AnalysisResponse:
+    try:
+        # Download and decode once, then share the image between every model.
+        img = await preprocess_image(image.image, request.app.state.http_session)
+        return await analyze_image(img)
+    except HTTPException:
+        raise
+    except Exception as e:  # pragma: no cover
+        logger.exception('Image analysis failed', error=e)
+        raise HTTPException(status_code=500, detail=f'Image analysis failed: {e}') from e
+
+
+@router.post(
+    '/analyze/upload',
+    openapi_extra=UPLOAD_OPENAPI_EXTRA,
+)
+async def analyze_upload(request: Request) -> AnalysisResponse:
+    """Analyze an image sent as the raw request body, without base64 encoding."""
+    try:
+        img = await preprocess_upload(request)
+        return await analyze_image(img)
+    except HTTPException:
+        raise
+    except Exception as e:  # pragma: no cover
+        logger.exception('Image analysis failed', error=e)
+        raise HTTPException(status_code=500, detail=f'Image analysis failed: {e}') from e
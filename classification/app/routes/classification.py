@@ -1,93 +1,113 @@
-from typing import Annotated, Any
+import asyncio
+from typing import TYPE_CHECKING, Annotated
 
 import structlog
-import torch
 from fastapi import APIRouter, Body, HTTPException, Request
-from transformers import AutoImageProcessor, AutoModelForImageClassification
-from transformers.pipelines import ImageClassificationPipeline, pipeline
 
-from app.device import resolve_model_device
-from app.imgutils.camie import get_camie_tags
-from app.models import ClassificationResult, ImageRequest
-from app.otel import pipeline_span
-from app.utils import preprocess_image
+from app.config import config
+from app.models import (
+    BatchClassificationResponse,
+    BatchImageRequest,
+    ClassificationError,
+    ClassificationResult,
+    ImageRequest,
+)
+from app.utils import UPLOAD_OPENAPI_EXTRA, preprocess_image, preprocess_upload
 
-logger = structlog.get_logger()
-model_device = resolve_model_device()
-
-NSFW_MODEL_ID = 'Freepik/nsfw_image_detector'
-AESTHETIC_MODEL_ID = 'cafeai/cafe_aesthetic'
-STYLE_MODEL_ID = 'cafeai/cafe_style'
-
-
-def create_classification_pipeline(
-    model_id: str,
-    dtype: torch.dtype,
-) -> ImageClassificationPipeline:
-    image_processor = AutoImageProcessor.from_pretrained(model_id, use_fast=False)
-    model = AutoModelForImageClassification.from_pretrained(model_id, torch_dtype=dtype)
-    return pipeline(
-        'image-classification',
-        model=model,
-        image_processor=image_processor,
-        device=model_device,
-    )
+if config.MODEL_HOST_SOCKET:
+    from app.model_client import classify_image
+else:
+    from app.services.classification import classify_image
 
+if TYPE_CHECKING:
+    from niquests import AsyncSession
 
-classification_dtype = torch.float16 if model_device == 'cuda' else torch.float32
-# BF16 has the same 8-bit exponent as FP32, so downcasting the FP32 checkpoint is
-# less likely to overflow or underflow intermediate activations than FP16's 5-bit
-# exponent. This is preferable for threshold-sensitive NSFW scores, and costs no
-# extra model memory over FP16 because both use 16 bits and run natively on ROCm.
-nsfw_dtype = torch.bfloat16 if model_device == 'cuda' else torch.float32
-
-nsfw_pipe = create_classification_pipeline(NSFW_MODEL_ID, nsfw_dtype)
-aesthetic_pipe = create_classification_pipeline(AESTHETIC_MODEL_ID, classification_dtype)
-style_pipe = create_classification_pipeline(STYLE_MODEL_ID, classification_dtype)
-
+logger = structlog.get_logger()
 
 router = APIRouter()
 
 
-def classify_nsfw(image: Any) -> list[dict[str, str | float]]:
-    return nsfw_pipe(image)  # type: ignore[return-value]
-
-
 @router.post('/classify')
 async def classify(
     request: Request,
     image: Annotated[
         ImageRequest,
         Body(
-            description='Image to classify. Provide JSON {"image": "<base64 or URL>"}',
+            description='Image to classify. Provide JSON {"image": "<base64, URL or file:// path>"}',
             examples=[
                 {'image': 'data:image/png;base64,iVBORw0KGgoAAA...'},
                 {'image': 'https://example.com/image.png'},
+                {'image': 'file:///mnt/images/image.png'},
             ],
         ),
     ],
 ) -> ClassificationResult:
     try:
         img = await preprocess_image(image.image, request.app.state.http_session)
-        with pipeline_span('nsfw_classification', NSFW_MODEL_ID):
-            nsfw_outputs = classify_nsfw(img)
+        return await classify_image(img)
+    except HTTPException:
+        raise
+    except Exception as e:  # pragma: no cover
+        logger.exception('Model inference failed', error=e)
+        raise HTTPException(status_code=500, detail=f'Model inference failed: {e}') from e
 
-        with pipeline_span('aesthetic_classification', AESTHETIC_MODEL_ID):
-            aestetic_outputs = aesthetic_pipe(img)
 
-        with pipeline_span('style_classification', STYLE_MODEL_ID):
-            style_outputs = style_pipe(img)
+@router.post(
+    '/classify/upload',
+    openapi_extra=UPLOAD_OPENAPI_EXTRA,
+)
+async def classify_upload(request: Request) -> ClassificationResult:
+    """Classify an image sent as the raw request body, without base64 encoding."""
+    try:
+        img = await preprocess_upload(request)
+        return await classify_image(img)
+    except HTTPException:
+        raise
+    except Exception as e:  # pragma: no cover
+        logger.exception('Model inference failed', error=e)
+        raise HTTPException(status_code=500, detail=f'Model inference failed: {e}') from e
 
-        with pipeline_span('tag_generation', 'Camais03/camie-tagger-v2'):
-            tags = get_camie_tags(img)
 
-        return ClassificationResult.from_response(
-            model_response={
-                'cafe': {'aesthetic': aestetic_outputs, 'style': style_outputs},
-                'nsfw': nsfw_outputs,
-                'tags': tags,
-            },
-        )
+async def classify_item(
+    image: str,
+    session: AsyncSession,
+) -> ClassificationResult | ClassificationError:
+    try:
+        img = await preprocess_image(image, session)
+        return await classify_image(img)
+    except HTTPException as e:
+        return ClassificationError(status_code=e.status_code, detail=str(e.detail))
     except Exception as e:  # pragma: no cover
         logger.exception('Model inference failed', error=e)
-        raise HTTPException(status_code=500, detail=f'Model inference failed: {e}') from e
+        return ClassificationError(status_code=500, detail=f'Model inference failed: {e}')
+
+
+@router.post('/classify/batch')
+async def classify_batch_images(
+    request: Request,
+    payload: Annotated[
+        BatchImageRequest,
+        Body(
+            description='Images to classify. Provide JSON {"images": ["<base64 or URL>", ...]}',
+            examples=[
+                {
+                    'images': [
+                        'https://example.com/first.png',
+                        'https://example.com/second.png',
+                    ],
+                },
+            ],
+        ),
+    ],
+) -> BatchClassificationResponse:
+    if len(payload.images) > config.CLASSIFY_BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f'Too many images: at most {config.CLASSIFY_BATCH_MAX_IMAGES} per request',
+        )
+
+    # Downloads run concurrently and each image joins the shared batcher as soon as it
+    # is decoded, so the whole request is served by a few batched forwards.
+    session = request.app.state.http_session
+    results = await asyncio.gather(*(classify_item(image, session) for image in payload.images))
+    return BatchClassificationResponse(results=results)
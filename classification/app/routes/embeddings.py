@@ -1,32 +1,26 @@
 from typing import TYPE_CHECKING, Annotated
 
 import structlog
-import torch
 from fastapi import APIRouter, Body, HTTPException, Request
-from sentence_transformers import SentenceTransformer
 
-from app.device import resolve_model_device
-from app.models import EmbeddingPayload, EmbeddingResponse
-from app.otel import pipeline_span
+from app.config import config
+from app.models import (
+    EmbeddingPayload,
+    EmbeddingResponse,
+    QueryEmbeddingPayload,
+    TextEmbeddingResponse,
+)
 from app.utils import preprocess_image
 
+if config.MODEL_HOST_SOCKET:
+    from app.model_client import encode_image, encode_query, encode_text
+else:
+    from app.services.embeddings import encode_image, encode_query, encode_text
+
 if TYPE_CHECKING:
     from numpy import ndarray
 
 logger = structlog.get_logger()
-model_device = resolve_model_device()
-
-
-embedding_model = SentenceTransformer(
-    'jinaai/jina-clip-v2',
-    trust_remote_code=True,
-    truncate_dim=1024,
-    device=model_device,
-    config_kwargs={
-        'use_text_flash_attn': False,
-        'use_vision_xformers': False,
-    },
-)
 
 router = APIRouter()
 
@@ -49,32 +43,40 @@ async def embeddings(
 ) -> EmbeddingResponse:
     try:
         # Always encode text
-        with pipeline_span('text_embedding', 'jinaai/jina-clip-v2', payload.encoding_mode):
-            emb_text_vec: ndarray = embedding_model.encode(
-                [payload.text],
-                prompt_name=payload.encoding_mode.value,
-                normalize_embeddings=True,
-            )
+        emb_text_vec = await encode_text(payload.text, payload.encoding_mode)
 
-        emb_image: ndarray | None = None  # pyright: ignore[reportAssignmentType]
+        emb_image: ndarray | None = None
 
         if payload.image:
-            with torch.no_grad():
-                img = await preprocess_image(payload.image.strip(), request.app.state.http_session)
-
-                with pipeline_span('image_embedding', 'jinaai/jina-clip-v2', payload.encoding_mode):
-                    emb_image: ndarray = embedding_model.encode(
-                        [img],
-                        prompt_name=payload.encoding_mode.value,
-                        normalize_embeddings=True,
-                    )  # pyright: ignore[reportCallIssue, reportArgumentType]
+            img = await preprocess_image(payload.image.strip(), request.app.state.http_session)
+            emb_image = await encode_image(img, payload.encoding_mode)
 
         return EmbeddingResponse(
-            image=emb_image[0].tolist() if emb_image is not None else None,
-            text=emb_text_vec[0].tolist(),
+            image=emb_image.tolist() if emb_image is not None else None,
+            text=emb_text_vec.tolist(),
         )
     except HTTPException:
         raise
     except Exception as e:  # pragma: no cover
         logger.exception('Embedding generation failed')
         raise HTTPException(status_code=500, detail=f'Embedding generation failed: {e}') from e
+
+
+@router.post('/embeddings/query')
+async def query_embeddings(
+    payload: Annotated[
+        QueryEmbeddingPayload,
+        Body(
+            description='Create a search query embedding. Text only; concurrent queries are batched on a dedicated pool.',
+            examples=[{'query': 'hatsune miku in the rain'}],
+        ),
+    ],
+) -> TextEmbeddingResponse:
+    try:
+        vector = await encode_query(payload.query)
+        return TextEmbeddingResponse(text=vector.tolist())
+    except HTTPException:
+        raise
+    except Exception as e:  # pragma: no cover
+        logger.exception('Query embedding failed')
+        raise HTTPException(status_code=500, detail=f'Query embedding failed: {e}') from e
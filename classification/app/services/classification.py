@@ -0,0 +1,198 @@
+import asyncio
+from functools import partial
+from operator import attrgetter
+from typing import TYPE_CHECKING
+
+import structlog
+import torch
+from transformers import AutoImageProcessor, AutoModelForImageClassification
+from transformers.pipelines import ImageClassificationPipeline, pipeline
+
+from app.batching import MicroBatcher
+from app.cache import CacheNamespace, image_digest, result_cache
+from app.config import config
+from app.device import resolve_model_device
+from app.imgutils.camie import (
+    DEFAULT_CHARACTER_THRESHOLD,
+    DEFAULT_GENERAL_THRESHOLD,
+    DEFAULT_TOP_K,
+    camie_inputs,
+    get_camie_tags_from_tensor,
+)
+from app.models import NSFW_THRESHOLD, ClassificationResult
+from app.otel import pipeline_span
+from app.preprocessing import PREPROCESSING_VERSION, DecodedBatch, TensorImageClassifier
+from app.quantization import applied_quantization, quantization_enabled, reference_images
+from app.registry import ManagedModel
+from app.utils import warmup_image
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from PIL.Image import Image as PILImage
+
+logger = structlog.get_logger()
+model_device = resolve_model_device()
+
+NSFW_MODEL_ID = 'Freepik/nsfw_image_detector'
+AESTHETIC_MODEL_ID = 'cafeai/cafe_aesthetic'
+STYLE_MODEL_ID = 'cafeai/cafe_style'
+CAMIE_MODEL_ID = 'Camais03/camie-tagger-v2'
+
+
+def create_classification_pipeline(
+    model_id: str,
+    dtype: torch.dtype,
+) -> ImageClassificationPipeline:
+    image_processor = AutoImageProcessor.from_pretrained(model_id, use_fast=False)
+    model = AutoModelForImageClassification.from_pretrained(model_id, torch_dtype=dtype)
+    return pipeline(
+        'image-classification',
+        model=model,
+        image_processor=image_processor,
+        device=model_device,
+    )
+
+
+classification_dtype = torch.float16 if model_device == 'cuda' else torch.float32
+# BF16 has the same 8-bit exponent as FP32, so downcasting the FP32 checkpoint is
+# less likely to overflow or underflow intermediate activations than FP16's 5-bit
+# exponent. This is preferable for threshold-sensitive NSFW scores, and costs no
+# extra model memory over FP16 because both use 16 bits and run natively on ROCm.
+nsfw_dtype = torch.bfloat16 if model_device == 'cuda' else torch.float32
+
+
+def load_classifier(
+    model_id: str,
+    dtype: torch.dtype,
+    decide: Callable[[torch.Tensor, dict[str, int]], torch.Tensor] | None = None,
+) -> TensorImageClassifier:
+    # The pipeline only supplies the model and its processor parameters; inputs are
+    # built from one shared device copy of each image instead of per-pipeline PIL work.
+    classifier = TensorImageClassifier(create_classification_pipeline(model_id, dtype))
+    if quantization_enabled(model_device):
+        reference = DecodedBatch.from_images(reference_images(), model_device)
+        classifier.quantize(
+            reference,
+            partial(decide, label_ids=classifier.label_ids) if decide else None,
+        )
+    return classifier
+
+
+def is_nsfw(scores: torch.Tensor, label_ids: dict[str, int]) -> torch.Tensor:
+    # Same decision as `NSFWResult.is_nsfw`, on a batch of score rows.
+    return scores[:, [label_ids['high'], label_ids['medium']]].sum(dim=-1) >= NSFW_THRESHOLD
+
+
+nsfw_model = ManagedModel(
+    NSFW_MODEL_ID,
+    partial(load_classifier, NSFW_MODEL_ID, nsfw_dtype, is_nsfw),
+    attrgetter('modules'),
+)
+aesthetic_model = ManagedModel(
+    AESTHETIC_MODEL_ID,
+    partial(load_classifier, AESTHETIC_MODEL_ID, classification_dtype),
+    attrgetter('modules'),
+)
+style_model = ManagedModel(
+    STYLE_MODEL_ID,
+    partial(load_classifier, STYLE_MODEL_ID, classification_dtype),
+    attrgetter('modules'),
+)
+
+
+def classify_batch(images: list[PILImage]) -> list[ClassificationResult]:
+    with pipeline_span('image_preprocessing'):
+        batch = DecodedBatch.from_images(images, model_device)
+
+    with pipeline_span('nsfw_classification', NSFW_MODEL_ID), nsfw_model.use() as nsfw_classifier:
+        nsfw_outputs = nsfw_classifier(batch)
+
+    with (
+        pipeline_span('aesthetic_classification', AESTHETIC_MODEL_ID),
+        aesthetic_model.use() as aesthetic_classifier,
+    ):
+        aestetic_outputs = aesthetic_classifier(batch)
+
+    with (
+        pipeline_span('style_classification', STYLE_MODEL_ID),
+        style_model.use() as style_classifier,
+    ):
+        style_outputs = style_classifier(batch)
+
+    with pipeline_span('tag_generation', CAMIE_MODEL_ID):
+        tags = get_camie_tags_from_tensor(camie_inputs(batch.pixels))
+
+    return [
+        ClassificationResult.from_response(
+            model_response={
+                'cafe': {'aesthetic': aesthetic, 'style': style},
+                'nsfw': nsfw,
+                'tags': image_tags,
+            },
+        )
+        for nsfw, aesthetic, style, image_tags in zip(
+            nsfw_outputs,
+            aestetic_outputs,
+            style_outputs,
+            tags,
+            strict=True,
+        )
+    ]
+
+
+classification_batcher = MicroBatcher('classification', classify_batch)
+
+
+def warmup() -> None:
+    # Loads every model and compiles Camie's tag tables, which otherwise happens on the
+    # first request.
+    image = warmup_image()
+    for batch_size in sorted({1, config.BATCH_MAX_SIZE}):
+        classify_batch([image] * batch_size)
+
+
+def classification_cache() -> CacheNamespace | None:
+    """Namespace of results from the models as loaded, or None before they first load.
+
+    Built per call rather than at import: whether each model kept its int8 weights is
+    only decided when it loads.
+    """
+    modes = [
+        applied_quantization(model_id, model_device)
+        for model_id in (NSFW_MODEL_ID, AESTHETIC_MODEL_ID, STYLE_MODEL_ID, CAMIE_MODEL_ID)
+    ]
+    if None in modes:
+        return None
+
+    return CacheNamespace.create(
+        'classification',
+        NSFW_MODEL_ID,
+        AESTHETIC_MODEL_ID,
+        STYLE_MODEL_ID,
+        CAMIE_MODEL_ID,
+        # Results differ slightly between dtypes and with int8 weights, and the disk tier
+        # outlives a configuration change.
+        f'dtype={classification_dtype}',
+        f'nsfw_dtype={nsfw_dtype}',
+        *(f'quantization={mode}' for mode in modes),
+        f'preprocessing={PREPROCESSING_VERSION}',
+        f'general_threshold={DEFAULT_GENERAL_THRESHOLD}',
+        f'character_threshold={DEFAULT_CHARACTER_THRESHOLD}',
+        f'top_k={DEFAULT_TOP_K}',
+    )
+
+
+async def classify_image(img: PILImage, pixels_digest: str | None = None) -> ClassificationResult:
+    # Until the models have loaded, the precision their results would be cached under
+    # isn't known; warmup normally loads them before the first request.
+    if not result_cache.enabled or (namespace := classification_cache()) is None:
+        return await classification_batcher.submit(img)
+
+    key = pixels_digest or await asyncio.to_thread(image_digest, img)
+    if (cached := await result_cache.get(namespace, key)) is not None:
+        return ClassificationResult.model_validate_json(cached)
+
+    result = await classification_batcher.submit(img)
+    await result_cache.set(namespace, key, result.model_dump_json().encode())
+    return result
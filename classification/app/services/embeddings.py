@@ -0,0 +1,264 @@
+import asyncio
+import threading
+import unicodedata
+from functools import partial
+from typing import TYPE_CHECKING
+
+import numpy as np
+import structlog
+import torch
+from sentence_transformers import SentenceTransformer
+
+from app.batching import MicroBatcher
+from app.cache import CacheNamespace, ObjectCache, digest, image_digest, result_cache
+from app.config import config
+from app.device import resolve_model_device
+from app.inference import inference_executor, query_executor
+from app.metrics import time_stage
+from app.models import EncodingMode
+from app.otel import pipeline_span
+from app.quantization import (
+    REFERENCE_TEXTS,
+    accept_quantized,
+    applied_quantization,
+    quantization_enabled,
+    quantize_linear_layers,
+    record_quantization,
+)
+from app.registry import ManagedModel
+from app.utils import warmup_image
+
+if TYPE_CHECKING:
+    from numpy import ndarray
+    from PIL.Image import Image as PILImage
+
+logger = structlog.get_logger()
+model_device = resolve_model_device()
+
+
+EMBEDDING_MODEL_ID = 'jinaai/jina-clip-v2'
+EMBEDDING_DIM = 1024
+EMBEDDING_DTYPE = torch.float32
+
+
+def load_embedding_model(name: str, device: str) -> SentenceTransformer:
+    model = SentenceTransformer(
+        EMBEDDING_MODEL_ID,
+        trust_remote_code=True,
+        truncate_dim=EMBEDDING_DIM,
+        device=device,
+        model_kwargs={'torch_dtype': EMBEDDING_DTYPE},
+        config_kwargs={
+            'use_text_flash_attn': False,
+            'use_vision_xformers': False,
+        },
+    )
+    # The text tower serves tag strings and search queries; it's quantized wherever it
+    # runs on the CPU, including a CPU query copy next to an accelerator model.
+    if quantization_enabled(device):
+        quantize_text_tower(model, text_tower_name(name))
+    return model
+
+
+def text_tower_name(name: str) -> str:
+    return f'{name}:text'
+
+
+embedding_model = ManagedModel(
+    EMBEDDING_MODEL_ID,
+    partial(load_embedding_model, EMBEDDING_MODEL_ID, model_device),
+    lambda model: [model],
+)
+# Search queries only need the text tower. Running them on a CPU copy keeps typing
+# latency independent of image embedding backlogs on the accelerator, at the cost of
+# holding the weights twice.
+query_model = (
+    ManagedModel(
+        f'{EMBEDDING_MODEL_ID}:query',
+        partial(load_embedding_model, f'{EMBEDDING_MODEL_ID}:query', 'cpu'),
+        lambda model: [model],
+    )
+    if config.QUERY_EMBEDDING_DEVICE == 'cpu' and model_device != 'cpu'
+    else embedding_model
+)
+
+# Vectors differ slightly between dtypes, and the disk tier outlives a configuration
+# change. Only the text tower is ever quantized, so image vectors don't depend on it.
+image_embedding_cache = CacheNamespace.create(
+    'image_embedding',
+    EMBEDDING_MODEL_ID,
+    f'dim={EMBEDDING_DIM}',
+    f'dtype={EMBEDDING_DTYPE}',
+)
+
+
+def text_embedding_cache() -> CacheNamespace | None:
+    """Namespace of text vectors from `embedding_model`, or None before it first loads.
+
+    Whether the text tower kept its int8 weights is only decided at load time.
+    """
+    mode = applied_quantization(text_tower_name(embedding_model.name), model_device)
+    if mode is None:
+        return None
+
+    return CacheNamespace.create(
+        'text_embedding',
+        EMBEDDING_MODEL_ID,
+        f'dim={EMBEDDING_DIM}',
+        f'dtype={EMBEDDING_DTYPE}',
+        f'quantization={mode}',
+    )
+
+
+# Keyed by model as well: the CPU query copy may run an int8 text tower, so its vectors
+# differ from the main model's for the same query.
+text_vectors: ObjectCache[tuple[str, str, EncodingMode], ndarray] = ObjectCache(
+    'text_vectors',
+    max_entries=config.TEXT_CACHE_MAX_ENTRIES,
+    ttl_seconds=config.TEXT_CACHE_TTL_SECONDS,
+)
+
+# With QUERY_EMBEDDING_DEVICE=shared, the query and inference executors call the same
+# model from different threads. Its fast tokenizer fails with "Already borrowed" when
+# called concurrently, so calls to one model are serialized.
+_encode_locks = {model.name: threading.Lock() for model in (embedding_model, query_model)}
+
+
+def encode(
+    inputs: list[str] | list[PILImage],
+    encoding_mode: EncodingMode,
+    model: ManagedModel[SentenceTransformer] = embedding_model,
+) -> ndarray:
+    # sentence-transformers preprocesses and returns numpy arrays inside `encode`, so the
+    # whole call counts as the forward.
+    with model.use() as loaded, _encode_locks[model.name], time_stage(model.name, 'forward'):
+        return encode_with(loaded, inputs, encoding_mode)
+
+
+def encode_with(
+    model: SentenceTransformer,
+    inputs: list[str] | list[PILImage],
+    encoding_mode: EncodingMode,
+) -> ndarray:
+    with torch.no_grad():
+        return model.encode(
+            inputs,  # pyright: ignore[reportArgumentType]
+            prompt_name=encoding_mode.value,
+            normalize_embeddings=True,
+        )
+
+
+def quantize_text_tower(model: SentenceTransformer, name: str) -> None:
+    """Swap in an int8 text tower if reference embeddings stay close to FP32.
+
+    Only the text tower is copied for the comparison, never the whole model. The outcome
+    is recorded under `name`.
+    """
+    transformer = model[0]
+    clip = getattr(transformer, 'auto_model', None) or getattr(transformer, 'model', None)
+    text_model = getattr(clip, 'text_model', None)
+    if text_model is None:
+        logger.warning('Text tower not found, keeping FP32', model=name)
+        record_quantization(name, 'none')
+        return
+
+    texts = list(REFERENCE_TEXTS)
+    expected = encode_with(model, texts, EncodingMode.QUERY)
+    clip.text_model = quantize_linear_layers(text_model)  # pyright: ignore[reportOptionalMemberAccess]
+    actual = encode_with(model, texts, EncodingMode.QUERY)
+
+    # Embeddings are normalized, so the dot product is the cosine similarity.
+    min_similarity = float((expected * actual).sum(axis=1).min())
+    if not accept_quantized(name, max_diff=1 - min_similarity):
+        clip.text_model = text_model  # pyright: ignore[reportOptionalMemberAccess]
+
+
+async def cached_encode(
+    namespace: CacheNamespace,
+    input_digest: str,
+    value: str | PILImage,
+    encoding_mode: EncodingMode,
+) -> ndarray:
+    if (cached := await result_cache.get(namespace, input_digest)) is not None:
+        return np.frombuffer(cached, dtype=np.float32)
+
+    embedding = (await inference_executor.run(encode, [value], encoding_mode))[0]  # pyright: ignore[reportArgumentType]
+    await result_cache.set(namespace, input_digest, embedding.astype(np.float32).tobytes())
+    return embedding
+
+
+def normalize_text(text: str) -> str:
+    # Only normalize what can't change the meaning: Unicode compatibility forms and
+    # whitespace. Case is kept because the jina tokenizer is case-sensitive.
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+async def encode_text(text: str, encoding_mode: EncodingMode) -> ndarray:
+    text = normalize_text(text)
+
+    # Hot tag strings and search queries are served straight from memory without
+    # touching the executor, the result cache or tracing.
+    key = (embedding_model.name, text, encoding_mode)
+    if (vector := text_vectors.get(key)) is not None:
+        return vector
+
+    with pipeline_span('text_embedding', EMBEDDING_MODEL_ID, encoding_mode):
+        # Before the first load, which precision vectors would be cached under isn't
+        # known yet; warmup normally loads the model before the first request.
+        if result_cache.enabled and (namespace := text_embedding_cache()) is not None:
+            input_digest = digest(text, encoding_mode.value)
+            vector = await cached_encode(namespace, input_digest, text, encoding_mode)
+        else:
+            vector = (await inference_executor.run(encode, [text], encoding_mode))[0]
+
+    text_vectors.set(key, vector)
+    return vector
+
+
+def encode_queries(queries: list[str]) -> list[ndarray]:
+    return list(encode(queries, EncodingMode.QUERY, query_model))
+
+
+query_batcher = MicroBatcher(
+    'query_embedding',
+    encode_queries,
+    max_batch_size=config.QUERY_BATCH_MAX_SIZE,
+    max_wait_ms=config.QUERY_BATCH_MAX_WAIT_MS,
+    consumers=config.QUERY_CONCURRENCY,
+    executor=query_executor,
+)
+
+
+def warmup() -> None:
+    encode([warmup_image()], EncodingMode.DOCUMENT)
+    encode(['warmup'], EncodingMode.DOCUMENT)
+    for batch_size in sorted({1, config.QUERY_BATCH_MAX_SIZE}):
+        encode_queries(['warmup'] * batch_size)
+
+
+async def encode_query(query: str) -> ndarray:
+    query = normalize_text(query)
+
+    key = (query_model.name, query, EncodingMode.QUERY)
+    if (vector := text_vectors.get(key)) is not None:
+        return vector
+
+    with pipeline_span('query_embedding', EMBEDDING_MODEL_ID, EncodingMode.QUERY):
+        vector = await query_batcher.submit(query)
+
+    text_vectors.set(key, vector)
+    return vector
+
+
+async def encode_image(
+    img: PILImage,
+    encoding_mode: EncodingMode,
+    pixels_digest: str | None = None,
+) -> ndarray:
+    with pipeline_span('image_embedding', EMBEDDING_MODEL_ID, encoding_mode):
+        if not result_cache.enabled:
+            return (await inference_executor.run(encode, [img], encoding_mode))[0]
+
+        pixels_digest = pixels_digest or await asyncio.to_thread(image_digest, img)
+        input_digest = digest(pixels_digest, encoding_mode.value)
+        return await cached_encode(image_embedding_cache, input_digest, img, encoding_mode)
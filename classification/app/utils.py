@@ -1,66 +1,276 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import binascii
 import io
+import math
+import mmap
+import os
+from pathlib import Path
 from typing import TYPE_CHECKING
 
 import structlog
 from fastapi import HTTPException
 from PIL import Image
 
+from app.config import config
+from app.http_client import host_limiter
+from app.metrics import image_decode_seconds, image_download_seconds
 from app.otel import pipeline_span
 
 if TYPE_CHECKING:
+    from fastapi import Request
     from niquests import AsyncSession
     from PIL.Image import Image as PILImage
 
 logger = structlog.get_logger()
 
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+_BINARY_CONTENT_TYPES = frozenset({'application/octet-stream', 'binary/octet-stream'})
 
-async def preprocess_image(image: str, session: AsyncSession) -> PILImage:
-    with pipeline_span('preprocess_image'):
-        match image.startswith(('http://', 'https://')):
-            case True:
-                headers = {'Accept-Encoding': 'gzip'}
-                try:
-                    response = await session.get(image, headers=headers, timeout=25)
+# (prefix, offset, suffix) of every format Pillow decodes for us.
+_IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 0, b''),  # JPEG
+    (b'\x89PNG\r\n\x1a\n', 0, b''),
+    (b'GIF87a', 0, b''),
+    (b'GIF89a', 0, b''),
+    (b'RIFF', 8, b'WEBP'),
+    (b'BM', 0, b''),
+    (b'II*\x00', 0, b''),  # TIFF, little endian
+    (b'MM\x00*', 0, b''),  # TIFF, big endian
+    # AVIF / HEIF, by major brand, since other ISO media files (MP4, MOV) share `ftyp`
+    *((b'', 4, b'ftyp' + brand) for brand in (b'avif', b'avis', b'heic', b'heix', b'mif1')),
+)
+SIGNATURE_SIZE = 12
+
+# Large enough that every model resizes rather than pads, like real photos.
+WARMUP_IMAGE_SIZE = 1024
+
+
+def warmup_image() -> PILImage:
+    return Image.new('RGB', (WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE), (124, 116, 104))
+
+
+def decode_image(
+    raw: bytes | mmap.mmap,
+    min_size: int = config.IMAGE_DECODE_MIN_SIZE,
+    max_pixels: int = config.IMAGE_MAX_PIXELS,
+) -> PILImage:
+    """Decode an RGB image no smaller than needed for a `min_size` shorter side."""
+    # A mapped file is already a seekable file object, so only bytes need wrapping.
+    img = Image.open(raw if isinstance(raw, mmap.mmap) else io.BytesIO(raw))
+    scale = min(img.size) / min_size
+
+    # JPEG can decode straight to 1/2, 1/4 or 1/8 scale, skipping most of the work and
+    # memory of a full-resolution decode. `draft` never goes below the requested size.
+    if img.format == 'JPEG' and scale >= 2:
+        img.draft('RGB', (math.ceil(img.width / scale), math.ceil(img.height / scale)))
+        scale = min(img.size) / min_size
+
+    # Checked before pixel data is read, so oversized images never get allocated.
+    if img.width * img.height > max_pixels:
+        raise HTTPException(
+            status_code=413,
+            detail=f'Image is too large: {img.width}x{img.height} exceeds {max_pixels} pixels',
+        )
+
+    img = img.convert('RGB')
+
+    # Other formats have no reduced decode; an integer box reduce is the next cheapest.
+    if (factor := math.floor(scale)) >= 2:
+        img = img.reduce(factor)
+
+    return img
+
+
+def check_image_signature(head: bytes) -> None:
+    # Magic bytes are checked rather than trusted Content-Type headers or extensions.
+    if not any(
+        head.startswith(signature) and head[offset : offset + len(suffix)] == suffix
+        for signature, offset, suffix in _IMAGE_SIGNATURES
+    ):
+        raise HTTPException(status_code=415, detail='Unsupported image type')
+
+
+def _too_large_detail(max_bytes: int) -> str:
+    return f'Image is too large: more than {max_bytes} bytes'
+
+
+async def download_image(
+    url: str,
+    session: AsyncSession,
+    max_bytes: int = config.IMAGE_MAX_BYTES,
+) -> bytes:
+    """Stream an image into memory, aborting as soon as it's clearly unusable.
+
+    Non-image content types, unknown magic bytes and bodies over `max_bytes` (as
+    announced or as received, after decompression) close the connection right away
+    instead of reading the rest of the body.
+    """
+    headers = {'Accept-Encoding': 'gzip'}
+    timeout = config.IMAGE_DOWNLOAD_TIMEOUT_SECONDS
+
+    async with asyncio.timeout(timeout), host_limiter.slot(url):
+        response = await session.get(url, headers=headers, timeout=timeout, stream=True)
+        async with response:
+            if not response.ok:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f'Failed to download image: HTTP {response.status_code}',
+                )
+
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type and not (
+                content_type.startswith('image/') or content_type in _BINARY_CONTENT_TYPES
+            ):
+                raise HTTPException(
+                    status_code=415,
+                    detail=f'Unsupported content type: {content_type}',
+                )
+
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit() and int(content_length) > max_bytes:
+                raise HTTPException(status_code=413, detail=_too_large_detail(max_bytes))
+
+            chunks: list[bytes] = []
+            size = 0
+            sniffed = False
+            async for chunk in await response.iter_content(_DOWNLOAD_CHUNK_SIZE):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=_too_large_detail(max_bytes))
+                if not sniffed and size >= SIGNATURE_SIZE:
+                    check_image_signature(b''.join(chunks)[:SIGNATURE_SIZE])
+                    sniffed = True
 
-                    if not response.ok:
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f'Failed to download image: HTTP {response.status_code}',
-                        )
+    if size == 0:
+        raise HTTPException(status_code=400, detail='Failed to download image: empty body')
 
-                    if response.content is None:
-                        raise HTTPException(
-                            status_code=400, detail='Failed to download image: empty body',
-                        )
+    # A single join is the only copy; BytesIO then wraps the result without copying.
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
 
-                    raw = response.content
+
+def open_shared_image(path: str) -> mmap.mmap:
+    """Map an image file under `IMAGE_SHARED_VOLUME` into memory, read-only.
+
+    The decoder reads straight from the page cache, with no HTTP, base64 or buffer
+    copies in between.
+    """
+    if not config.IMAGE_SHARED_VOLUME:
+        raise HTTPException(status_code=400, detail='Local image paths are not enabled')
+
+    root = Path(config.IMAGE_SHARED_VOLUME).resolve()
+    target = (root / path).resolve()
+    # Resolving first means neither `..` nor symlinks can escape the volume.
+    if not target.is_relative_to(root) or not target.is_file():
+        raise HTTPException(status_code=404, detail=f'Image not found: {path}')
+
+    with target.open('rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            raise HTTPException(status_code=400, detail='Invalid image data: empty file')
+        if size > config.IMAGE_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=_too_large_detail(config.IMAGE_MAX_BYTES))
+
+        # The mapping stays valid after the file is closed.
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+async def load_image(raw: bytes | mmap.mmap) -> PILImage:
+    check_image_signature(raw[:SIGNATURE_SIZE])
+
+    try:
+        with image_decode_seconds.time():
+            return await asyncio.to_thread(decode_image, raw)
+    except HTTPException:
+        raise
+    except Exception as e:  # pragma: no cover
+        raise HTTPException(status_code=400, detail=f'Invalid image data: {e}') from e
+
+
+async def preprocess_image(image: str, session: AsyncSession) -> PILImage:
+    with pipeline_span('preprocess_image'):
+        scheme = image.split('://', 1)[0] if '://' in image else None
+        match scheme:
+            case 'http' | 'https':
+                try:
+                    with image_download_seconds.time():
+                        raw = await download_image(image, session)
                 except HTTPException:
                     raise
+                except TimeoutError as e:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=(
+                            'Failed to download image: timed out after '
+                            f'{config.IMAGE_DOWNLOAD_TIMEOUT_SECONDS:g}s'
+                        ),
+                    ) from e
                 except Exception as e:
                     logger.exception('Failed to download image %s', image)
                     raise HTTPException(
                         status_code=400,
                         detail=f'Failed to download image: {e}',
                     ) from e
-            case False:
+            case 'file':
+                # Resolving, opening and mapping all hit the filesystem, which may be a
+                # network mount; none of it belongs on the event loop.
+                path = image.removeprefix('file://')
+                with await asyncio.to_thread(open_shared_image, path) as mapped:
+                    return await load_image(mapped)
+            case None:
                 try:
                     raw = base64.b64decode(image, validate=True)
                 except (binascii.Error, ValueError) as e:  # pragma: no cover
                     raise HTTPException(status_code=400, detail=f'Invalid base64 input: {e}') from e
-            case _:  # pyright: ignore[reportUnnecessaryComparison]
-                raise HTTPException(  # pyright: ignore[reportUnreachable]
+
+                if len(raw) > config.IMAGE_MAX_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=_too_large_detail(config.IMAGE_MAX_BYTES),
+                    )
+            case _:
+                raise HTTPException(
                     status_code=400,
-                    detail='Invalid image data',
+                    detail=f'Unsupported image source: {scheme}://',
+                )
+
+        return await load_image(raw)
+
+
+# Upload routes read the raw body themselves, so FastAPI can't infer its schema.
+UPLOAD_OPENAPI_EXTRA = {
+    'requestBody': {
+        'required': True,
+        'content': {'application/octet-stream': {'schema': {'type': 'string', 'format': 'binary'}}},
+    },
+}
+
+
+async def preprocess_upload(request: Request) -> PILImage:
+    """Read and decode an image sent as the raw request body."""
+    content_type = request.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if not (content_type.startswith('image/') or content_type in _BINARY_CONTENT_TYPES):
+        raise HTTPException(
+            status_code=415,
+            detail='Send the image as application/octet-stream or image/*',
+        )
+
+    with pipeline_span('preprocess_image'):
+        chunks: list[bytes] = []
+        size = 0
+        async for chunk in request.stream():
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > config.IMAGE_MAX_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=_too_large_detail(config.IMAGE_MAX_BYTES),
                 )
 
-        try:
-            img = Image.open(io.BytesIO(raw))
-            img = img.convert('RGB')
-        except Exception as e:  # pragma: no cover
-            raise HTTPException(status_code=400, detail=f'Invalid image data: {e}') from e
+        if size == 0:
+            raise HTTPException(status_code=400, detail='Invalid image data: empty body')
 
-        return img
+        return await load_image(chunks[0] if len(chunks) == 1 else b''.join(chunks))
@@ -0,0 +1,4 @@
+import os
+
+# Required by app.config; nothing under test checks it.
+os.environ.setdefault('API_TOKEN', 'test')
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+from operator import itemgetter
+
+import pytest
+from fastapi import HTTPException
+
+from app.batching import MicroBatcher
+from app.inference import InferenceExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = InferenceExecutor(concurrency=2, max_pending=16)
+    yield executor
+    executor.shutdown()
+
+
+def test_concurrent_submits_share_a_batch(executor):
+    batches: list[list[int]] = []
+
+    def double(items: list[int]) -> list[int]:
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher('test', double, max_batch_size=8, max_wait_ms=50, executor=executor)
+
+    async def main() -> list[int]:
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(main()) == [0, 2, 4, 6, 8]
+    assert batches == [[0, 1, 2, 3, 4]]
+    assert batcher.stats.batches == 1
+    assert batcher.stats.items == 5
+
+
+def test_batches_are_capped_at_max_batch_size(executor):
+    sizes: list[int] = []
+
+    def identity(items: list[int]) -> list[int]:
+        sizes.append(len(items))
+        return items
+
+    batcher = MicroBatcher(
+        'test',
+        identity,
+        max_batch_size=2,
+        max_wait_ms=50,
+        consumers=1,
+        executor=executor,
+    )
+
+    async def main() -> list[int]:
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(main()) == [0, 1, 2, 3, 4]
+    assert sizes == [2, 2, 1]
+
+
+def test_submit_fails_fast_when_queue_is_full(executor):
+    release = threading.Event()
+
+    def blocking(items: list[int]) -> list[int]:
+        release.wait()
+        return items
+
+    batcher = MicroBatcher(
+        'test',
+        blocking,
+        max_batch_size=1,
+        max_wait_ms=0,
+        max_queue_size=1,
+        consumers=1,
+        executor=executor,
+    )
+
+    async def main() -> None:
+        running = asyncio.create_task(batcher.submit(1))
+        await asyncio.sleep(0.05)
+        queued = asyncio.create_task(batcher.submit(2))
+        await asyncio.sleep(0)
+
+        with pytest.raises(HTTPException) as e:
+            await batcher.submit(3)
+        assert e.value.status_code == 503
+
+        release.set()
+        assert await asyncio.gather(running, queued) == [1, 2]
+        await batcher.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+
+
+def test_result_count_mismatch_fails_the_batch(executor):
+    batcher = MicroBatcher(
+        'test',
+        itemgetter(slice(-1)),
+        max_batch_size=8,
+        max_wait_ms=50,
+        executor=executor,
+    )
+
+    async def main() -> list[int | BaseException]:
+        try:
+            return await asyncio.gather(
+                *(batcher.submit(i) for i in range(3)),
+                return_exceptions=True,
+            )
+        finally:
+            await batcher.close()
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_consumers_survive_a_failed_batch(executor):
+    def fail_on_negative(items: list[int]) -> list[int]:
+        if any(item < 0 for item in items):
+            raise RuntimeError('bad item')
+        return items
+
+    batcher = MicroBatcher(
+        'test',
+        fail_on_negative,
+        max_batch_size=1,
+        max_wait_ms=0,
+        consumers=1,
+        executor=executor,
+    )
+
+    async def main() -> int:
+        try:
+            with pytest.raises(RuntimeError, match='bad item'):
+                await batcher.submit(-1)
+            return await asyncio.wait_for(batcher.submit(7), timeout=1)
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(main()) == 7
+
+
+def test_dead_consumers_are_replaced(executor):
+    batcher = MicroBatcher('test', lambda items: items, max_wait_ms=0, executor=executor)
+
+    async def main() -> int:
+        try:
+            await batcher.submit(1)
+            for task in asyncio.all_tasks():
+                if task.get_name().startswith('test-batcher-'):
+                    task.cancel()
+            await asyncio.sleep(0)
+            return await asyncio.wait_for(batcher.submit(2), timeout=1)
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(main()) == 2
+
+
+def test_cancelled_callers_are_skipped(executor):
+    release = threading.Event()
+    seen: list[list[int]] = []
+
+    def record(items: list[int]) -> list[int]:
+        release.wait()
+        seen.append(items)
+        return items
+
+    batcher = MicroBatcher(
+        'test',
+        record,
+        max_batch_size=1,
+        max_wait_ms=0,
+        consumers=1,
+        executor=executor,
+    )
+
+    async def main() -> None:
+        first = asyncio.create_task(batcher.submit(1))
+        await asyncio.sleep(0.05)
+        abandoned = asyncio.create_task(batcher.submit(2))
+        await asyncio.sleep(0)
+        abandoned.cancel()
+
+        release.set()
+        assert await first == 1
+        assert await asyncio.wait_for(batcher.submit(3), timeout=1) == 3
+        await batcher.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+    assert seen == [[1], [3]]
@@ -0,0 +1,106 @@
+import json
+
+import pytest
+from PIL import Image
+
+from app import bulk
+
+
+def _rows(*keys: str) -> list[dict]:
+    return [{'path': key, 'aesthetic': 0.5} for key in keys]
+
+
+def test_jsonl_resume_drops_a_torn_line(tmp_path):
+    path = tmp_path / 'results.jsonl'
+    writer = bulk.JsonlWriter(path)
+    writer.write(_rows('a', 'b'))
+    writer.close()
+    # Interrupted halfway through writing the next row.
+    with path.open('a', encoding='utf-8') as file:
+        file.write('{"path": "c", "aest')
+
+    writer = bulk.JsonlWriter(path)
+    assert writer.completed() == {'a', 'b'}
+    writer.write(_rows('c'))
+    writer.close()
+
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert [json.loads(line)['path'] for line in lines] == ['a', 'b', 'c']
+
+
+def test_jsonl_without_output_has_nothing_completed(tmp_path):
+    assert bulk.JsonlWriter(tmp_path / 'missing.jsonl').completed() == set()
+
+
+def test_run_skips_completed_images(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    images = tmp_path / 'images'
+    images.mkdir()
+    for name in ('a', 'b', 'c'):
+        Image.new('RGB', (8, 8)).save(images / f'{name}.png')
+    (images / 'd.png').write_bytes(b'not an image')
+
+    classified: list[str] = []
+
+    def classify(keys: list[str], _: list) -> list[dict]:
+        classified.extend(keys)
+        return _rows(*keys)
+
+    monkeypatch.setattr(bulk, '_classify', classify)
+    output = tmp_path / 'results.jsonl'
+    previous = bulk.JsonlWriter(output)
+    previous.write(_rows('a.png'))
+    previous.close()
+
+    def run() -> None:
+        writer = bulk.JsonlWriter(output)
+        try:
+            bulk.run(
+                bulk.iter_sources(images),
+                writer,
+                batch_size=2,
+                decode_workers=2,
+                prefetch=4,
+            )
+        finally:
+            writer.close()
+
+    run()
+    assert classified == ['b.png', 'c.png']
+    # Failed images are recorded rather than retried.
+    run()
+    assert classified == ['b.png', 'c.png']
+
+    rows = [json.loads(line) for line in output.read_text(encoding='utf-8').splitlines()]
+    assert sorted(row['path'] for row in rows) == ['a.png', 'b.png', 'c.png', 'd.png']
+    assert next(row for row in rows if row['path'] == 'd.png')['error']['status_code'] == 415
+
+
+def test_parquet_resume_reads_complete_parts(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    writer = bulk.ParquetWriter(tmp_path, rows_per_part=2, part_seconds=3600)
+    writer.write(_rows('a', 'b', 'c'))
+    # Only whole parts are written until the writer is closed.
+    assert [part.name for part in writer._parts()] == ['part-00000.parquet']
+    # A part that was being written when the run stopped.
+    (tmp_path / '.part-00001.parquet.tmp').write_bytes(b'PAR1')
+
+    writer = bulk.ParquetWriter(tmp_path, rows_per_part=2, part_seconds=3600)
+    assert writer.completed() == {'a', 'b'}
+    assert not list(tmp_path.glob('.*.tmp'))
+
+    writer.write([*_rows('c'), {'path': 'd', 'error': {'status_code': 415, 'detail': 'x'}}])
+    writer.write(_rows('e'))
+    writer.close()
+    assert writer.completed() == {'a', 'b', 'c', 'd', 'e'}
+
+
+def test_parquet_writes_slow_runs_on_a_time_bound(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    writer = bulk.ParquetWriter(tmp_path, rows_per_part=100, part_seconds=0)
+    writer.write(_rows('a'))
+    writer.write(_rows('b'))
+
+    assert len(writer._parts()) == 2
+    assert writer.completed() == {'a', 'b'}
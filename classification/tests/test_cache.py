@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import sqlite3
+
+import pytest
+from PIL import Image
+
+from app import cache
+from app.cache import CacheNamespace, ObjectCache, ResultCache, digest, image_digest
+
+NAMESPACE = CacheNamespace.create('test', 'model-a', 'threshold=0.5')
+
+
+def test_digest_separates_parts():
+    assert digest('ab', 'c') != digest('a', 'bc')
+    assert digest('a', b'b') == digest(b'a', 'b')
+
+
+def test_namespace_fingerprint_follows_its_parts():
+    assert CacheNamespace.create('test', 'model-a', 'threshold=0.5') == NAMESPACE
+    assert NAMESPACE.fingerprint != CacheNamespace.create('test', 'model-b').fingerprint
+    assert NAMESPACE.key('abc') == f'test:{NAMESPACE.fingerprint}:abc'
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', '1'])
+def test_image_digest_matches_whole_image_hash(monkeypatch, mode):
+    # Small strips force many rows through the strip loop.
+    monkeypatch.setattr(cache, '_DIGEST_STRIP_BYTES', 100)
+    img = Image.effect_noise((37, 29), 64).convert(mode)
+
+    expected = hashlib.blake2b(digest_size=16)
+    for part in (mode.encode(), b'37x29', img.tobytes()):
+        expected.update(part)
+        expected.update(b'\0')
+
+    assert image_digest(img) == expected.hexdigest()
+
+
+def test_image_digest_follows_pixels_not_encoding():
+    img = Image.new('RGB', (8, 8), (10, 20, 30))
+    same = Image.new('RGB', (8, 8), (10, 20, 30))
+    other = Image.new('RGB', (8, 8), (10, 20, 31))
+
+    assert image_digest(img) == image_digest(same)
+    assert image_digest(img) != image_digest(other)
+    assert image_digest(img) != image_digest(img.convert('RGBA'))
+
+
+def test_object_cache_evicts_least_recently_used():
+    lru: ObjectCache[str, int] = ObjectCache('test-lru', max_entries=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert len(lru) == 2
+    assert (lru.stats.hits, lru.stats.misses) == (3, 1)
+
+
+def test_object_cache_expires_entries(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr(cache, 'monotonic', lambda: now)
+    ttl: ObjectCache[str, int] = ObjectCache('test-ttl', max_entries=4, ttl_seconds=10)
+    ttl.set('a', 1)
+
+    now = 105.0
+    assert ttl.get('a') == 1
+    now = 111.0
+    assert ttl.get('a') is None
+    assert len(ttl) == 0
+
+
+def test_object_cache_disabled_at_zero_entries():
+    disabled: ObjectCache[str, int] = ObjectCache('test-disabled', max_entries=0)
+    disabled.set('a', 1)
+    assert disabled.get('a') is None
+
+
+def test_memory_tier_stays_within_budget():
+    results = ResultCache(memory_max_bytes=30)
+
+    async def main() -> list[bytes | None]:
+        for name in 'abcd':
+            await results.set(NAMESPACE, name, name.encode() * 10)
+        # Replacing an entry frees its old size instead of evicting others.
+        await results.set(NAMESPACE, 'd', b'D' * 10)
+        return [await results.get(NAMESPACE, name) for name in 'abcd']
+
+    assert asyncio.run(main()) == [None, b'b' * 10, b'c' * 10, b'D' * 10]
+    assert results.memory_size == 30
+
+
+def test_memory_tier_skips_values_over_budget():
+    results = ResultCache(memory_max_bytes=5)
+
+    async def main() -> bytes | None:
+        await results.set(NAMESPACE, 'a', b'too large')
+        return await results.get(NAMESPACE, 'a')
+
+    assert asyncio.run(main()) is None
+    assert results.memory_size == 0
+
+
+def test_disk_tier_survives_restarts(tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    first = ResultCache(memory_max_bytes=0, disk_path=path, disk_max_bytes=1024)
+    asyncio.run(first.set(NAMESPACE, 'a', b'value'))
+    first.close()
+
+    second = ResultCache(memory_max_bytes=1024, disk_path=path, disk_max_bytes=1024)
+    try:
+        assert asyncio.run(second.get(NAMESPACE, 'a')) == b'value'
+        # Promoted to memory on the way out.
+        assert second.memory_size == len(b'value')
+        assert second.stats['test'].disk_hits == 1
+    finally:
+        second.close()
+
+
+def _stored(path) -> dict[str, tuple[int, float]]:
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute('SELECT key, size, accessed_at FROM results').fetchall()
+    return {key.rsplit(':', 1)[1]: (size, accessed_at) for key, size, accessed_at in rows}
+
+
+def test_disk_tier_evicts_least_recently_accessed(monkeypatch, tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    now = 1000.0
+    monkeypatch.setattr(cache, 'time', lambda: now)
+    results = ResultCache(memory_max_bytes=0, disk_path=path, disk_max_bytes=100)
+
+    async def main() -> None:
+        nonlocal now
+        for name in 'abcd':
+            await results.set(NAMESPACE, name, b'x' * 25)
+            now += 1
+        # Overwriting a key doesn't count its old value against the budget.
+        for _ in range(10):
+            await results.set(NAMESPACE, 'd', b'y' * 25)
+        # Past the refresh interval, so this hit makes `a` the most recent.
+        now += 1000
+        assert await results.get(NAMESPACE, 'a') == b'x' * 25
+        await results.set(NAMESPACE, 'e', b'z' * 25)
+
+    try:
+        asyncio.run(main())
+    finally:
+        results.close()
+
+    assert sorted(_stored(path)) == ['a', 'd', 'e']
+
+
+def test_disk_tier_throttles_access_updates(monkeypatch, tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    now = 1000.0
+    monkeypatch.setattr(cache, 'time', lambda: now)
+    results = ResultCache(memory_max_bytes=0, disk_path=path, disk_max_bytes=1024)
+
+    async def main() -> None:
+        nonlocal now
+        await results.set(NAMESPACE, 'a', b'value')
+        now = 1010.0
+        await results.get(NAMESPACE, 'a')
+        assert _stored(path)['a'][1] == pytest.approx(1000)
+
+        now = 2000.0
+        await results.get(NAMESPACE, 'a')
+        assert _stored(path)['a'][1] == pytest.approx(2000)
+
+    try:
+        asyncio.run(main())
+    finally:
+        results.close()
+
+
+def test_cache_stats_count_hits_and_misses():
+    results = ResultCache(memory_max_bytes=1024)
+
+    async def main() -> None:
+        assert await results.get(NAMESPACE, 'a') is None
+        await results.set(NAMESPACE, 'a', b'value')
+        assert await results.get(NAMESPACE, 'a') == b'value'
+
+    asyncio.run(main())
+    assert (results.stats['test'].hits, results.stats['test'].misses) == (1, 1)
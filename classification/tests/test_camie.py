@@ -0,0 +1,72 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+camie = pytest.importorskip('app.imgutils.camie')
+
+# General (0) and character (1) tags can be returned; -1 marks everything else.
+TAGS = {
+    'hair': 0,
+    'long hair': 0,
+    'very long hair': 0,
+    'hat': 0,
+    'witch hat': 0,
+    'hair ornament': 0,
+    'ribbon': 0,
+    'hair ribbon': 0,
+    'a': 0,
+    'hatsune miku': 1,
+    'rating general': -1,
+}
+OVERLAPS = {'hat': ['witch_hat'], 'ribbon': ['hair_ribbon', 'not_in_vocabulary']}
+
+
+@pytest.fixture
+def vocabulary(monkeypatch):
+    names = list(TAGS)
+    codes = torch.tensor(list(TAGS.values()), dtype=torch.int8)
+    monkeypatch.setattr(camie, '_get_tag_table', lambda: (names, codes))
+    monkeypatch.setattr(camie, '_get_overlap_tags', lambda: OVERLAPS)
+    camie._get_overlap_index.cache_clear()
+    yield names
+    camie._get_overlap_index.cache_clear()
+
+
+def _ids(vocabulary, *tags):
+    return [vocabulary.index(tag) for tag in tags]
+
+
+def test_substrings_of_present_tags_are_dropped(vocabulary):
+    tag_ids = _ids(vocabulary, 'hair', 'long hair', 'very long hair', 'hat')
+    kept = camie._drop_overlap_tag_ids(tag_ids)
+    assert kept == set(_ids(vocabulary, 'very long hair', 'hat'))
+
+
+def test_overlap_relation_drops_implied_tags(vocabulary):
+    tag_ids = _ids(vocabulary, 'ribbon', 'hair ribbon', 'witch hat')
+    # `hat` isn't present, so nothing implies `witch hat`.
+    assert camie._drop_overlap_tag_ids(tag_ids) == set(_ids(vocabulary, 'hair ribbon', 'witch hat'))
+
+
+def test_tags_shorter_than_an_ngram_are_matched(vocabulary):
+    tag_ids = _ids(vocabulary, 'a', 'hat')
+    assert camie._drop_overlap_tag_ids(tag_ids) == set(_ids(vocabulary, 'hat'))
+
+
+def test_unreturnable_tags_never_dominate(vocabulary):
+    indptr, indices = camie._get_overlap_index()
+    skipped = vocabulary.index('rating general')
+    assert skipped not in indices.tolist()
+    assert indptr[skipped] == indptr[skipped + 1]
+
+
+@pytest.mark.parametrize(
+    'tags',
+    [
+        ['hair', 'long hair', 'very long hair', 'hat', 'witch hat'],
+        ['ribbon', 'hair ribbon', 'hair ornament', 'a'],
+        list(TAGS)[:-1],
+    ],
+)
+def test_index_matches_string_rules(vocabulary, tags):
+    kept = camie._drop_overlap_tag_ids(_ids(vocabulary, *tags))
+    assert {vocabulary[idx] for idx in kept} == set(camie.drop_overlap_tags(tags))
@@ -0,0 +1,53 @@
+import pytest
+
+# Skipped without torch, which the module imports.
+device = pytest.importorskip('app.device')
+
+
+@pytest.mark.parametrize(
+    ('cpulist', 'cpus'),
+    [
+        ('0', [0]),
+        ('0-3', [0, 1, 2, 3]),
+        ('0-1,4,6-7\n', [0, 1, 4, 6, 7]),
+        ('0,,2', [0, 2]),
+        ('', []),
+    ],
+)
+def test_parse_cpulist(cpulist: str, cpus: list[int]):
+    assert device._parse_cpulist(cpulist) == cpus
+
+
+@pytest.mark.parametrize('cpulist', ['0', '0-3', '0-1,4,6-7', '2,4,6'])
+def test_format_cpulist_round_trips(cpulist: str):
+    assert device._format_cpulist(device._parse_cpulist(cpulist)) == cpulist
+
+
+def test_split_shares_cores_evenly():
+    cpus = list(range(10))
+    parts = [device._split(cpus, 3, index) for index in range(3)]
+
+    assert parts == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+
+
+def test_split_shares_cores_when_there_are_too_few():
+    assert device._split([0, 1], 4, 3) == [0, 1]
+
+
+def test_worker_slots_are_claimed_in_order(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(device.tempfile, 'gettempdir', lambda: str(tmp_path))
+
+    first, first_lock = device._claim_worker_slot(2)
+    second, second_lock = device._claim_worker_slot(2)
+    try:
+        assert (first, second) == (0, 1)
+        # Every slot is taken, so further processes share one rather than fail.
+        assert device._claim_worker_slot(2)[1] is None
+    finally:
+        first_lock.close()
+        second_lock.close()
+
+    # A released slot is reclaimed by the next worker.
+    slot, lock = device._claim_worker_slot(2)
+    lock.close()
+    assert slot == 0
@@ -0,0 +1,81 @@
+import asyncio
+import contextvars
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from app.inference import InferenceExecutor
+
+request_id: contextvars.ContextVar[str | None] = contextvars.ContextVar('request_id', default=None)
+
+
+def test_run_returns_result_off_the_event_loop():
+    executor = InferenceExecutor(concurrency=1, max_pending=4)
+
+    async def main() -> tuple[int, int]:
+        return await executor.run(lambda a, b: (a + b, threading.get_ident()), 1, b=2)
+
+    try:
+        result, thread = asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+    assert result == 3
+    assert thread != threading.get_ident()
+
+
+def test_run_keeps_caller_context():
+    executor = InferenceExecutor(concurrency=1, max_pending=4)
+
+    async def main() -> str | None:
+        request_id.set('abc')
+        return await executor.run(request_id.get)
+
+    try:
+        assert asyncio.run(main()) == 'abc'
+    finally:
+        executor.shutdown()
+
+
+def test_run_rejects_calls_beyond_max_pending():
+    executor = InferenceExecutor(concurrency=1, max_pending=2)
+    release = threading.Event()
+
+    async def main() -> None:
+        blocked = [asyncio.create_task(executor.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert executor.pending == 2
+
+        with pytest.raises(HTTPException) as e:
+            await executor.run(lambda: None)
+        assert e.value.status_code == 503
+
+        release.set()
+        await asyncio.gather(*blocked)
+        assert executor.pending == 0
+        # Capacity is given back once calls finish.
+        assert await executor.run(lambda: 1) == 1
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_run_releases_slot_when_call_fails():
+    executor = InferenceExecutor(concurrency=1, max_pending=1)
+
+    def fail() -> None:
+        raise ValueError('boom')
+
+    async def main() -> None:
+        with pytest.raises(ValueError, match='boom'):
+            await executor.run(fail)
+        assert executor.pending == 0
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
@@ -0,0 +1,68 @@
+import asyncio
+import socket
+
+import pytest
+from PIL import Image
+
+from app.ipc import DISCONNECTED, image_from_payload, image_to_payload, read_frame, write_frame
+
+
+async def _round_trip(frames: list[tuple[dict, bytes]]) -> list[tuple[dict, bytes]]:
+    left, right = socket.socketpair()
+    reader, reader_side = await asyncio.open_connection(sock=left)
+    _, writer = await asyncio.open_connection(sock=right)
+    try:
+        for header, payload in frames:
+            write_frame(writer, header, payload)
+        await writer.drain()
+        return [await read_frame(reader) for _ in frames]
+    finally:
+        for stream in (writer, reader_side):
+            stream.close()
+            await stream.wait_closed()
+
+
+def test_frames_round_trip_back_to_back():
+    frames = [
+        ({'id': 1, 'op': 'encode_text', 'args': {'text': 'メイド'}}, b''),
+        ({'id': 2, 'op': 'classify'}, bytes(range(256)) * 1000),
+        ({'id': 3, 'op': 'encode_image'}, b'\x00'),
+    ]
+    assert asyncio.run(_round_trip(frames)) == frames
+
+
+def test_truncated_frame_reads_as_disconnected():
+    async def main() -> None:
+        frame = await _encode({'id': 1}, b'payload')
+        # The peer goes away halfway through the payload.
+        reader = asyncio.StreamReader()
+        reader.feed_data(frame[:-3])
+        reader.feed_eof()
+        await read_frame(reader)
+
+    with pytest.raises(DISCONNECTED):
+        asyncio.run(main())
+
+
+async def _encode(header: dict, payload: bytes) -> bytes:
+    left, right = socket.socketpair()
+    with left:
+        _, writer = await asyncio.open_connection(sock=right)
+        write_frame(writer, header, payload)
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+        return left.recv(1024)
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'L', 'RGBA'])
+def test_image_payload_round_trips(mode: str):
+    img = Image.linear_gradient('L').resize((7, 5)).convert(mode)
+
+    meta, payload = image_to_payload(img)
+    ((header, received),) = asyncio.run(_round_trip([(meta, payload)]))
+    restored = image_from_payload(header, received)
+
+    assert restored.mode == mode
+    assert restored.size == (7, 5)
+    assert restored.tobytes() == img.tobytes()
@@ -0,0 +1,31 @@
+import pytest
+
+from app import profiling
+
+
+def test_prune_keeps_the_newest_traces(tmp_path):
+    names = [f'profile-20260101T00000{second}.000000-abcd1234.json' for second in range(5)]
+    for name in names:
+        (tmp_path / name).write_text('{}')
+    (tmp_path / 'notes.json').write_text('{}')
+
+    profiling.prune_traces(tmp_path, 2)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['notes.json', *names[3:]]
+
+
+def test_failed_start_releases_the_profile_slot(monkeypatch: pytest.MonkeyPatch):
+    def fail() -> None:
+        raise RuntimeError('no profiler')
+
+    monkeypatch.setattr(profiling, '_start', fail)
+    for _ in range(2):
+        with profiling.torch_profile() as summaries:
+            pass
+        assert summaries == []
+    assert not profiling._lock.locked()
+
+
+def test_calls_outside_profiled_requests_are_not_profiled(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(profiling, '_start', pytest.fail)
+    assert profiling.run_profiled(sum, [1, 2]) == 3
@@ -0,0 +1,86 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# Skipped without torch, which the module imports.
+registry = pytest.importorskip('app.registry')
+
+
+# Keeps test models out of the process-wide registry.
+pytestmark = pytest.mark.usefixtures('isolated_registry')
+
+
+@pytest.fixture
+def isolated_registry(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(registry, '_models', [])
+
+
+def _managed(load):
+    return registry.ManagedModel('test', load, lambda _: [])
+
+
+def test_stats_do_not_wait_for_a_load():
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load() -> str:
+        loading.set()
+        release.wait(timeout=5)
+        return 'model'
+
+    model = _managed(load)
+
+    def use() -> str:
+        with model.use() as loaded:
+            return loaded
+
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(use)
+        assert loading.wait(timeout=5)
+        try:
+            # Would block until `release` while the load held the state lock.
+            stats = registry.model_stats()['test']
+            assert not stats.loaded
+            assert stats.loads == 0
+            assert model.unload_if_idle(0) is False
+        finally:
+            release.set()
+        assert future.result(timeout=5) == 'model'
+
+
+def test_concurrent_callers_share_one_load():
+    calls = 0
+    lock = threading.Lock()
+
+    def load() -> object:
+        nonlocal calls
+        with lock:
+            calls += 1
+        return object()
+
+    model = _managed(load)
+
+    def use() -> object:
+        with model.use() as loaded:
+            return loaded
+
+    with ThreadPoolExecutor(8) as pool:
+        loaded = set(pool.map(lambda _: id(use()), range(32)))
+
+    assert calls == 1
+    assert len(loaded) == 1
+    assert model.stats().in_use == 0
+
+
+def test_models_in_use_are_not_unloaded():
+    model = _managed(object)
+    with model.use():
+        assert model.unload_if_idle(0) is False
+        assert model.stats().idle_seconds is None
+
+    assert model.unload_if_idle(0) is True
+    assert not model.loaded
+    with model.use():
+        pass
+    assert model.stats().loads == 2
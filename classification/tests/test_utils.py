@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Self
+
+import pytest
+from fastapi import HTTPException
+
+from app.config import config
+from app.utils import SIGNATURE_SIZE, check_image_signature, download_image, open_shared_image
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.mark.parametrize(
+    'head',
+    [
+        b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01',
+        b'\x89PNG\r\n\x1a\n\x00\x00\x00\x0d',
+        b'GIF89a\x01\x00\x01\x00\x00\x00',
+        b'RIFF\x24\x00\x00\x00WEBP',
+        b'\x00\x00\x00\x1cftypavif',
+        b'\x00\x00\x00\x18ftypheic',
+    ],
+)
+def test_signature_accepts_images(head: bytes):
+    assert len(head) == SIGNATURE_SIZE
+    check_image_signature(head)
+
+
+@pytest.mark.parametrize(
+    'head',
+    [
+        b'\x00\x00\x00\x18ftypmp42',  # MP4
+        b'\x00\x00\x00\x14ftypqt  ',  # QuickTime
+        b'RIFF\x24\x00\x00\x00WAVE',
+        b'<!DOCTYPE html>'[:SIGNATURE_SIZE],
+        b'',
+    ],
+)
+def test_signature_rejects_other_files(head: bytes):
+    with pytest.raises(HTTPException) as excinfo:
+        check_image_signature(head)
+    assert excinfo.value.status_code == 415
+
+
+class _Response:
+    def __init__(self, body: bytes, headers: dict[str, str]) -> None:
+        self.ok = True
+        self.status_code = 200
+        self.headers = headers
+        self._body = body
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        pass
+
+    async def iter_content(self, chunk_size: int):
+        return _chunks(self._body, chunk_size)
+
+
+async def _chunks(body: bytes, chunk_size: int):
+    for start in range(0, len(body), chunk_size):
+        await asyncio.sleep(0)
+        yield body[start : start + chunk_size]
+
+
+class _Session:
+    def __init__(self, body: bytes, headers: dict[str, str] | None = None) -> None:
+        self._response = _Response(body, headers or {})
+
+    async def get(self, *args: object, **kwargs: object) -> _Response:
+        return self._response
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(100)
+
+
+def test_download_returns_body():
+    session = _Session(PNG, {'Content-Type': 'image/png'})
+    assert asyncio.run(download_image('https://example.com/a.png', session)) == PNG  # pyright: ignore[reportArgumentType]
+
+
+@pytest.mark.parametrize('headers', [{}, {'Content-Length': str(len(PNG))}])
+def test_download_reports_the_enforced_limit(headers: dict[str, str]):
+    session = _Session(PNG, headers)
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(download_image('https://example.com/a.png', session, max_bytes=50))  # pyright: ignore[reportArgumentType]
+
+    assert excinfo.value.status_code == 413
+    assert excinfo.value.detail == 'Image is too large: more than 50 bytes'
+
+
+def test_download_rejects_unknown_magic_bytes():
+    session = _Session(b'\x00\x00\x00\x18ftypmp42' + bytes(100))
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(download_image('https://example.com/a.mp4', session))  # pyright: ignore[reportArgumentType]
+    assert excinfo.value.status_code == 415
+
+
+@pytest.fixture
+def shared_volume(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    root = tmp_path / 'shared'
+    (root / 'nested').mkdir(parents=True)
+    (root / 'nested' / 'a.png').write_bytes(PNG)
+    (tmp_path / 'secret.png').write_bytes(PNG)
+    monkeypatch.setattr(config, 'IMAGE_SHARED_VOLUME', str(root))
+    return root
+
+
+def test_shared_image_maps_files_under_the_volume(shared_volume: Path):
+    with open_shared_image('nested/a.png') as mapped:
+        assert mapped[:] == PNG
+
+
+@pytest.mark.parametrize('path', ['../secret.png', 'nested/../../secret.png', 'missing.png'])
+def test_shared_image_stays_inside_the_volume(shared_volume: Path, path: str):
+    with pytest.raises(HTTPException) as excinfo:
+        open_shared_image(path)
+    assert excinfo.value.status_code == 404
+
+
+def test_shared_image_rejects_absolute_paths_outside(shared_volume: Path):
+    with pytest.raises(HTTPException) as excinfo:
+        open_shared_image(str(shared_volume.parent / 'secret.png'))
+    assert excinfo.value.status_code == 404
+
+
+def test_shared_image_does_not_follow_symlinks_out(shared_volume: Path):
+    (shared_volume / 'link.png').symlink_to(shared_volume.parent / 'secret.png')
+    with pytest.raises(HTTPException) as excinfo:
+        open_shared_image('link.png')
+    assert excinfo.value.status_code == 404
+
+
+def test_shared_image_requires_a_volume(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(config, 'IMAGE_SHARED_VOLUME', None)
+    with pytest.raises(HTTPException) as excinfo:
+        open_shared_image('a.png')
+    assert excinfo.value.status_code == 400
+
+
+def test_shared_image_enforces_the_size_limit(shared_volume: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(config, 'IMAGE_MAX_BYTES', 50)
+    with pytest.raises(HTTPException) as excinfo:
+        open_shared_image('nested/a.png')
+    assert excinfo.value.status_code == 413
@@ -120,15 +120,14 @@ export namespace EmbeddingsService {
 			) {
 				yield* Effect.logInfo("EmbeddingsService: Generating text embeddings");
 
-				const request = yield* HttpClientRequest.post(`${env.ML_BASE_URL}/v1/embeddings`).pipe(
+				const request = yield* HttpClientRequest.post(
+					`${env.ML_BASE_URL}/v1/embeddings/query`,
+				).pipe(
 					HttpClientRequest.setHeaders({
 						"X-API-Token": env.ML_API_TOKEN!,
 						"X-Request-Id": requestId ?? Bun.randomUUIDv7(),
 					}),
-					HttpClientRequest.bodyJson({
-						tags: query,
-						encoding_mode: "retrieval.query",
-					}),
+					HttpClientRequest.bodyJson({ query }),
 					Effect.mapError((error) =>
 						EmbeddingsError.fromCause({
 							message: "Failed to encode request body",